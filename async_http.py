@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+
+import aiohttp
+
+import metrics
+
+
+class Client:
+    # JSON API client over a pool of keep-alive connections. Requests wait
+    # for the shared RateBudget, and rate limit or timeout errors are
+    # retried in place, so callers never have to restart.
+    def __init__(self, base_url, headers, budget, connections=20):
+        self.base_url = base_url.rstrip('/')
+        self.budget = budget
+
+        connector = aiohttp.TCPConnector(limit=connections, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(
+            headers=headers, connector=connector,
+            timeout=aiohttp.ClientTimeout(total=60))
+
+    def rate_limited(self, response):
+        if response.status == 429:
+            return True
+        return response.status == 403 and (
+            'Retry-After' in response.headers or
+            response.headers.get('X-RateLimit-Remaining') == '0')
+
+    async def get(self, path, params=None, headers=None):
+        # Returns (status, data, links, headers), data is None for a 304
+        url = path
+        if not path.startswith('http'):
+            url = self.base_url + path
+
+        while True:
+            await self.budget.acquire_async()
+            start = time.monotonic()
+            try:
+                async with self.session.get(url, params=params, headers=headers) as response:
+                    metrics.observe_response(self.budget.name, response.status, time.monotonic() - start)
+                    self.budget.update_from_headers(response.headers)
+
+                    if self.rate_limited(response):
+                        print("API request limit reached. Waiting until the limit is reset.")
+                        if self.budget.remaining is None:
+                            await asyncio.sleep(60)
+                        continue
+
+                    links = {rel: str(link['url']) for rel, link in response.links.items()}
+                    if response.status == 304:
+                        return response.status, None, links, response.headers
+
+                    response.raise_for_status()
+                    return response.status, await response.json(), links, response.headers
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                print("Request timed out. Retrying in 60 seconds.")
+                await asyncio.sleep(60)
+
+    async def get_all(self, path, params=None):
+        result = []
+        url = path
+        while url is not None:
+            status, data, links, headers = await self.get(url, params)
+            result.extend(data)
+            url = links.get('next')
+            params = None
+        return result
+
+    async def fetch_after(self, path, cursor, per_page):
+        # Same as sync_pool.fetch_after, for APIs with 1-based page numbers
+        start = 0
+        if cursor is not None:
+            start = cursor['count']
+
+        page = 0
+        if start > 0:
+            page = (start - 1) // per_page
+
+        items = []
+        index = page * per_page
+        verified = start == 0
+        while True:
+            status, batch, links, headers = await self.get(
+                path, {'page': page + 1, 'per_page': per_page})
+            for item in batch:
+                if index == start - 1:
+                    if item['id'] != cursor['id']:
+                        return await self.fetch_after(path, None, per_page)
+                    verified = True
+                elif index >= start:
+                    items.append(item)
+                index += 1
+
+            if len(batch) < per_page:
+                break
+            page += 1
+
+        if not verified:
+            return await self.fetch_after(path, None, per_page)
+
+        new_cursor = cursor
+        if items:
+            new_cursor = {'count': start + len(items), 'id': items[-1]['id']}
+
+        return items, new_cursor, start == 0
+
+    async def close(self):
+        await self.session.close()
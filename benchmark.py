@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks of the store, burndown, the exports and, with --sync,
+# the async importers against fake_api.py. A synthetic store is generated
+# for every size, with event histories, renamed milestones, labels,
+# pull requests and both GitHub and GitLab repositories:
+#
+#   ./benchmark.py --sizes 1k,10k,100k --save-baseline baseline.json
+#   ./benchmark.py --sizes 1k,10k,100k --compare baseline.json
+#
+# Every stage runs in a fresh process, so its peak memory is its own. It
+# reports wall time, issues per second and peak RSS, and with --compare
+# the change against a saved run; a stage more than --threshold slower
+# than the baseline counts as a regression and makes the exit status 1.
+#
+# Burndown stages also save a digest of their output, and a different
+# one fails the comparison too. With --modules the stages import the
+# code of another checkout, so a golden baseline can come from an older
+# revision:
+#
+#   git worktree add ../before <revision>
+#   ./benchmark.py --stages burndown --modules ../before --save-baseline golden.json
+#   ./benchmark.py --stages burndown --compare golden.json
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+ORGNAME = 'org'
+EPOCH = datetime.datetime(2018, 1, 1)
+MILESTONES = ['1.%d' % i for i in range(10)]
+LABELS = ['bug', 'feature', 'docs', '1sp', '2sp', '3sp', '5sp']
+
+STAGES = ['read_issues', 'write_issues', 'burndown', 'burndown_cached', 'burndown_records',
+          'burndown_records_cached', 'export_tsv', 'export_xlsx', 'export_xlsx_constant_memory', 'export_parquet', 'pipeline']
+SYNC_STAGES = ['sync_github', 'sync_gitlab']
+STAGE_MODULES = {
+    'burndown': ['burndown'],
+    'burndown_cached': ['burndown'],
+    'burndown_records': ['burndown'],
+    'burndown_records_cached': ['burndown'],
+    'export_tsv': ['export_tsv'],
+    'export_xlsx': ['export_xlsx'],
+    'export_xlsx_constant_memory': ['export_xlsx'],
+    'export_parquet': ['export_parquet'],
+    'pipeline': ['export_pipeline'],
+    'sync_github': ['import_github_async'],
+    'sync_gitlab': ['import_gitlab_async']
+}
+
+BURNDOWN_STAGES = ['burndown', 'burndown_cached', 'burndown_records', 'burndown_records_cached']
+BURNDOWN_CACHE = 'bench_burndown_cache.json'
+
+BASELINE_VERSION = 1
+# Differences below this many seconds are noise, never regressions
+NOISE = 0.05
+
+
+def parse_size(text):
+    match = re.match(r'^(\d+)([kKmM]?)$', text)
+    if match is None:
+        raise argparse.ArgumentTypeError('bad size %r' % text)
+    return int(match.group(1)) * {'': 1, 'k': 1000, 'm': 1000000}[match.group(2).lower()]
+
+
+def timestamp(seconds):
+    return (EPOCH + datetime.timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def generate_repo(rnd, reponame, source, count, renames):
+    # renames maps a milestone title to the title it was renamed to, so
+    # issues added before the rename have the old title in their events
+    repo_issues = {}
+    for number in range(1, count + 1):
+        created = rnd.randint(0, 3 * 365 * 86400)
+        t = created
+        milestone = None
+        labels = set(rnd.sample(LABELS, rnd.randint(0, 2)))
+        events = []
+        for e in range(rnd.randint(0, 8)):
+            t += rnd.randint(60, 20 * 86400)
+            kind = rnd.choice(['milestoned', 'milestoned', 'demilestoned', 'labeled', 'unlabeled'])
+            if kind == 'milestoned':
+                milestone = rnd.choice(MILESTONES)
+                events.append({'created_at': timestamp(t), 'event': kind, 'milestone': milestone, 'label': None})
+            elif kind == 'demilestoned' and milestone is not None:
+                events.append({'created_at': timestamp(t), 'event': kind, 'milestone': milestone, 'label': None})
+                milestone = None
+            elif kind == 'labeled':
+                label = rnd.choice(LABELS)
+                labels.add(label)
+                events.append({'created_at': timestamp(t), 'event': kind, 'milestone': None, 'label': label})
+            elif kind == 'unlabeled' and labels:
+                label = rnd.choice(sorted(labels))
+                labels.discard(label)
+                events.append({'created_at': timestamp(t), 'event': kind, 'milestone': None, 'label': label})
+
+        closed = None
+        if rnd.random() < 0.6:
+            closed = t + rnd.randint(60, 10 * 86400)
+
+        weight = 1
+        for label in sorted(labels):
+            if label.endswith('sp'):
+                weight = int(label[:-2])
+
+        current = renames.get(milestone, milestone)
+        repo_issues[str(number)] = {
+            'orgname': ORGNAME,
+            'reponame': reponame,
+            'number': number,
+            'source': source,
+            'title': 'Issue %d of %s' % (number, reponame),
+            'updated_at': timestamp(max(t, closed or 0) + 1),
+            'created_at': timestamp(created),
+            'closed_at': timestamp(closed) if closed is not None else None,
+            'state': 'closed' if closed is not None else 'open',
+            'is_pr': source == 'github.com' and rnd.random() < 0.2,
+            'labels': sorted(labels),
+            'milestone': current,
+            'milestone_number': MILESTONES.index(milestone) + 1 if milestone is not None else None,
+            'events': events,
+            'weight': weight
+        }
+    return repo_issues
+
+
+def generate_store(directory, issues, repos=None, seed=1):
+    # Writes issues.json into directory one repository at a time and
+    # returns the milestone config for burndown
+    import issue_store
+
+    if repos is None:
+        repos = max(5, issues // 2000)
+    rnd = random.Random(seed)
+
+    milestones = {'Releases': {}, 'Next': {}}
+    filename = os.path.join(directory, issue_store.SNAPSHOT)
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('{%s: {' % json.dumps(ORGNAME))
+        for r in range(repos):
+            reponame = 'repo%d' % r
+            source = 'https://gitlab.com' if r % 5 == 4 else 'github.com'
+            renamed = rnd.sample(MILESTONES, 2)
+            renames = {title: title + '.0' for title in renamed}
+            count = issues // repos + (1 if r < issues % repos else 0)
+
+            repo_issues = generate_repo(rnd, reponame, source, count, renames)
+            f.write('%s%s: %s' % (',' if r else '', json.dumps(reponame), json.dumps(repo_issues)))
+
+            # Burndown covers the first repositories, under the titles
+            # the milestones have now
+            if r < 50:
+                titles = [renames.get(title, title) for title in MILESTONES]
+                milestones['Releases'][reponame] = titles[:5]
+                milestones['Next'][reponame] = titles[5:]
+        f.write('}}')
+
+    return milestones
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+@contextlib.contextmanager
+def quiet():
+    # Exporters and importers print progress and XlsxWriter warns about
+    # every hyperlink over its limit, which is not what is measured
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+
+def run_stage(stage, workdir, params):
+    # Runs in its own process. Returns the seconds of the measured part
+    # and the number of issues it handled. Only the modules of the stage
+    # are imported, so numpy and pyarrow don't count towards the peak
+    # memory of every stage, and before the clock starts. Burndown stages
+    # also return a digest of their output.
+    if params['modules'] is not None:
+        sys.path.insert(0, params['modules'])
+    import issue_store
+    for name in STAGE_MODULES.get(stage, []):
+        importlib.import_module(name)
+
+    os.chdir(workdir)
+    milestones = params['milestones']
+    issues = None
+    if stage in ['write_issues'] + BURNDOWN_STAGES:
+        issues = issue_store.read_issues()
+
+    if stage in BURNDOWN_STAGES:
+        import burndown
+
+    if stage in ['burndown_records', 'burndown_records_cached']:
+        # Typed records built beforehand, as the export pipeline shares
+        # them between burndown and the sinks
+        import issue_model
+        index = burndown.MilestoneIndex(milestones)
+        repos = list(issue_model.iter_issues(issues, reponames=index.reponames, is_pr=False,
+                                             milestoned_only=True))
+
+    if stage == 'burndown_cached':
+        # Fills the cache file, which the measured run then starts from,
+        # as an export after a sync that changed nothing would
+        with quiet():
+            burndown.burndown(issues, milestones, burndown.BurndownCache(BURNDOWN_CACHE))
+    elif stage == 'burndown_records_cached':
+        with quiet():
+            burndown.burndown_repos(repos, index, burndown.BurndownCache(BURNDOWN_CACHE))
+
+    start = time.perf_counter()
+    count = params['issues']
+    output = None
+    with quiet():
+        if stage == 'read_issues':
+            issues = issue_store.read_issues()
+        elif stage == 'write_issues':
+            issue_store.checkpoint(issues)
+        elif stage == 'burndown':
+            output = burndown.burndown(issues, milestones)
+        elif stage == 'burndown_cached':
+            output = burndown.burndown(issues, milestones, burndown.BurndownCache(BURNDOWN_CACHE))
+        elif stage == 'burndown_records':
+            output = burndown.burndown_repos(repos, index)
+        elif stage == 'burndown_records_cached':
+            output = burndown.burndown_repos(repos, index, burndown.BurndownCache(BURNDOWN_CACHE))
+        elif stage == 'export_tsv':
+            import export_tsv
+            export_tsv.do_export(issue_store.IssueStream(), 'bench.tsv', ORGNAME)
+        elif stage == 'export_xlsx':
+            import export_xlsx
+            export_xlsx.do_export(issue_store.IssueStream(), 'bench.xlsx', milestones)
+        elif stage == 'export_xlsx_constant_memory':
+            import export_xlsx
+            export_xlsx.do_export(issue_store.IssueStream(), 'bench.xlsx', milestones, constant_memory=True)
+        elif stage == 'export_parquet':
+            import export_parquet
+            export_parquet.do_export(issue_store.IssueStream(), 'bench_parquet')
+        elif stage == 'pipeline':
+            import export_pipeline
+            export_pipeline.run(issue_store.IssueStream(), [
+                export_pipeline.TsvSink('bench.tsv', ORGNAME),
+                export_pipeline.XlsxSink('bench.xlsx', constant_memory=True),
+                export_pipeline.ParquetSink('bench_parquet')
+            ], milestones)
+        elif stage in SYNC_STAGES:
+            count = run_sync(stage, params)
+        else:
+            raise ValueError('unknown stage %s' % stage)
+    seconds = time.perf_counter() - start
+
+    result = {'seconds': seconds, 'issues': count, 'peak_mb': peak_rss_mb()}
+    if output is not None:
+        result['digest'] = burndown_digest(output)
+    return result
+
+
+def burndown_digest(bd):
+    # SHA-1 of everything burndown returns, in its order: the groups, their
+    # days and values, and their issues. Issues were store records before
+    # they were Issue objects, so both are accepted.
+    def key(issue):
+        if isinstance(issue, dict):
+            return [issue['orgname'], issue['reponame'], int(issue['number'])]
+        return [issue.orgname, issue.reponame, issue.number]
+
+    data = [[group, [[day.isoformat(), int(value)] for day, value in entries['days'].items()],
+             [key(issue) for issue in entries['issues']]]
+            for group, entries in bd.items()]
+    return hashlib.sha1(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+def run_sync(stage, params):
+    # A sync into the empty store of the working directory
+    import issue_store
+
+    if stage == 'sync_github':
+        import import_github_async
+        import_github_async.do_import('token', ORGNAME, workers=params['workers'],
+                                      requests_per_hour=None, base_url=params['api_url'])
+    else:
+        import import_gitlab_async
+        import_gitlab_async.do_import('token', ORGNAME, workers=params['workers'],
+                                      requests_per_hour=None, base_url=params['api_url'])
+
+    return sum(len(repo_issues) for org in issue_store.read_issues().values() for repo_issues in org.values())
+
+
+def measure(stage, workdir, params, repeat):
+    # Best of repeat runs, each in a new process
+    best = None
+    for i in range(repeat):
+        if stage in SYNC_STAGES:
+            # Every sync starts from an empty store
+            shutil.rmtree(workdir, ignore_errors=True)
+            os.makedirs(workdir)
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_stage, stage, workdir, params).result()
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    best['throughput'] = best['issues'] / best['seconds'] if best['seconds'] > 0 else 0
+    return best
+
+
+@contextlib.contextmanager
+def fake_api(issues, latency, rate_limit, window):
+    # fake_api.py in a separate process, serving about as many issues as
+    # the store has
+    repos = max(1, issues // 1000)
+    process = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_api.py'),
+         '--port', '0', '--org', ORGNAME, '--repos', str(repos), '--issues', str(max(1, issues // repos)),
+         '--latency', str(latency), '--rate-limit', str(rate_limit), '--window', str(window)],
+        stdout=subprocess.PIPE, text=True)
+    try:
+        line = process.stdout.readline()
+        match = re.search(r'(http://\S+)', line)
+        if match is None:
+            raise RuntimeError('fake_api.py did not start: %r' % line)
+        yield match.group(1)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def compare(results, baseline, threshold):
+    # Returns the rows of (size, stage, ratio of seconds, ratio of peak
+    # memory, regression, output changed) for the stages that are in both.
+    # Every burndown stage has to return what the burndown stage of the
+    # baseline did, which may be all the baseline has of them; the ratios
+    # of those are None.
+    rows = []
+    for size, stages in results.items():
+        golden = baseline.get(size, {}).get('burndown', {}).get('digest')
+        for stage, result in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            digest = golden if golden is not None else (base or {}).get('digest')
+            changed = 'digest' in result and digest is not None and result['digest'] != digest
+            if base is None:
+                if 'digest' in result and digest is not None:
+                    rows.append((size, stage, None, None, False, changed))
+                continue
+
+            ratio = result['seconds'] / base['seconds'] if base['seconds'] > 0 else 1
+            memory = result['peak_mb'] / base['peak_mb'] if base['peak_mb'] > 0 else 1
+            regression = ratio > 1 + threshold and result['seconds'] - base['seconds'] > NOISE
+            rows.append((size, stage, ratio, memory, regression, changed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the store, burndown, exports and importers.')
+    parser.add_argument('--sizes', default='1k,10k',
+                        help='comma separated numbers of issues, e.g. 1k,10k,100k,1M (default: 1k,10k)')
+    parser.add_argument('--repos', type=int, default=None,
+                        help='repositories in the store (default: one per 2000 issues, at least 5)')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated stages (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the fastest is reported')
+    parser.add_argument('--sync', action='store_true',
+                        help='also sync from fake_api.py with both async importers')
+    parser.add_argument('--sync-max', type=parse_size, default=parse_size('10k'),
+                        help='largest size to sync (default: 10k)')
+    parser.add_argument('--latency', type=float, default=0.002, help='fake API latency in seconds')
+    parser.add_argument('--rate-limit', type=int, default=1000000, help='fake API requests per window')
+    parser.add_argument('--window', type=int, default=3600, help='fake API rate limit window in seconds')
+    parser.add_argument('--workers', type=int, default=4, help='sync workers')
+    parser.add_argument('--workdir', default=None, help='where stores are generated (default: a temporary directory)')
+    parser.add_argument('--modules', metavar='DIRECTORY', default=None,
+                        help='import the store, burndown and the exporters from a checkout of another revision')
+    parser.add_argument('--save-baseline', metavar='FILENAME')
+    parser.add_argument('--compare', metavar='FILENAME')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown against the baseline that counts as a regression (default: 0.2)')
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    stages = [stage for stage in args.stages.split(',') if stage]
+    for stage in stages:
+        if stage not in STAGES + SYNC_STAGES:
+            parser.error('unknown stage %s' % stage)
+
+    root = args.workdir
+    if root is None:
+        root = tempfile.mkdtemp(prefix='benchmark-')
+    os.makedirs(root, exist_ok=True)
+
+    results = {}
+    print('%8s  %-28s %10s %12s %10s' % ('issues', 'stage', 'seconds', 'issues/s', 'peak MB'))
+    try:
+        for size in sizes:
+            workdir = os.path.join(root, str(size))
+            shutil.rmtree(workdir, ignore_errors=True)
+            os.makedirs(workdir)
+
+            start = time.perf_counter()
+            milestones = generate_store(workdir, size, args.repos)
+            print('%8d  %-28s %10.3f' % (size, 'generate', time.perf_counter() - start))
+
+            params = {'milestones': milestones, 'issues': size, 'workers': args.workers,
+                      'modules': os.path.abspath(args.modules) if args.modules is not None else None}
+            results[str(size)] = {}
+
+            size_stages = list(stages)
+            if args.sync and size <= args.sync_max:
+                size_stages += [stage for stage in SYNC_STAGES if stage not in size_stages]
+
+            for stage in size_stages:
+                if stage in SYNC_STAGES:
+                    with fake_api(size, args.latency, args.rate_limit, args.window) as api_url:
+                        result = measure(stage, os.path.join(root, '%d-%s' % (size, stage)),
+                                         dict(params, api_url=api_url), args.repeat)
+                else:
+                    result = measure(stage, workdir, params, args.repeat)
+
+                results[str(size)][stage] = result
+                print('%8d  %-28s %10.3f %12.0f %10.1f' % (
+                    size, stage, result['seconds'], result['throughput'], result['peak_mb']))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({
+                'version': BASELINE_VERSION,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'modules': args.modules,
+                'results': results
+            }, indent=2))
+        print('Baseline written to %s' % args.save_baseline)
+
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.loads(f.read())
+        if baseline.get('version') != BASELINE_VERSION:
+            raise RuntimeError('%s is not a baseline of this version' % args.compare)
+
+        print()
+        print('Against %s (%s, Python %s):' % (args.compare, baseline['date'], baseline['python']))
+        print('%8s  %-28s %10s %10s' % ('issues', 'stage', 'time', 'memory'))
+        regressions = 0
+        changes = 0
+        for size, stage, ratio, memory, regression, changed in compare(results, baseline['results'], args.threshold):
+            if ratio is None:
+                change = '%10s %10s' % ('-', '-')
+            else:
+                change = '%+9.1f%% %+9.1f%%' % ((ratio - 1) * 100, (memory - 1) * 100)
+            print('%8s  %-28s %s%s%s' % (size, stage, change, '  REGRESSION' if regression else '',
+                                         '  OUTPUT CHANGED' if changed else ''))
+            regressions += regression
+            changes += changed
+        if regressions:
+            print('%d regressions' % regressions)
+        if changes:
+            print('%d stages changed their output' % changes)
+        if regressions or changes:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
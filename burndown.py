@@ -1,195 +1,433 @@
 #!/usr/bin/env python3
 import datetime
 import collections
+import gc
+import hashlib
 import os
 import json
+import operator
 import pprint
+import time
 
-def read_issues():
-    issues = {}
-    if os.path.exists('issues.json'):
-        with open('issues.json', encoding='utf-8') as f:
-            issues = json.loads(f.read())
-    return issues
-
-
-def merge_days(lhs, rhs):
-    if len(list(lhs)) == 0 and len(list(rhs)) == 0:
-        return collections.OrderedDict()
-
-    if len(list(lhs)) == 0:
-        return rhs
-
-    if len(list(rhs)) == 0:
-        return lhs
-
-    start_date = min(list(lhs)[0], list(rhs)[0])
-    end_date = max(list(lhs)[-1], list(rhs)[-1])
-
-    delta = datetime.timedelta(days=1)
+import numpy
 
-    days = collections.OrderedDict()
+import issue_model
+import issue_store
+import metrics
+import profiler
 
-    last_lhs = None
-    last_rhs = None
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
 
-    while start_date <= end_date:
-        days[start_date] = 0
+CACHE_FILE = 'burndown_cache.json'
 
-        if start_date in lhs:
-            days[start_date] += lhs[start_date]
-            last_lhs = lhs[start_date]
-        elif last_lhs is not None:
-            days[start_date] += last_lhs
-
-        if start_date in rhs:
-            days[start_date] += rhs[start_date]
-            last_rhs = rhs[start_date]
-        elif last_rhs is not None:
-            days[start_date] += last_rhs
-
-
-        start_date += delta
-
-
-    return days
-
-def burndown(issues, milestones):
-    bd = {}
-
-    burndowns = {}
-    for orgname, org_repos in issues.items():
-        for reponame, repo_issues in org_repos.items():
-            milestone_issues = {}
-            if reponame not in burndowns:
-                burndowns[reponame] = {}
+DAY = 24 * 60 * 60
 
-            bd[reponame] = collections.defaultdict(list)
+# Codes of the events burndown looks at. Other kinds get 0 as they are
+# first seen.
+MILESTONED = 1
+DEMILESTONED = 2
+EVENT_KINDS = collections.defaultdict(int, {'milestoned': MILESTONED, 'demilestoned': DEMILESTONED})
+EVENT_KIND = operator.attrgetter('event')
+EVENT_TIME = operator.attrgetter('created_at')
+EVENT_TITLE = operator.attrgetter('milestone')
 
-            aliases = {}
-
-            for number, issue in repo_issues.items():
-                issue['number'] = number
-
-            for number, issue in repo_issues.items():
-                if issue['is_pr']:
-                    continue
-                if issue['milestone'] is not None:
-                    if issue['milestone'] not in milestone_issues:
-                        milestone_issues[issue['milestone']] = []
-
-                    milestone_issues[issue['milestone']].append(issue)
-
-
-                for event in reversed(issue['events']):
-                    if event['event'] == 'demilestoned':
-                        break
-
-                    if event['event'] == 'milestoned' and issue['milestone'] is not None:
-                        if event['milestone'] != issue['milestone']:
-                            aliases[event['milestone']] = issue['milestone']
-                        break
-
-
-
-            for number, issue in repo_issues.items():
-                if issue['is_pr']:
-                    continue
-
-                closed_at = None
+def read_issues():
+    return issue_store.read_issues()
 
-                if issue['closed_at'] is not None:
-                    closed_at = datetime.datetime.strptime(issue['closed_at'], "%Y-%m-%dT%H:%M:%SZ")
 
-                milestoned = {}
-                last_milestone = None
-                for event in issue['events']:
-                    if event['event'] not in ['milestoned', 'demilestoned']:
-                        continue
+def to_days(first, values):
+    # A series kept as its first day (days since 1970-01-01) and an array
+    # of values, one per day, as an OrderedDict of date -> value
+    calendar = numpy.arange(first, first + len(values)).astype('datetime64[D]')
+    return collections.OrderedDict(zip(calendar.tolist(), values.tolist()))
 
-                    created_at = datetime.datetime.strptime(event['created_at'], "%Y-%m-%dT%H:%M:%SZ")
 
-                    if closed_at is not None and created_at > closed_at:
-                        continue
+def merge_arrays(series):
+    # Sums (days, values) series, days being sorted days since 1970-01-01,
+    # over the union of their day ranges. A series counts with its last
+    # value after it ends and with zero before it starts. Each series is
+    # reduced to its value changes, which are accumulated onto one shared
+    # calendar and summed up in a single pass, so the cost is linear in the
+    # days and points involved. Returns the first day and the values.
+    days = numpy.concatenate([d for d, v in series])
+    changes = numpy.concatenate([numpy.diff(v, prepend=0) for d, v in series])
 
-                    milestone = event['milestone']
+    first = days.min()
+    totals = numpy.zeros(days.max() - first + 1, dtype=changes.dtype)
+    numpy.add.at(totals, days - first, changes)
 
-                    if milestone in aliases:
-                        milestone = aliases[milestone]
+    return first, numpy.cumsum(totals)
 
-                    if event['event'] == 'milestoned':
-                        last_milestone = milestone
-                        milestoned[milestone] = created_at
-                        bd[reponame][milestone].append(
-                            (created_at.date(),
-                             issue['weight']))
-                    else:
-                        last_milestone = None
-                        last = milestoned.get(event['milestone'], None)
-                        if last == None:
-                            continue
 
-                        if closed_at is not None and last <= closed_at and closed_at <= created_at:
-                            bd[reponame][event['milestone']].append(
-                                (closed_at.date(),
-                                 -issue['weight']))
-                        else:
-                            bd[reponame][event['milestone']].append(
-                                (created_at.date(),
-                                 -issue['weight']))
+def merge_series(series):
+    # Same as merge_arrays for any number of OrderedDicts of date -> value
+    series = [s for s in series if len(s) > 0]
+    if len(series) == 0:
+        return collections.OrderedDict()
+    if len(series) == 1:
+        return series[0]
 
-                if last_milestone is not None and closed_at is not None:
-                    bd[reponame][last_milestone].append(
-                        (closed_at.date(),
-                         -issue['weight']))
+    # Converting date objects through toordinal() is much faster than
+    # having numpy parse them
+    return to_days(*merge_arrays([
+        (numpy.fromiter((d.toordinal() for d in s), numpy.int64, len(s)) - EPOCH_ORDINAL,
+         numpy.array(list(s.values())))
+        for s in series]))
 
-            for milestone, evts in bd[reponame].items():
-                evts.sort(key=lambda e: e[0])
 
-                start_date = evts[0][0]
-                end_date = evts[-1][0]
-                delta = datetime.timedelta(days=1)
+def merge_days(lhs, rhs):
+    return merge_series([lhs, rhs])
 
-                days = collections.OrderedDict()
-                while start_date <= end_date:
-                    days[start_date] = 0
-                    start_date += delta
 
-                for evt in evts:
-                    days[evt[0]] += evt[1]
+def daily_series(days, codes, deltas, milestones):
+    # Turns the columns of (day since 1970-01-01, milestone code, weight
+    # delta) into a cumulative daily series per milestone, covering every
+    # day from its first to its last change, as (first day, values).
+    if len(days) == 0:
+        return collections.OrderedDict()
 
-                acc = 0
-                for day, count in days.items():
-                    acc = acc + count
-                    days[day] = acc
+    days = numpy.array(days, dtype=numpy.int64)
+    codes = numpy.array(codes)
+    deltas = numpy.array(deltas)
+
+    # Group by milestone, then by day
+    order = numpy.lexsort((days, codes))
+    days = days[order]
+    codes = codes[order]
+    deltas = deltas[order]
+    bounds = numpy.flatnonzero(numpy.diff(codes)) + 1
+
+    result = collections.OrderedDict()
+    for group_days, group_codes, group_deltas in zip(numpy.split(days, bounds),
+                                                     numpy.split(codes, bounds),
+                                                     numpy.split(deltas, bounds)):
+        first = group_days[0]
+        totals = numpy.zeros(group_days[-1] - first + 1, dtype=group_deltas.dtype)
+        numpy.add.at(totals, group_days - first, group_deltas)
+
+        result[milestones[group_codes[0]]] = (int(first), numpy.cumsum(totals))
+
+    # Milestones in the order of their first change, like the input
+    return collections.OrderedDict((m, result[m]) for m in milestones if m in result)
+
+
+def repo_deltas(issues, aliases):
+    # The (day, milestone, weight delta) changes a list of issues of one
+    # repository make to its burndowns, computed for all of them at once.
+    # Per issue, milestone events after it was closed don't count. A
+    # milestoned event adds the weight to the milestone, under its current
+    # title. A demilestoned event subtracts it from the title in the event,
+    # if an earlier milestoned event of the issue added to that title. An
+    # issue closed while its last event is a milestoned one is subtracted
+    # from that milestone on the day it was closed.
+    #
+    # Returns the columns (owner, days, codes, deltas) in the order the
+    # changes happen, issue by issue, and the titles the codes index, in
+    # the order of their first change. owner is the position of the issue
+    # in issues, days are counted from 1970-01-01 like numpy's
+    # datetime64[D].
+
+    # Columns of all events, gathered with C-level iteration since there
+    # are many more of them than issues
+    events = [event for issue in issues for event in issue.events]
+    kinds = numpy.fromiter(map(EVENT_KINDS.__getitem__, map(EVENT_KIND, events)), numpy.int8, len(events))
+    selected = numpy.flatnonzero(kinds)
+    if len(selected) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty, empty, []
+
+    owner = numpy.repeat(numpy.arange(len(issues)), [len(issue.events) for issue in issues])[selected]
+    added = kinds[selected] == MILESTONED
+    times = numpy.fromiter(map(EVENT_TIME, events), numpy.int64, len(events))[selected]
+    titles = list(map(EVENT_TITLE, map(events.__getitem__, selected.tolist())))
+
+    # Titles as codes, both the one in the event and the current one
+    codes = dict.fromkeys(titles)
+    for code, title in enumerate(codes):
+        codes[title] = code
+    raw = numpy.fromiter(map(codes.__getitem__, titles), numpy.int64, len(titles))
+    renamed = [codes.setdefault(aliases.get(title, title), len(codes)) for title in list(codes)]
+    current = numpy.array(renamed, dtype=numpy.int64)[raw]
+
+    closed = numpy.array([issue.closed_at is not None for issue in issues])
+    closed_at = numpy.array([issue.closed_at or 0 for issue in issues], dtype=numpy.int64)
+    weights = numpy.array([issue.weight for issue in issues])
+
+    keep = ~(closed[owner] & (times > closed_at[owner]))
+    owner = owner[keep]
+    added = added[keep]
+    times = times[keep]
+    raw = raw[keep]
+    current = current[keep]
+    if len(owner) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty, empty, []
+
+    # A demilestoned event counts if the first milestoned event of the
+    # issue under its title comes before it
+    position = numpy.arange(len(owner))
+    width = len(codes)
+    added_keys, first = numpy.unique(owner[added] * width + current[added], return_index=True)
+    first = position[added][first]
+
+    removed = numpy.flatnonzero(~added)
+    removed_keys = owner[removed] * width + raw[removed]
+    found = numpy.zeros(len(removed), dtype=bool)
+    if len(added_keys):
+        at = numpy.minimum(numpy.searchsorted(added_keys, removed_keys), len(added_keys) - 1)
+        found = (added_keys[at] == removed_keys) & (first[at] < removed)
+
+    counted = added.copy()
+    counted[removed] = found
+    rows = numpy.flatnonzero(counted)
+
+    # The last milestone event of every issue, if it is a milestoned one
+    # with a title and the issue is closed, ends it on the day it was
+    # closed
+    last = numpy.flatnonzero(numpy.append(owner[1:] != owner[:-1], True))
+    ends = last[added[last] & closed[owner[last]] & (current[last] != codes.get(None, -1))]
+
+    row_owner = owner[rows]
+    end_owner = owner[ends]
+    owner = numpy.concatenate([row_owner, end_owner])
+    days = numpy.concatenate([times[rows], closed_at[end_owner]]) // DAY
+    change_codes = numpy.concatenate([numpy.where(added[rows], current[rows], raw[rows]), current[ends]])
+    deltas = numpy.concatenate([numpy.where(added[rows], weights[row_owner], -weights[row_owner]),
+                                -weights[end_owner]])
+
+    # An issue ends after its last event
+    order = numpy.argsort(numpy.concatenate([rows * 2, ends * 2 + 1]))
+    owner = owner[order]
+    days = days[order]
+    change_codes = change_codes[order]
+    deltas = deltas[order]
+
+    # Renumber the codes in the order of their first change
+    used, first = numpy.unique(change_codes, return_index=True)
+    used = used[numpy.argsort(first)]
+    renumbered = numpy.zeros(width, dtype=numpy.int64)
+    renumbered[used] = numpy.arange(len(used))
+    names = list(codes)
+
+    return owner, days, renumbered[change_codes], deltas, [names[code] for code in used]
+
+
+class BurndownCache:
+    # Daily series of every repository from the last run, with a
+    # fingerprint of the issues and aliases they come from. burndown()
+    # recomputes the series of a repository only when its fingerprint
+    # changed, and reads nothing per issue otherwise. reused and recomputed
+    # count the series of the last run.
+    VERSION = 3
+
+    def __init__(self, filename=CACHE_FILE):
+        self.filename = filename
+        self.reused = 0
+        self.recomputed = 0
+        self.dirty = False
+
+        self.repos = {}
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                data = json.loads(f.read())
+            if data.get('version') == self.VERSION:
+                self.repos = data['repos']
+
+    def series(self, orgname, reponame, fingerprint):
+        # The series of the repository as daily_series() returns them, or
+        # None if they were computed from other issues
+        entry = self.repos.get('%s/%s' % (orgname, reponame))
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        return collections.OrderedDict((milestone, (first, numpy.array(values)))
+                                       for milestone, first, values in entry['series'])
+
+    def store(self, orgname, reponame, fingerprint, series):
+        self.repos['%s/%s' % (orgname, reponame)] = {
+            'fingerprint': fingerprint,
+            'series': [[milestone, first, values.tolist()] for milestone, (first, values) in series.items()]
+        }
+        self.dirty = True
+
+    def stats(self):
+        return {
+            'reused': self.reused,
+            'recomputed': self.recomputed
+        }
+
+    def save(self):
+        issue_store.atomic_write(self.filename, json.dumps(
+            {'version': self.VERSION, 'repos': self.repos}, ensure_ascii=False))
+        self.dirty = False
+
+
+def repo_fingerprint(issues, aliases):
+    # Everything repo_deltas() reads changes updated_at, except closing
+    # times, weights and renames, which are hashed separately
+    return hashlib.sha1(repr((sorted(aliases.items()), [
+        (issue.number, issue.updated_at, issue.closed_at, issue.weight) for issue in issues
+    ])).encode('utf-8')).hexdigest()
+
+
+def find_aliases(repo_issues):
+    # Milestones that were renamed after an issue was added to them: maps
+    # the title in the last milestoned event to the current title.
+    aliases = {}
+
+    for number, issue in repo_issues.items():
+        if issue.is_pr or issue.milestone is None:
+            continue
+
+        for event in reversed(issue.events):
+            if event.event == 'demilestoned':
+                break
+
+            if event.event == 'milestoned':
+                if event.milestone != issue.milestone:
+                    aliases[event.milestone] = issue.milestone
+                break
+
+    return aliases
+
+
+class MilestoneIndex:
+    # Lookup tables shared by burndown and the exporters, built once per
+    # export: (reponame, milestone title) -> the configured burndown groups
+    # it belongs to, in config order, and per repository the aliases of
+    # renamed milestones, filled in as repositories are first seen.
+    def __init__(self, milestones):
+        self.groups = {}
+        for group, repos in milestones.items():
+            for reponame, titles in repos.items():
+                for title in titles:
+                    groups = self.groups.setdefault((reponame, title), [])
+                    if group not in groups:
+                        groups.append(group)
+
+        self.reponames = {reponame for reponame, title in self.groups}
+        self.aliases = {}
+
+    @classmethod
+    def build(cls, issues, milestones):
+        index = cls(milestones)
+        for orgname, reponame, repo_issues in issue_model.iter_issues(
+                issues, reponames=index.reponames, is_pr=False, milestoned_only=True):
+            index.repo_aliases(orgname, reponame, repo_issues)
+        return index
+
+    def repo_aliases(self, orgname, reponame, repo_issues):
+        if (orgname, reponame) not in self.aliases:
+            self.aliases[(orgname, reponame)] = find_aliases(repo_issues)
+        return self.aliases[(orgname, reponame)]
+
+    def canonical(self, orgname, reponame, title):
+        return self.aliases.get((orgname, reponame), {}).get(title, title)
+
+    def groups_of(self, reponame, title):
+        return self.groups.get((reponame, title), [])
+
+
+@profiler.traced('burndown.burndown')
+def burndown(issues, milestones, cache=None, index=None):
+    if index is None:
+        index = MilestoneIndex(milestones)
+
+    # Building the Issue objects allocates enough to run the cyclic garbage
+    # collector many times over, each time through the whole loaded store,
+    # which holds no cycles. That doubled the time at 100k issues.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # Only repositories named in the milestone config can contribute,
+        # and only issues that ever had a milestone
+        return burndown_repos(issue_model.iter_issues(
+            issues, reponames=index.reponames, is_pr=False, milestoned_only=True), index, cache)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+@profiler.traced('burndown.burndown_repos')
+def burndown_repos(repos, index, cache=None):
+    # burndown() over (orgname, reponame, repo_issues) of Issue objects that
+    # were read already, filtered as burndown() filters them
+    start = time.monotonic()
+    burndowns = {}
 
-                burndowns[reponame][milestone] = {
-                    "days": days,
-                    "issues": milestone_issues.get(milestone, [])
-                }
+    if cache is not None:
+        cache.reused = 0
+        cache.recomputed = 0
+
+    for orgname, reponame, repo_issues in repos:
+        milestone_issues = {}
+        if reponame not in burndowns:
+            burndowns[reponame] = {}
+
+        for number, issue in repo_issues.items():
+            if issue.is_pr:
+                continue
+            if issue.milestone is not None:
+                if issue.milestone not in milestone_issues:
+                    milestone_issues[issue.milestone] = []
+
+                milestone_issues[issue.milestone].append(issue)
+
+        aliases = index.repo_aliases(orgname, reponame, repo_issues)
+        issue_list = [issue for issue in repo_issues.values() if not issue.is_pr]
+
+        series = None
+        if cache is not None:
+            fingerprint = repo_fingerprint(issue_list, aliases)
+            series = cache.series(orgname, reponame, fingerprint)
+
+        if series is None:
+            owner, days, codes, deltas, titles = repo_deltas(issue_list, aliases)
+            series = daily_series(days, codes, deltas, titles)
+            if cache is not None:
+                cache.store(orgname, reponame, fingerprint, series)
+                cache.recomputed += len(series)
+            metrics.inc('burndown_series_total', len(series), state='recomputed')
+            metrics.inc('burndown_series_total', 0, state='reused')
+        else:
+            cache.reused += len(series)
+            metrics.inc('burndown_series_total', 0, state='recomputed')
+            metrics.inc('burndown_series_total', len(series), state='reused')
+
+        for milestone, milestone_days in series.items():
+            burndowns[reponame][milestone] = {
+                "days": milestone_days,
+                "issues": milestone_issues.get(milestone, [])
+            }
 
     res = {}
+    series = {}
 
     #print(milestones)
     for reponame in burndowns:
         for milestone in burndowns[reponame]:
 
-            for m in milestones:
-                if reponame in milestones[m] and milestone in milestones[m][reponame]:
-                    if m not in res:
-                        res[m] = {"days": collections.OrderedDict(), "issues": []}
+            for m in index.groups_of(reponame, milestone):
+                if m not in res:
+                    res[m] = {"days": collections.OrderedDict(), "issues": []}
+                    series[m] = []
 
-                    res[m]['days'] = merge_days(res[m]['days'], burndowns[reponame][milestone]['days'])
+                series[m].append(burndowns[reponame][milestone]['days'])
 
-                    for issue in burndowns[reponame][milestone]['issues']:
-                        issue['reponame'] = reponame
-                        if issue['milestone'] == milestone:
-                            res[m]['issues'].append(issue)
+                # All of them have the milestone now, by construction
+                res[m]['issues'].extend(burndowns[reponame][milestone]['issues'])
 
+    for m in res:
+        first, values = merge_arrays([(numpy.arange(first, first + len(values)), values)
+                                      for first, values in series[m]])
+        res[m]['days'] = to_days(first, values)
 
     #pp = pprint.PrettyPrinter(indent=4)
     #pp.pprint(res)
 
+    if cache is not None and cache.dirty:
+        cache.save()
+
+    metrics.observe('burndown_seconds', time.monotonic() - start)
     return res
 
 if __name__ == '__main__':
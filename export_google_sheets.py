@@ -1,20 +1,33 @@
 #!/usr/bin/env python3
 
+import json
 import pickle
 import os.path
+import time
+
+import httplib2
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.http import MediaFileUpload
 
 import export_xlsx
+import issue_store
+import metrics
+import profiler
 
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
+SPREADSHEET_MIME = 'application/vnd.google-apps.spreadsheet'
 
-def connect():
-    """Shows basic usage of the Drive v3 API.
-    Prints the names and ids of the first 10 files the user has access to.
-    """
+# Drive file id of every spreadsheet name exported so far
+FILE_IDS = 'drive_files.json'
+
+# Resumable uploads go in chunks of this size, a multiple of 256 KiB
+CHUNK_SIZE = 8 * 1024 * 1024
+RETRIES = 5
+
+def get_credentials():
     creds = None
     # The file token.pickle stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -34,49 +47,156 @@ def connect():
         with open('token.pickle', 'wb') as token:
             pickle.dump(creds, token)
 
-    service = build('drive', 'v3', credentials=creds)
+    return creds
+
+
+def connect():
+    """Shows basic usage of the Drive v3 API.
+    Prints the names and ids of the first 10 files the user has access to.
+    """
+    service = build('drive', 'v3', credentials=get_credentials())
 
     return service
 
 
 
-def get_file_id(service, filename):
-    # Call the Drive v3 API
-    results = service.files().list(
-        pageSize=10, fields="nextPageToken, files(id, name)").execute()
-    items = results.get('files', [])
-
-    if not items:
-        pass
-    else:
-        for item in items:
+def read_file_ids():
+    if os.path.exists(FILE_IDS):
+        with open(FILE_IDS, encoding='utf-8') as f:
+            return json.loads(f.read())
+    return {}
+
+
+def write_file_ids(file_ids):
+    issue_store.atomic_write(FILE_IDS, json.dumps(file_ids, ensure_ascii=False))
+
+
+def find_file(service, filename):
+    # Drive matches the name, so only candidates come back, but there may
+    # still be more than one page of them
+    query = "name = '%s' and mimeType = '%s' and trashed = false" % (
+        filename.replace('\\', '\\\\').replace("'", "\\'"), SPREADSHEET_MIME)
+    page_token = None
+    while True:
+        results = service.files().list(
+            q=query, spaces='drive', orderBy='modifiedTime desc', pageToken=page_token,
+            fields="nextPageToken, files(id, name)").execute()
+        for item in results.get('files', []):
             if item['name'] == filename:
                 return item['id']
 
-    return None
+        page_token = results.get('nextPageToken')
+        if page_token is None:
+            return None
+
+
+def file_exists(service, file_id):
+    # A file in the trash can still be updated, so it counts as gone too
+    try:
+        item = service.files().get(fileId=file_id, fields='trashed').execute()
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        return False
+    return not item.get('trashed', False)
 
-def do_export(issues, filename, milestones):
-    export_xlsx.do_export(issues, 'tmp.xlsx', milestones)
 
+def get_file_id(service, filename):
+    # The id found last time is used as long as the file is still there,
+    # otherwise it is looked up by name again
+    file_ids = read_file_ids()
+    if filename in file_ids:
+        if file_exists(service, file_ids[filename]):
+            return file_ids[filename]
+        print('File %s is gone or in the trash, looking it up again' % file_ids[filename])
+        del file_ids[filename]
+        write_file_ids(file_ids)
+
+    file_id = find_file(service, filename)
+    if file_id is not None:
+        file_ids[filename] = file_id
+        write_file_ids(file_ids)
+    return file_id
+
+
+def upload(request):
+    # Sends a resumable upload chunk by chunk. next_chunk() retries a
+    # chunk itself, and after an error it asks Drive how much arrived and
+    # continues from there, so a failure never restarts the transfer.
+    start = time.monotonic()
+    response = None
+    failures = 0
+    while response is None:
+        try:
+            status, response = request.next_chunk(num_retries=RETRIES)
+        except (HttpError, httplib2.HttpLib2Error, OSError) as e:
+            if isinstance(e, HttpError) and e.resp.status < 500 and e.resp.status != 429:
+                raise
+            failures += 1
+            metrics.inc('drive_upload_retries_total')
+            if failures > RETRIES:
+                raise
+            print("Upload interrupted (%s), resuming in %d seconds" % (e, 2 ** failures))
+            time.sleep(2 ** failures)
+            continue
+
+        failures = 0
+        metrics.inc('drive_upload_chunks_total')
+        if status is not None:
+            print("Uploaded %d%%" % int(status.progress() * 100))
+
+    metrics.observe('drive_upload_seconds', time.monotonic() - start)
+    return response
+
+
+def upload_workbook(path, filename):
+    # Uploads an xlsx file as the spreadsheet called filename
     service = connect()
 
     file_metadata = {
         'name': filename,
-        'mimeType': 'application/vnd.google-apps.spreadsheet'
+        'mimeType': SPREADSHEET_MIME
     }
 
-    media = MediaFileUpload('tmp.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    def media():
+        return MediaFileUpload(path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                               chunksize=CHUNK_SIZE, resumable=True)
 
+    file = None
     file_id = get_file_id(service, filename)
-
-    if file_id is None:
-        file = service.files().create(body=file_metadata,
-                                      media_body=media,
-                                      fields='id').execute()
-        print('File ID: %s' % file.get('id'))
-    else:
-        file = service.files().update(fileId=file_id,
-                                      body=file_metadata,
-                                      media_body=media,
-                                      fields='id').execute()
-        print('File ID: %s' % file.get('id'))
+    if file_id is not None:
+        try:
+            file = upload(service.files().update(fileId=file_id,
+                                                 body=file_metadata,
+                                                 media_body=media(),
+                                                 fields='id'))
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print('File %s not found, looking it up again' % file_id)
+            file_ids = read_file_ids()
+            file_ids.pop(filename, None)
+            write_file_ids(file_ids)
+
+            file_id = get_file_id(service, filename)
+            if file_id is not None:
+                file = upload(service.files().update(fileId=file_id,
+                                                     body=file_metadata,
+                                                     media_body=media(),
+                                                     fields='id'))
+
+    if file is None:
+        file = upload(service.files().create(body=file_metadata,
+                                             media_body=media(),
+                                             fields='id'))
+        file_ids = read_file_ids()
+        file_ids[filename] = file['id']
+        write_file_ids(file_ids)
+
+    print('File ID: %s' % file.get('id'))
+
+
+@profiler.traced('export_google_sheets.do_export')
+def do_export(issues, filename, milestones, cache=None, index=None, constant_memory=False, bd=None):
+    export_xlsx.do_export(issues, 'tmp.xlsx', milestones, cache, index, constant_memory, bd)
+    upload_workbook('tmp.xlsx', filename)
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+# Google Sheets export through the Sheets API v4. The Drive export uploads
+# a new workbook every time, which Google converts from scratch, dropping
+# the filters and views people set up. This one keeps the spreadsheet and
+# remembers which issue is on which row (sheets_state.json), so an export
+# only sends the rows that were added, changed or removed since the last
+# one. Rows keep their place, new rows are appended at the end of their
+# table.
+
+import datetime
+import hashlib
+import json
+import os
+
+import google.auth.credentials
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+import burndown
+import export_google_sheets
+import export_xlsx
+import issue_model
+import issue_store
+import metrics
+import profiler
+
+STATE_FILE = 'sheets_state.json'
+
+# Limits of a single batchUpdate call
+BATCH_REQUESTS = 500
+BATCH_ROWS = 5000
+
+ISSUE_SHEET = 'All issues'
+NEW_SHEET_ROWS = 1000
+
+# Header row of the burndown and issue tables on milestone sheets, below
+# the chart, as in export_xlsx
+FIRST_ROW = 24
+
+SERIAL_EPOCH = datetime.datetime(1899, 12, 30)
+DATE_FORMAT = {'type': 'DATE', 'pattern': 'd mmmm yyyy'}
+
+
+def connect(api_url=None):
+    # With api_url, requests go to that endpoint without credentials, for
+    # a local stand-in such as fake_sheets.py
+    if api_url is not None:
+        return build('sheets', 'v4', credentials=google.auth.credentials.AnonymousCredentials(),
+                     client_options={'api_endpoint': api_url})
+    return build('sheets', 'v4', credentials=export_google_sheets.get_credentials())
+
+
+def cell(value):
+    # A value as Sheets CellData. Dates are serial numbers, as Sheets and
+    # Excel store them, with a date format.
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, datetime.date):
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime.combine(value, datetime.time())
+        return {'userEnteredValue': {'numberValue': (value - SERIAL_EPOCH).total_seconds() / 86400},
+                'userEnteredFormat': {'numberFormat': DATE_FORMAT}}
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+
+def link(url, number):
+    return {'userEnteredValue': {'formulaValue': '=HYPERLINK("%s", %d)' % (url.replace('"', '""'), number)}}
+
+
+def fingerprint(cells):
+    return hashlib.sha1(json.dumps(cells, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def grid_range(sheet_id, start_row, end_row, start_column, end_column):
+    # end_row None is open-ended, so charts and filters grow with the table
+    result = {
+        'sheetId': sheet_id,
+        'startRowIndex': start_row,
+        'startColumnIndex': start_column,
+        'endColumnIndex': end_column
+    }
+    if end_row is not None:
+        result['endRowIndex'] = end_row
+    return result
+
+
+def runs(indexes):
+    # Sorted row indexes as (start, end) ranges of consecutive rows
+    result = []
+    for i in indexes:
+        if result and result[-1][1] == i:
+            result[-1][1] = i + 1
+        else:
+            result.append([i, i + 1])
+    return result
+
+
+class Table:
+    # Rows under a header row at (row, column), each with a key that stays
+    # the same as long as the row is about the same thing
+    def __init__(self, name, row, column, headers):
+        self.name = name
+        self.row = row
+        self.column = column
+        self.headers = headers
+        self.rows = {}
+
+    def add(self, key, values):
+        unique = key
+        n = 1
+        while unique in self.rows:
+            n += 1
+            unique = '%s#%d' % (key, n)
+        self.rows[unique] = [cell(v) for v in values]
+
+    def update_cells(self, sheet_id, start, rows, fields='userEnteredValue,userEnteredFormat.numberFormat'):
+        return {'updateCells': {
+            'start': {'sheetId': sheet_id, 'rowIndex': self.row + 1 + start, 'columnIndex': self.column},
+            'rows': [{'values': cells} for cells in rows],
+            'fields': fields
+        }}
+
+    def header(self, sheet_id):
+        bold = {'userEnteredFormat': {'textFormat': {'bold': True}}}
+        return self.update_cells(sheet_id, -1, [[dict(cell(h), **bold) for h in self.headers]],
+                                 'userEnteredValue,userEnteredFormat.textFormat.bold')
+
+    def delete_rows(self, sheet_id, start, end):
+        # Only the columns of the table move up, a table next to it stays
+        return {'deleteRange': {
+            'range': grid_range(sheet_id, self.row + 1 + start, self.row + 1 + end,
+                                self.column, self.column + len(self.headers)),
+            'shiftDimension': 'ROWS'
+        }}
+
+    def diff(self, old):
+        # old is the [key, fingerprint] list of the rows on the sheet. Rows
+        # whose key is gone are deleted, the others keep their order and
+        # new ones go at the end. Returns the deleted indexes in old, the
+        # indexes to write in the new list, and the new list.
+        fingerprints = {key: fingerprint(cells) for key, cells in self.rows.items()}
+        deleted = [i for i, (key, fp) in enumerate(old) if key not in fingerprints]
+        present = set(key for key, fp in old)
+
+        rows = [[key, fp] for key, fp in old if key in fingerprints]
+        rows.extend([key, None] for key in self.rows if key not in present)
+
+        written = []
+        for i, entry in enumerate(rows):
+            fp = fingerprints[entry[0]]
+            if entry[1] != fp:
+                entry[1] = fp
+                written.append(i)
+
+        return deleted, written, rows
+
+
+def column_widths(sheet_id, widths):
+    # widths in characters, as for XlsxWriter's set_column
+    return [{'updateDimensionProperties': {
+        'range': {'sheetId': sheet_id, 'dimension': 'COLUMNS', 'startIndex': first, 'endIndex': last + 1},
+        'properties': {'pixelSize': chars * 7 + 5},
+        'fields': 'pixelSize'
+    }} for first, last, chars in widths]
+
+
+def issue_table():
+    return Table('issues', 0, 0, export_xlsx.ISSUE_COLUMNS)
+
+
+def add_issues(table, orgname, reponame, repo_issues):
+    for number, issue in repo_issues.items():
+        if issue.is_pr:
+            continue
+
+        path = "%s/%s/issues/%s" % (orgname, reponame, number)
+        table.add(path, [
+            path,
+            orgname,
+            reponame,
+            issue.number,
+            issue.title.strip(),
+            issue.state,
+            issue_model.to_datetime(issue.created_at),
+            issue_model.to_datetime(issue.updated_at),
+            issue_model.to_datetime(issue.closed_at)
+        ])
+
+
+def issue_sheet(table):
+    def setup(sheet_id):
+        return column_widths(sheet_id, [(0, 0, 40), (1, 2, 12), (4, 4, 100), (6, 8, 17)]) + [
+            {'updateSheetProperties': {
+                'properties': {'sheetId': sheet_id, 'gridProperties': {'frozenRowCount': 1}},
+                'fields': 'gridProperties.frozenRowCount'
+            }},
+            {'setBasicFilter': {'filter': {'range': grid_range(sheet_id, 0, None, 0, len(table.headers))}}}
+        ]
+
+    return ISSUE_SHEET, [table], setup
+
+
+def milestone_sheet(milestone, entries):
+    # Keyed by position, so a series that grows only writes its new days
+    series = Table('series', FIRST_ROW, 0, ['date', 'weight'])
+    for i, (day, count) in enumerate(entries['days'].items()):
+        series.add(str(i), [day, count])
+
+    table = Table('issues', FIRST_ROW, 4, export_xlsx.MILESTONE_COLUMNS)
+    for issue in entries['issues']:
+        data = [issue.orgname, issue.reponame, issue.milestone, issue.number, issue.title,
+                issue.weight, issue.state, issue.source]
+        table.add("%s/%s/issues/%d" % (issue.orgname, issue.reponame, issue.number),
+                  data[:3] + [link(export_xlsx.issue_url(data), issue.number)] + data[4:7])
+
+    def setup(sheet_id):
+        chart = {
+            'spec': {'basicChart': {
+                'chartType': 'LINE',
+                'legendPosition': 'NO_LEGEND',
+                'headerCount': 1,
+                'axis': [{'position': 'BOTTOM_AXIS'}, {'position': 'LEFT_AXIS'}],
+                'domains': [{'domain': {'sourceRange': {
+                    'sources': [grid_range(sheet_id, FIRST_ROW, None, 0, 1)]}}}],
+                'series': [{'series': {'sourceRange': {
+                    'sources': [grid_range(sheet_id, FIRST_ROW, None, 1, 2)]}},
+                    'targetAxis': 'LEFT_AXIS'}]
+            }},
+            'position': {'overlayPosition': {
+                'anchorCell': {'sheetId': sheet_id, 'rowIndex': 0, 'columnIndex': 0},
+                'widthPixels': 1400,
+                'heightPixels': 420
+            }}
+        }
+        return column_widths(sheet_id, [(0, 0, 17), (1, 1, 10), (4, 5, 20), (6, 7, 12), (8, 8, 100), (9, 9, 10)]) + [
+            {'addChart': {'chart': chart}},
+            {'setBasicFilter': {'filter': {'range': grid_range(sheet_id, FIRST_ROW, None, 4, 4 + len(table.headers))}}}
+        ]
+
+    return milestone, [series, table], setup
+
+
+class SheetsState:
+    # Per spreadsheet name: its id and, per sheet and table, the key and
+    # fingerprint of every row in the order they are on the sheet.
+    # complete is false while changes are being sent, and a spreadsheet
+    # left that way has its tables rewritten in full.
+    VERSION = 1
+
+    def __init__(self, filename=STATE_FILE):
+        self.filename = filename
+
+        self.spreadsheets = {}
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                data = json.loads(f.read())
+            if data.get('version') == self.VERSION:
+                self.spreadsheets = data['spreadsheets']
+
+    def spreadsheet(self, name):
+        return self.spreadsheets.setdefault(name, {'spreadsheet_id': None, 'complete': True, 'sheets': {}})
+
+    def save(self):
+        issue_store.atomic_write(self.filename, json.dumps(
+            {'version': self.VERSION, 'spreadsheets': self.spreadsheets}, ensure_ascii=False))
+
+
+def open_spreadsheet(service, entry, filename):
+    # Returns the properties of every sheet by title, creating the
+    # spreadsheet if there is none yet or it was deleted
+    if entry['spreadsheet_id'] is not None:
+        try:
+            result = service.spreadsheets().get(
+                spreadsheetId=entry['spreadsheet_id'], fields='sheets.properties').execute()
+            return {s['properties']['title']: s['properties'] for s in result['sheets']}
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print("Spreadsheet %s not found, creating a new one" % entry['spreadsheet_id'])
+
+    result = service.spreadsheets().create(
+        body={'properties': {'title': filename},
+              'sheets': [{'properties': {'sheetId': 0, 'title': ISSUE_SHEET}}]},
+        fields='spreadsheetId,sheets.properties').execute()
+
+    entry.update({'spreadsheet_id': result['spreadsheetId'], 'complete': True, 'sheets': {}})
+    print('Spreadsheet ID: %s' % result['spreadsheetId'])
+    return {s['properties']['title']: s['properties'] for s in result['sheets']}
+
+
+def send(service, spreadsheet_id, requests):
+    # Requests are applied in order, split into calls that stay within
+    # the size limits. Returns the number of calls.
+    calls = 0
+    batch = []
+    rows = 0
+    for request in requests:
+        size = len(request.get('updateCells', {}).get('rows', ()))
+        if batch and (len(batch) >= BATCH_REQUESTS or rows + size > BATCH_ROWS):
+            service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': batch}).execute()
+            calls += 1
+            batch = []
+            rows = 0
+        batch.append(request)
+        rows += size
+
+    if batch:
+        service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': batch}).execute()
+        calls += 1
+
+    return calls
+
+
+def update_spreadsheet(filename, table, bd, api_url=None, state_file=STATE_FILE):
+    # Brings the spreadsheet called filename in line with the issue table
+    # and the burndown() result bd
+    service = connect(api_url)
+    state = SheetsState(state_file)
+    entry = state.spreadsheet(filename)
+    properties = open_spreadsheet(service, entry, filename)
+
+    sheets = [issue_sheet(table)]
+    for milestone, entries in bd.items():
+        sheets.append(milestone_sheet(milestone, entries))
+    titles = set(title for title, tables, setup in sheets)
+
+    requests = []
+    new_sheets = {}
+    for title in entry['sheets']:
+        if title not in titles and title in properties:
+            requests.append({'deleteSheet': {'sheetId': properties[title]['sheetId']}})
+            # Kept until the deletion went through
+            new_sheets[title] = {'tables': {}}
+
+    next_id = max([p['sheetId'] for p in properties.values()] + [0]) + 1
+    written = 0
+    removed = 0
+    for title, tables, setup in sheets:
+        old_tables = None
+        if title in properties:
+            sheet_id = properties[title]['sheetId']
+            row_count = properties[title]['gridProperties']['rowCount']
+            if title in entry['sheets']:
+                old_tables = entry['sheets'][title]['tables'] if entry['complete'] else {}
+        else:
+            sheet_id = next_id
+            next_id += 1
+            row_count = NEW_SHEET_ROWS
+            requests.append({'addSheet': {'properties': {
+                'sheetId': sheet_id, 'title': title, 'gridProperties': {'rowCount': row_count}}}})
+
+        if old_tables is None:
+            requests.extend(setup(sheet_id))
+            old_tables = {}
+
+        # All deletions on a sheet come first, so the row indexes of the
+        # writes after them are those of the new layout
+        deletes = []
+        writes = []
+        height = 0
+        table_state = {}
+        for table in tables:
+            old = old_tables.get(table.name)
+            if old is None:
+                # Whatever is below the header is unknown, so it is cleared
+                # and the table written in full
+                if row_count > table.row + 1:
+                    deletes.append(table.delete_rows(sheet_id, 0, row_count - table.row - 1))
+                writes.append(table.header(sheet_id))
+                old = []
+
+            deleted, rewritten, rows = table.diff(old)
+            for start, end in reversed(runs(deleted)):
+                deletes.append(table.delete_rows(sheet_id, start, end))
+            for start, end in runs(rewritten):
+                for chunk in range(start, end, BATCH_ROWS):
+                    writes.append(table.update_cells(
+                        sheet_id, chunk, [table.rows[key] for key, fp in rows[chunk:min(end, chunk + BATCH_ROWS)]]))
+
+            written += len(rewritten)
+            removed += len(deleted)
+            height = max(height, table.row + 1 + len(rows))
+            table_state[table.name] = rows
+
+        requests.extend(deletes)
+        if height > row_count:
+            requests.append({'appendDimension': {'sheetId': sheet_id, 'dimension': 'ROWS', 'length': height - row_count}})
+        requests.extend(writes)
+
+        new_sheets[title] = {'tables': table_state}
+
+    entry['sheets'] = new_sheets
+    entry['complete'] = False
+    state.save()
+
+    with metrics.timer('sheets_send_seconds'):
+        calls = send(service, entry['spreadsheet_id'], requests)
+    metrics.inc('sheets_api_calls_total', calls)
+    metrics.inc('sheets_rows_written_total', written)
+    metrics.inc('sheets_rows_removed_total', removed)
+
+    for title in list(new_sheets):
+        if title not in titles:
+            del new_sheets[title]
+    entry['complete'] = True
+    state.save()
+
+    print("Sheets: %d rows written, %d removed in %d requests" % (written, removed, calls))
+
+
+@profiler.traced('export_google_sheets_api.do_export')
+def do_export(issues, filename, milestones, cache=None, index=None, api_url=None, state_file=STATE_FILE,
+              bd=None):
+    table = issue_table()
+    for orgname, reponame, repo_issues in issue_model.iter_issues(issues, is_pr=False):
+        add_issues(table, orgname, reponame, repo_issues)
+
+    if bd is None:
+        bd = burndown.burndown(issues, milestones, cache, index)
+    update_spreadsheet(filename, table, bd, api_url, state_file)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Parquet export of the store as two tables, issues.parquet and
+# events.parquet, for loading into pandas or any Arrow reader. Columns are
+# typed, timestamps are UTC timestamps, and org, repo, state, milestone
+# and label columns are dictionary encoded. Rows are buffered up to a row
+# group and then written out, so memory doesn't grow with the store.
+
+import os
+
+import pyarrow
+import pyarrow.parquet
+
+import issue_model
+import profiler
+
+ROW_GROUP_SIZE = 65536
+COMPRESSION = 'zstd'
+
+STRING = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+TIMESTAMP = pyarrow.timestamp('s', tz='UTC')
+
+ISSUE_SCHEMA = pyarrow.schema([
+    ('orgname', STRING),
+    ('reponame', STRING),
+    ('number', pyarrow.int64()),
+    ('source', STRING),
+    ('title', pyarrow.string()),
+    ('state', STRING),
+    ('is_pr', pyarrow.bool_()),
+    ('labels', pyarrow.list_(STRING)),
+    ('milestone', STRING),
+    ('milestone_number', pyarrow.int64()),
+    ('weight', pyarrow.int64()),
+    ('created_at', TIMESTAMP),
+    ('updated_at', TIMESTAMP),
+    ('closed_at', TIMESTAMP),
+])
+
+EVENT_SCHEMA = pyarrow.schema([
+    ('orgname', STRING),
+    ('reponame', STRING),
+    ('number', pyarrow.int64()),
+    ('seq', pyarrow.int32()),
+    ('event', STRING),
+    ('created_at', TIMESTAMP),
+    ('milestone', STRING),
+    ('label', STRING),
+])
+
+
+class TableWriter:
+    # Rows of one table, kept as columns until there are enough of them
+    # for a row group
+    def __init__(self, filename, schema):
+        self.schema = schema
+        self.writer = pyarrow.parquet.ParquetWriter(filename, schema, compression=COMPRESSION)
+        self.columns = {name: [] for name in schema.names}
+        self.rows = 0
+
+    def append(self, row):
+        for name, value in zip(self.schema.names, row):
+            self.columns[name].append(value)
+        self.rows += 1
+        if self.rows >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.rows == 0:
+            return
+        self.writer.write_table(pyarrow.table(
+            [pyarrow.array(self.columns[field.name], type=field.type) for field in self.schema],
+            schema=self.schema))
+        for values in self.columns.values():
+            values.clear()
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class ParquetExport:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.issues = TableWriter(os.path.join(directory, 'issues.parquet'), ISSUE_SCHEMA)
+        self.events = TableWriter(os.path.join(directory, 'events.parquet'), EVENT_SCHEMA)
+
+    def add_issues(self, orgname, reponame, repo_issues):
+        for number, issue in repo_issues.items():
+            self.issues.append([
+                orgname,
+                reponame,
+                issue.number,
+                issue.source,
+                issue.title,
+                issue.state,
+                issue.is_pr,
+                issue.labels,
+                issue.milestone,
+                issue.milestone_number,
+                issue.weight,
+                issue.created_at,
+                issue.updated_at,
+                issue.closed_at
+            ])
+
+            for seq, event in enumerate(issue.events):
+                self.events.append([
+                    orgname,
+                    reponame,
+                    issue.number,
+                    seq,
+                    event.event,
+                    event.created_at,
+                    event.milestone,
+                    event.label
+                ])
+
+    def close(self):
+        self.issues.close()
+        self.events.close()
+
+
+@profiler.traced('export_parquet.do_export')
+def do_export(issues, directory):
+    export = ParquetExport(directory)
+    try:
+        for orgname, reponame, repo_issues in issue_model.iter_issues(issues):
+            export.add_issues(orgname, reponame, repo_issues)
+    finally:
+        export.close()
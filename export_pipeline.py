@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+# Runs several exports off a single read of the store. Repositories are
+# read once, turned into Issue objects once and handed to every sink, each
+# running in its own worker thread or process behind a bounded queue, so
+# the store is streamed however many sinks there are. Burndown is computed
+# once from the same pass and given to the sinks that need it when the
+# store has been read.
+#
+# A sink has a name, a kind labelling its metrics, raw (whether it takes
+# store records rather than Issue objects) and burndown (whether it needs
+# the burndown result), and
+# the methods open(), write(orgname, reponame, repo_issues) and close(bd),
+# all called in its worker.
+
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+import traceback
+
+import burndown
+import export_google_sheets
+import export_google_sheets_api
+import export_parquet
+import export_tsv
+import export_xlsx
+import issue_model
+import issue_store
+import metrics
+import profiler
+
+# Repositories waiting per sink before the reader waits for it
+QUEUE_SIZE = 16
+
+
+class TsvSink:
+    kind = 'tsv'
+    raw = True
+    burndown = False
+
+    def __init__(self, filename, orgname=None):
+        self.name = filename
+        self.filename = filename
+        self.orgname = orgname
+
+    def open(self):
+        self.export = export_tsv.TsvExport(self.filename)
+
+    def write(self, orgname, reponame, repo_issues):
+        if self.orgname is None or orgname == self.orgname:
+            self.export.add_issues(orgname, reponame, repo_issues)
+
+    def close(self, bd):
+        self.export.close()
+
+
+class XlsxSink:
+    kind = 'xlsx'
+    raw = False
+    burndown = True
+
+    def __init__(self, filename, constant_memory=False):
+        self.name = filename
+        self.filename = filename
+        self.constant_memory = constant_memory
+
+    def open(self):
+        self.export = export_xlsx.XlsxExport(self.filename, self.constant_memory)
+
+    def write(self, orgname, reponame, repo_issues):
+        self.export.add_issues(orgname, reponame, repo_issues)
+
+    def close(self, bd):
+        self.export.finish(bd)
+
+
+class ParquetSink:
+    kind = 'parquet'
+    raw = False
+    burndown = False
+
+    def __init__(self, directory):
+        self.name = directory
+        self.directory = directory
+
+    def open(self):
+        self.export = export_parquet.ParquetExport(self.directory)
+
+    def write(self, orgname, reponame, repo_issues):
+        self.export.add_issues(orgname, reponame, repo_issues)
+
+    def close(self, bd):
+        self.export.close()
+
+
+class GoogleSheetsSink(XlsxSink):
+    # Uploads the workbook to Drive, as export_google_sheets does
+    kind = 'google_sheets'
+
+    def __init__(self, sheet_name, constant_memory=False, path='tmp.xlsx'):
+        super().__init__(path, constant_memory)
+        self.name = sheet_name
+        self.sheet_name = sheet_name
+
+    def close(self, bd):
+        super().close(bd)
+        export_google_sheets.upload_workbook(self.filename, self.sheet_name)
+
+
+class SheetsApiSink:
+    kind = 'google_sheets_api'
+    raw = False
+    burndown = True
+
+    def __init__(self, sheet_name, api_url=None):
+        self.name = sheet_name
+        self.sheet_name = sheet_name
+        self.api_url = api_url
+
+    def open(self):
+        self.table = export_google_sheets_api.issue_table()
+
+    def write(self, orgname, reponame, repo_issues):
+        export_google_sheets_api.add_issues(self.table, orgname, reponame, repo_issues)
+
+    def close(self, bd):
+        export_google_sheets_api.update_spreadsheet(self.sheet_name, self.table, bd, self.api_url)
+
+
+def run_sink(sink, inbox):
+    # Returns whether the sink finished. A sink that fails keeps taking
+    # repositories off its queue, so the reader never waits for it. The
+    # profiler span covers the sink's own work, not waiting for the reader.
+    message = None
+    start = time.monotonic()
+    span = 'export_' + sink.kind
+    try:
+        with profiler.span(span):
+            sink.open()
+        while True:
+            message = inbox.get()
+            if message[0] == 'repo':
+                with profiler.span(span):
+                    sink.write(*message[1:])
+            elif message[0] == 'close':
+                close_start = time.monotonic()
+                with profiler.span(span):
+                    sink.close(message[1])
+                metrics.observe('export_close_seconds', time.monotonic() - close_start, sink=sink.kind)
+                metrics.observe('export_seconds', time.monotonic() - start, sink=sink.kind)
+                return True
+            else:
+                return False
+    except Exception:
+        metrics.inc('export_failures_total', sink=sink.kind)
+        print("Export to %s failed" % sink.name)
+        traceback.print_exc()
+        while message is None or message[0] == 'repo':
+            message = inbox.get()
+        return False
+
+
+def process_main(sink, inbox):
+    sys.exit(0 if run_sink(sink, inbox) else 1)
+
+
+@profiler.traced('export_pipeline.run')
+def run(issues, sinks, milestones, cache=None, index=None, processes=False):
+    # Returns the burndown() result, or None if no sink needed it
+    if index is None:
+        index = burndown.MilestoneIndex(milestones)
+
+    failed = []
+    workers = []
+    inboxes = []
+    for sink in sinks:
+        if processes:
+            inbox = multiprocessing.Queue(QUEUE_SIZE)
+            worker = multiprocessing.Process(target=process_main, args=(sink, inbox), daemon=True)
+        else:
+            inbox = queue.Queue(QUEUE_SIZE)
+            worker = threading.Thread(
+                target=lambda sink=sink, inbox=inbox: run_sink(sink, inbox) or failed.append(sink.name),
+                daemon=True)
+        worker.start()
+        workers.append(worker)
+        inboxes.append(inbox)
+
+    need_issues = any(not sink.raw for sink in sinks)
+    need_burndown = any(sink.burndown for sink in sinks)
+
+    start = time.monotonic()
+    try:
+        # Only the issues burndown looks at are kept until the end
+        milestoned = []
+        for orgname, reponame, records in issue_store.iter_repos(issues):
+            metrics.inc('export_repos_total')
+            repo_issues = None
+            if need_issues or (need_burndown and reponame in index.reponames):
+                repo_issues = {number: issue_model.Issue(orgname, reponame, number, record)
+                               for number, record in records.items()}
+
+            for sink, inbox in zip(sinks, inboxes):
+                inbox.put(('repo', orgname, reponame, records if sink.raw else repo_issues))
+
+            if need_burndown and reponame in index.reponames:
+                milestoned.append((orgname, reponame, {
+                    number: issue for number, issue in repo_issues.items()
+                    if not issue.is_pr and issue_store.milestoned(records[number])}))
+
+        metrics.observe('export_read_seconds', time.monotonic() - start)
+
+        bd = None
+        if need_burndown:
+            bd = burndown.burndown_repos(milestoned, index, cache)
+    except BaseException:
+        for inbox in inboxes:
+            inbox.put(('abort',))
+        raise
+
+    for inbox in inboxes:
+        inbox.put(('close', bd))
+    for worker in workers:
+        worker.join()
+
+    if processes:
+        failed = [sink.name for sink, worker in zip(sinks, workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError('Export to %s failed' % ', '.join(failed))
+
+    return bd
@@ -2,30 +2,49 @@
 
 import csv
 
+import issue_store
+import profiler
+
+
+class TsvExport:
+    def __init__(self, filename):
+        self.fd = open(filename, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.fd, delimiter="\t",
+                                 quotechar='|', quoting=csv.QUOTE_MINIMAL)
+
+        self.writer.writerow(['path', 'orgname', 'reponame', 'id', 'title', 'state', 'created_at', 'updated_at', 'closed_at'])
+
+    def add_issues(self, orgname, reponame, repo_issues):
+        # repo_issues are records as in the store
+        for number, issue in repo_issues.items():
+            if issue['is_pr']:
+                continue
+
+            try:
+                self.writer.writerow(
+                    [
+                        "%s/%s/issues/%s" % (orgname, reponame, number),
+                        orgname,
+                        reponame,
+                        number,
+                        issue['title'].strip(),
+                        issue['state'],
+                        issue['created_at'],
+                        issue['updated_at'],
+                        issue['closed_at']
+                    ])
+            except:
+                print(issue)
+
+    def close(self):
+        self.fd.close()
+
+
+@profiler.traced('export_tsv.do_export')
 def do_export(issues, filename, orgname):
-    with open(filename, 'w', newline='', encoding='utf-8') as fd:
-        writer = csv.writer(fd, delimiter="\t",
-                            quotechar='|', quoting=csv.QUOTE_MINIMAL)
-
-        writer.writerow(['path', 'orgname', 'reponame', 'id', 'title', 'state', 'created_at', 'updated_at', 'closed_at'])
-        if orgname in issues:
-            for reponame, repo_issues in issues[orgname].items():
-                for number, issue in repo_issues.items():
-                    if issue['is_pr']:
-                        continue
-
-                    try:
-                        writer.writerow(
-                            [
-                                "%s/%s/issues/%s" % (orgname, reponame, number),
-                                orgname,
-                                reponame,
-                                number,
-                                issue['title'].strip(),
-                                issue['state'],
-                                issue['created_at'],
-                                issue['updated_at'],
-                                issue['closed_at']
-                            ])
-                    except:
-                        print(issue)
+    export = TsvExport(filename)
+    try:
+        for orgname, reponame, repo_issues in issue_store.iter_repos(issues, orgname, is_pr=False):
+            export.add_issues(orgname, reponame, repo_issues)
+    finally:
+        export.close()
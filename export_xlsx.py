@@ -4,162 +4,232 @@ import xlsxwriter
 import datetime
 import collections
 import burndown
-
-def do_export(issues, filename, milestone_filter):
-    workbook = xlsxwriter.Workbook(filename)
-    issue_sheet = workbook.add_worksheet("All issues")
-
-    issue_sheet.write_row(
-        'A1',
-        ['path', 'orgname', 'reponame', 'id', 'title', 'state', 'created_at', 'updated_at', 'closed_at'])
-
-    date_format = workbook.add_format()
-    date_format.set_num_format('d mmmm yyyy')
-
-    wrap_format = workbook.add_format({'text_wrap': 1})
-
-    issue_data = []
-    event_data = []
-
-    issue_sheet.set_column('A:A', 40)
-    issue_sheet.set_column('B:C', 12)
-
-    issue_sheet.set_column('E:E', 100)
-    issue_sheet.set_column('G:I', 17)
-
-    milestones = collections.defaultdict(list)
-
-    for orgname, org_repos in issues.items():
-        for reponame, repo_issues in org_repos.items():
-            for number, issue in repo_issues.items():
-                if issue['is_pr']:
-                    continue
-
-                closed_at = None
-
-                if issue['closed_at'] is not None:
-                    closed_at = datetime.datetime.strptime(issue['closed_at'], "%Y-%m-%dT%H:%M:%SZ")
-
-                issue_row = [
-                    "%s/%s/issues/%s" % (orgname, reponame, number),
-                    orgname,
-                    reponame,
-                    int(number),
-                    issue['title'].strip(),
-                    issue['state'],
-                    datetime.datetime.strptime(issue['created_at'], "%Y-%m-%dT%H:%M:%SZ"),
-                    datetime.datetime.strptime(issue['updated_at'], "%Y-%m-%dT%H:%M:%SZ"),
-                    closed_at
+import issue_model
+import profiler
+
+ISSUE_COLUMNS = ['path', 'orgname', 'reponame', 'id', 'title', 'state', 'created_at', 'updated_at', 'closed_at']
+MILESTONE_COLUMNS = ['orgname', 'reponame', 'milestone', 'number', 'title', 'weight', 'state']
+
+
+def issue_url(data):
+    baseurl = "https://github.com"
+    if data[7] is not None:
+        baseurl = data[7]
+        # GitHub records name their source without a scheme
+        if '://' not in baseurl:
+            baseurl = 'https://' + baseurl
+    return "%s/%s/%s/issues/%d" % (baseurl, data[0], data[1], data[3])
+
+
+def write_milestone_rows(sheet, first_row, event_data, milestone_data,
+                         header_format, date_format, url_format):
+    # The date/weight and issue lists sit side by side, so in
+    # constant_memory mode they are written together, one row at a time
+    sheet.write_row(first_row - 1, 0, ['date', 'weight'], header_format)
+    sheet.write_row(first_row - 1, 4, MILESTONE_COLUMNS, header_format)
+
+    for i in range(max(len(event_data), len(milestone_data))):
+        row = first_row + i
+
+        if i < len(event_data):
+            day, count = event_data[i]
+            sheet.write_datetime(row, 0, day, date_format)
+            sheet.write_number(row, 1, count)
+
+        if i < len(milestone_data):
+            data = milestone_data[i]
+            sheet.write_row(row, 4, data[:7])
+            sheet.write_url(row, 7, issue_url(data), string=str(data[3]))
+            sheet.write_number(row, 7, data[3], url_format)
+
+    sheet.autofilter(first_row - 1, 4, first_row - 1 + max(len(milestone_data), 1),
+                     4 + len(MILESTONE_COLUMNS) - 1)
+
+
+class XlsxExport:
+    # The workbook of do_export(), filled in as repositories come in, with
+    # the milestone sheets added by finish() once burndown is known.
+    #
+    # With constant_memory, XlsxWriter flushes every row to disk as soon as
+    # the next one is started, so memory stays flat however many issues
+    # there are. Rows then have to be written strictly in order and tables
+    # aren't available, so headers get an autofilter instead.
+    def __init__(self, filename, constant_memory=False):
+        self.constant_memory = constant_memory
+        self.workbook = xlsxwriter.Workbook(filename, {'constant_memory': constant_memory})
+        self.issue_sheet = self.workbook.add_worksheet("All issues")
+
+        self.header_format = None
+        if constant_memory:
+            self.header_format = self.workbook.add_format({'bold': True})
+
+        self.issue_sheet.write_row('A1', ISSUE_COLUMNS, self.header_format)
+
+        self.date_format = self.workbook.add_format()
+        self.date_format.set_num_format('d mmmm yyyy')
+
+        self.issue_sheet.set_column('A:A', 40)
+        self.issue_sheet.set_column('B:C', 12)
+
+        self.issue_sheet.set_column('E:E', 100)
+        self.issue_sheet.set_column('G:I', 17)
+
+        # Rows are written as the repositories stream in, and the table is
+        # declared over them afterwards, so no repository is kept around
+        self.row = 0
+
+    def add_issues(self, orgname, reponame, repo_issues):
+        issue_sheet = self.issue_sheet
+        date_format = self.date_format
+
+        for number, issue in repo_issues.items():
+            if issue.is_pr:
+                continue
+
+            self.row += 1
+            row = self.row
+            issue_sheet.write_row(row, 0, [
+                "%s/%s/issues/%s" % (orgname, reponame, number),
+                orgname,
+                reponame,
+                issue.number,
+                issue.title.strip(),
+                issue.state
+            ])
+            issue_sheet.write_datetime(row, 6, issue_model.to_datetime(issue.created_at), date_format)
+            issue_sheet.write_datetime(row, 7, issue_model.to_datetime(issue.updated_at), date_format)
+            if issue.closed_at is not None:
+                issue_sheet.write_datetime(row, 8, issue_model.to_datetime(issue.closed_at), date_format)
+            else:
+                issue_sheet.write_blank(row, 8, None, date_format)
+
+    def finish(self, bd):
+        workbook = self.workbook
+        issue_sheet = self.issue_sheet
+        date_format = self.date_format
+        header_format = self.header_format
+        constant_memory = self.constant_memory
+        row = self.row
+
+        if constant_memory:
+            issue_sheet.autofilter(0, 0, max(row, 1), len(ISSUE_COLUMNS) - 1)
+        else:
+            issue_sheet.add_table(
+                'A1:I%d'%max(row + 1, 2),
+                {'columns':
+                 [{'header': 'path'},
+                  {'header': 'orgname'},
+                  {'header': 'reponame'},
+                  {'header': 'id'},
+                  {'header': 'title'},
+                  {'header': 'state'},
+                  {'header': 'created_at', 'format': date_format},
+                  {'header': 'updated_at', 'format': date_format},
+                  {'header': 'closed_at', 'format': date_format}]})
+        issue_sheet.freeze_panes(1, 0)
+
+        for milestone, entries in bd.items():
+            milestone_sheet = workbook.add_worksheet(milestone)
+
+            milestone_sheet.set_column('A:A', 17)
+            milestone_sheet.set_column('B:B', 10)
+
+            milestone_sheet.set_column('E:E', 20)
+            milestone_sheet.set_column('F:F', 20)
+            milestone_sheet.set_column('G:H', 12)
+            milestone_sheet.set_column('I:I', 100)
+            milestone_sheet.set_column('J:J', 10)
+
+            milestone_data = []
+            event_data = []
+
+            for day, count in entries['days'].items():
+                event_row = [
+                    day,
+                    count
                 ]
-                issue_data.append(issue_row)
-
-    issue_sheet.add_table(
-        'A1:I%d'%len(issue_data),
-        {'data': issue_data,
-         'columns':
-         [{'header': 'path'},
-          {'header': 'orgname'},
-          {'header': 'reponame'},
-          {'header': 'id'},
-          {'header': 'title'},
-          {'header': 'state'},
-          {'header': 'created_at', 'format': date_format},
-          {'header': 'updated_at', 'format': date_format},
-          {'header': 'closed_at', 'format': date_format}]})
-    issue_sheet.freeze_panes(1, 0)
-
-    bd = burndown.burndown(issues, milestone_filter)
-
-    for milestone, entries in bd.items():
-        milestone_sheet = workbook.add_worksheet(milestone)
-
-        milestone_sheet.set_column('A:A', 17)
-        milestone_sheet.set_column('B:B', 10)
-
-        milestone_sheet.set_column('E:E', 20)
-        milestone_sheet.set_column('F:F', 20)
-        milestone_sheet.set_column('G:H', 12)
-        milestone_sheet.set_column('I:I', 100)
-        milestone_sheet.set_column('J:J', 10)
-
-        milestone_data = []
-        event_data = []
-
-        for day, count in entries['days'].items():
-            event_row = [
-                day,
-                count
-            ]
-            event_data.append(event_row)
-
-        for issue in entries['issues']:
-            row = [
-                issue['orgname'],
-                issue['reponame'],
-                issue['milestone'],
-                int(issue['number']),
-                issue['title'],
-                issue['weight'],
-                issue['state'],
-                issue.get('source', None)
-            ]
-            milestone_data.append(row)
-
-        first_row = 25
-
-        chart = workbook.add_chart({'type': 'line'})
-
-
-        milestone_sheet.add_table(
-            'A%d:B%d'%(first_row, len(event_data)+first_row),
-            {'data': event_data,
-             'columns':
-             [{'header': 'date', 'format': date_format},
-              {'header': 'weight'}
-              ]})
-
-        milestone_sheet.add_table(
-            'E%d:K%d'%(first_row, len(milestone_data)+first_row),
-            {'data': milestone_data,
-             'columns':
-             [{'header': 'orgname'},
-              {'header': 'reponame'},
-              {'header': 'milestone'},
-              {'header': 'number'},
-              {'header': 'title'},
-              {'header': 'weight'},
-              {'header': 'state'},
-              ]})
-
-
-        url_format = workbook.get_default_url_format()
-        for i, data in enumerate(milestone_data):
-            baseurl = "https://github.com"
-            if data[7] is not None:
-                baseurl = data[7]
-            url = "%s/%s/%s/issues/%d" % (baseurl, data[0], data[1], data[3])
-            milestone_sheet.write_url('H%d' % (first_row + i+1,), url, string=str(data[3]))
-            milestone_sheet.write_number('H%d' % (first_row + i+1,), data[3], url_format)
-
-        #milestone_sheet.freeze_panes(1, 0)
-
-        chart.set_title({'name': ''})
-        chart.add_series(
-            {
-                'categories': '=\'%s\'!$A$%d:$A$%d'%(milestone, first_row, len(event_data)+first_row),
-                'values': '=\'%s\'!$B$%d:$B$%d'%(milestone, first_row, len(event_data)+first_row)
+                event_data.append(event_row)
+
+            for issue in entries['issues']:
+                row = [
+                    issue.orgname,
+                    issue.reponame,
+                    issue.milestone,
+                    issue.number,
+                    issue.title,
+                    issue.weight,
+                    issue.state,
+                    issue.source
+                ]
+                milestone_data.append(row)
+
+            first_row = 25
+
+            chart = workbook.add_chart({'type': 'line'})
+
+
+            url_format = workbook.get_default_url_format()
+
+            if constant_memory:
+                write_milestone_rows(milestone_sheet, first_row, event_data, milestone_data,
+                                     header_format, date_format, url_format)
+            else:
+                milestone_sheet.add_table(
+                    'A%d:B%d'%(first_row, len(event_data)+first_row),
+                    {'data': event_data,
+                     'columns':
+                     [{'header': 'date', 'format': date_format},
+                      {'header': 'weight'}
+                      ]})
+
+                milestone_sheet.add_table(
+                    'E%d:K%d'%(first_row, len(milestone_data)+first_row),
+                    {'data': milestone_data,
+                     'columns':
+                     [{'header': 'orgname'},
+                      {'header': 'reponame'},
+                      {'header': 'milestone'},
+                      {'header': 'number'},
+                      {'header': 'title'},
+                      {'header': 'weight'},
+                      {'header': 'state'},
+                      ]})
+
+                for i, data in enumerate(milestone_data):
+                    milestone_sheet.write_url('H%d' % (first_row + i+1,), issue_url(data), string=str(data[3]))
+                    milestone_sheet.write_number('H%d' % (first_row + i+1,), data[3], url_format)
+
+            #milestone_sheet.freeze_panes(1, 0)
+
+            chart.set_title({'name': ''})
+            chart.add_series(
+                {
+                    'categories': '=\'%s\'!$A$%d:$A$%d'%(milestone, first_row, len(event_data)+first_row),
+                    'values': '=\'%s\'!$B$%d:$B$%d'%(milestone, first_row, len(event_data)+first_row)
+                })
+
+            chart.set_x_axis({
+                'date_axis': True
+            })
+            chart.set_y_axis({
+                'date_axis': False,
+                'num_format': '0'
             })
 
-        chart.set_x_axis({
-            'date_axis': True
-        })
-        chart.set_y_axis({
-            'date_axis': False,
-            'num_format': '0'
-        })
+            chart.set_size({'width': 1400, 'height': 420})
+
+            milestone_sheet.insert_chart('A1', chart)
+
+        workbook.close()
 
-        chart.set_size({'width': 1400, 'height': 420})
 
-        milestone_sheet.insert_chart('A1', chart)
+@profiler.traced('export_xlsx.do_export')
+def do_export(issues, filename, milestone_filter, cache=None, index=None, constant_memory=False, bd=None):
+    # bd is the burndown() result, when the caller has it already
+    export = XlsxExport(filename, constant_memory)
+    for orgname, reponame, repo_issues in issue_model.iter_issues(issues, is_pr=False):
+        export.add_issues(orgname, reponame, repo_issues)
 
-    workbook.close()
+    if bd is None:
+        bd = burndown.burndown(issues, milestone_filter, cache, index)
+    export.finish(bd)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the parts of the GitHub and GitLab REST APIs the
+# importers use, serving a generated organization. It lets the import
+# engines run and be measured offline:
+#
+#   ./fake_api.py --port 8080 --repos 20 --issues 500
+#
+# and then in github-google-sheets.ini:
+#
+#   sync_engine=async
+#   github_api_url=http://127.0.0.1:8080
+#   gitlab_url=http://127.0.0.1:8080
+#
+# With --rate-limit N it allows N requests per --window seconds and then
+# answers like the real APIs do when the quota is gone: 403 with
+# X-RateLimit-Remaining: 0 on GitHub paths, 429 with Retry-After on
+# GitLab ones.
+
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+EPOCH = datetime.datetime(2018, 1, 1)
+
+
+def timestamp(seconds, millis=False):
+    tm = EPOCH + datetime.timedelta(seconds=seconds)
+    if millis:
+        return tm.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    return tm.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def generate(orgname='org', repos=10, issues=100, events=6, seed=1):
+    rnd = random.Random(seed)
+    milestones = ['1.%d' % i for i in range(10)]
+    labels = ['bug', 'feature', '1sp', '2sp', '3sp', '5sp']
+
+    data = []
+    event_id = 1
+    for r in range(repos):
+        repo = {'id': r + 1, 'name': 'repo%d' % r, 'issues': []}
+        for n in range(1, issues + 1):
+            created = rnd.randint(0, 3 * 365 * 86400)
+            history = []
+            t = created
+            for e in range(rnd.randint(0, events)):
+                t += rnd.randint(60, 30 * 86400)
+                kind = rnd.choice(['milestoned', 'demilestoned', 'labeled', 'unlabeled', 'closed'])
+                history.append({
+                    'id': event_id,
+                    'event': kind,
+                    'created_at': t,
+                    'milestone': rnd.choice(milestones),
+                    'label': rnd.choice(labels)
+                })
+                event_id += 1
+            closed = None
+            if rnd.random() < 0.6:
+                closed = t + rnd.randint(60, 86400)
+            repo['issues'].append({
+                'number': n,
+                'title': 'Issue %d of repo%d' % (n, r),
+                'created_at': created,
+                'updated_at': max(t, closed or 0) + 1,
+                'closed_at': closed,
+                'is_pr': rnd.random() < 0.2,
+                'labels': rnd.sample(labels, rnd.randint(0, 2)),
+                'milestone': rnd.choice(milestones + [None]),
+                'events': history
+            })
+        repo['issues'].sort(key=lambda i: i['updated_at'])
+        data.append(repo)
+
+    return {'org': orgname, 'repos': data}
+
+
+def github_issue(issue):
+    result = {
+        'number': issue['number'],
+        'title': issue['title'],
+        'state': 'closed' if issue['closed_at'] is not None else 'open',
+        'created_at': timestamp(issue['created_at']),
+        'updated_at': timestamp(issue['updated_at']),
+        'closed_at': timestamp(issue['closed_at']) if issue['closed_at'] is not None else None,
+        'labels': [{'name': l} for l in issue['labels']],
+        'milestone': None
+    }
+    if issue['milestone'] is not None:
+        result['milestone'] = {'title': issue['milestone'], 'number': int(issue['milestone'][2:]) + 1}
+    if issue['is_pr']:
+        result['pull_request'] = {}
+    return result
+
+
+def github_event(event):
+    return {
+        'id': event['id'],
+        'event': event['event'],
+        'created_at': timestamp(event['created_at']),
+        'milestone': {'title': event['milestone']} if 'milestone' in event['event'] else None,
+        'label': {'name': event['label']} if 'label' in event['event'] else None
+    }
+
+
+def gitlab_issue(issue):
+    return {
+        'iid': issue['number'],
+        'title': issue['title'],
+        'state': 'closed' if issue['closed_at'] is not None else 'opened',
+        'created_at': timestamp(issue['created_at'], True),
+        'updated_at': timestamp(issue['updated_at'], True),
+        'closed_at': timestamp(issue['closed_at'], True) if issue['closed_at'] is not None else None,
+        'labels': issue['labels'],
+        'milestone': {'title': issue['milestone'], 'iid': int(issue['milestone'][2:]) + 1}
+        if issue['milestone'] is not None else None,
+        'weight': None
+    }
+
+
+def gitlab_event(event):
+    return {
+        'id': event['id'],
+        'action': 'add' if event['event'] == 'milestoned' else 'remove',
+        'created_at': timestamp(event['created_at'], True),
+        'milestone': {'title': event['milestone']}
+    }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.lock:
+            server.requests += 1
+            now = time.time()
+            if now >= server.reset:
+                server.reset = int(now) + server.window
+                server.used = 0
+            server.used += 1
+            self.reset = server.reset
+            self.remaining = max(server.rate_limit - server.used, 0)
+            limited = server.used > server.rate_limit
+
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        if limited:
+            with server.lock:
+                server.limited += 1
+            if url.path.startswith('/api/v4/'):
+                self.respond(429, {'message': '429 Too Many Requests'},
+                             {'Retry-After': str(max(int(self.reset - time.time()), 1))})
+            else:
+                self.respond(403, {'message': 'API rate limit exceeded'})
+            return
+
+        for pattern, handler in ROUTES:
+            match = re.match(pattern + '$', url.path)
+            if match:
+                items = handler(server.data, query, *match.groups())
+                break
+        else:
+            self.respond(404, {'message': 'Not Found'})
+            return
+
+        if items is None:
+            self.respond(404, {'message': 'Not Found'})
+            return
+
+        if isinstance(items, dict):
+            self.respond(200, items)
+        else:
+            self.respond_page(url, query, items)
+
+    def respond_page(self, url, query, items):
+        per_page = int(query.get('per_page', 30))
+        page = int(query.get('page', 1))
+        body = items[(page - 1) * per_page:page * per_page]
+
+        headers = {}
+        if page * per_page < len(items):
+            query['page'] = str(page + 1)
+            next_url = 'http://%s%s?%s' % (self.headers['Host'], url.path, urllib.parse.urlencode(query))
+            headers['Link'] = '<%s>; rel="next"' % next_url
+
+        self.respond(200, body, headers)
+
+    def respond(self, status, body, headers={}):
+        data = json.dumps(body).encode('utf-8')
+        etag = 'W/"%s"' % hashlib.sha1(data).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status = 304
+            data = b''
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('X-RateLimit-Limit', str(self.server.rate_limit))
+        self.send_header('X-RateLimit-Remaining', str(self.remaining))
+        self.send_header('X-RateLimit-Reset', str(self.reset))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def find_repo(data, orgname, name):
+    if orgname != data['org']:
+        return None
+    for repo in data['repos']:
+        if repo['name'] == name or str(repo['id']) == name:
+            return repo
+    return None
+
+
+def find_issue(repo, number):
+    if repo is None:
+        return None
+    for issue in repo['issues']:
+        if issue['number'] == int(number):
+            return issue
+    return None
+
+
+def github_repos(data, query, orgname):
+    if orgname != data['org']:
+        return None
+    return [{'name': r['name'], 'full_name': '%s/%s' % (orgname, r['name'])} for r in data['repos']]
+
+
+def github_issues(data, query, orgname, name):
+    repo = find_repo(data, orgname, name)
+    if repo is None:
+        return None
+    since = query.get('since', '1970-01-01T00:00:00Z')
+    return [github_issue(i) for i in repo['issues'] if timestamp(i['updated_at']) >= since]
+
+
+def github_events(data, query, orgname, name, number):
+    issue = find_issue(find_repo(data, orgname, name), number)
+    if issue is None:
+        return None
+    return [github_event(e) for e in issue['events']]
+
+
+def gitlab_projects(data, query, orgname):
+    orgname = urllib.parse.unquote(orgname)
+    if orgname != data['org']:
+        return None
+    return [{'id': r['id'], 'path_with_namespace': '%s/%s' % (orgname, r['name'])} for r in data['repos']]
+
+
+def gitlab_issues(data, query, project_id):
+    repo = find_repo(data, data['org'], project_id)
+    if repo is None:
+        return None
+    since = query.get('updated_after', '1970-01-01T00:00:00Z')[:19]
+    return [gitlab_issue(i) for i in repo['issues']
+            if timestamp(i['updated_at'])[:19] >= since and not i['is_pr']]
+
+
+def gitlab_single_issue(data, query, project_id, iid):
+    issue = find_issue(find_repo(data, data['org'], project_id), iid)
+    if issue is None or issue['is_pr']:
+        return None
+    return gitlab_issue(issue)
+
+
+def gitlab_events(data, query, project_id, iid):
+    issue = find_issue(find_repo(data, data['org'], project_id), iid)
+    if issue is None:
+        return None
+    return [gitlab_event(e) for e in issue['events'] if 'milestone' in e['event']]
+
+
+ROUTES = [
+    (r'/orgs/([^/]+)/repos', github_repos),
+    (r'/repos/([^/]+)/([^/]+)/issues', github_issues),
+    (r'/repos/([^/]+)/([^/]+)/issues/(\d+)/events', github_events),
+    (r'/api/v4/groups/([^/]+)/projects', gitlab_projects),
+    (r'/api/v4/projects/(\d+)/issues', gitlab_issues),
+    (r'/api/v4/projects/(\d+)/issues/(\d+)', gitlab_single_issue),
+    (r'/api/v4/projects/(\d+)/issues/(\d+)/resource_milestone_events', gitlab_events),
+]
+
+
+def serve(data, port=0, latency=0, rate_limit=1000000, window=3600):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.data = data
+    server.latency = latency
+    server.rate_limit = rate_limit
+    server.window = window
+    server.lock = threading.Lock()
+    server.requests = 0
+    # Requests in the current rate limit window, and those refused
+    server.used = 0
+    server.reset = 0
+    server.limited = 0
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--org', default='org')
+    parser.add_argument('--repos', type=int, default=10)
+    parser.add_argument('--issues', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds added to every response')
+    parser.add_argument('--rate-limit', type=int, default=1000000,
+                        help='requests allowed per window')
+    parser.add_argument('--window', type=int, default=3600,
+                        help='length of the rate limit window in seconds')
+    args = parser.parse_args()
+
+    server = serve(generate(args.org, args.repos, args.issues), args.port, args.latency,
+                   args.rate_limit, args.window)
+    print("Serving %s on http://127.0.0.1:%d" % (args.org, server.server_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the parts of the Google Sheets API v4 the Sheets API
+# export uses, keeping spreadsheets in memory. It follows the real API
+# where the export depends on it: requests of a batchUpdate apply in
+# order, deleteRange shifts only the cells of its columns, and writes
+# outside the grid are rejected.
+#
+#   ./fake_sheets.py --port 8090
+#
+# and then in github-google-sheets.ini:
+#
+#   google_sheets_export=api
+#   google_sheets_api_url=http://127.0.0.1:8090
+
+import argparse
+import copy
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Spreadsheet:
+    def __init__(self, spreadsheet_id, body):
+        self.spreadsheet_id = spreadsheet_id
+        self.properties = dict(body.get('properties', {}))
+        self.sheets = []
+        self.charts = 0
+        for sheet in body.get('sheets', [{'properties': {'title': 'Sheet1'}}]):
+            self.add_sheet(sheet.get('properties', {}))
+
+    def add_sheet(self, properties):
+        properties = json.loads(json.dumps(properties))
+        properties.setdefault('sheetId', max([s['properties']['sheetId'] for s in self.sheets] + [-1]) + 1)
+        properties.setdefault('title', 'Sheet%d' % (len(self.sheets) + 1))
+        properties.setdefault('index', len(self.sheets))
+        grid = properties.setdefault('gridProperties', {})
+        grid.setdefault('rowCount', 1000)
+        grid.setdefault('columnCount', 26)
+
+        for sheet in self.sheets:
+            if sheet['properties']['sheetId'] == properties['sheetId'] or \
+               sheet['properties']['title'] == properties['title']:
+                raise BadRequest('A sheet with this id or title already exists: %s' % properties['title'])
+
+        self.sheets.append({'properties': properties, 'cells': {}, 'charts': [], 'basicFilter': None})
+        return properties
+
+    def sheet(self, sheet_id):
+        for sheet in self.sheets:
+            if sheet['properties']['sheetId'] == sheet_id:
+                return sheet
+        raise BadRequest('No sheet with id %s' % sheet_id)
+
+    def resource(self):
+        return {
+            'spreadsheetId': self.spreadsheet_id,
+            'properties': self.properties,
+            'sheets': [{'properties': s['properties']} for s in self.sheets]
+        }
+
+    def apply(self, request):
+        (kind, body), = request.items()
+        handler = getattr(self, 'do_' + kind, None)
+        if handler is None:
+            raise BadRequest('Unsupported request %s' % kind)
+        return handler(body)
+
+    def do_addSheet(self, body):
+        return {'addSheet': {'properties': self.add_sheet(body['properties'])}}
+
+    def do_deleteSheet(self, body):
+        self.sheets.remove(self.sheet(body['sheetId']))
+
+    def do_updateSheetProperties(self, body):
+        properties = self.sheet(body['properties']['sheetId'])['properties']
+        for field in body['fields'].split(','):
+            source = body['properties']
+            target = properties
+            path = field.split('.')
+            for name in path[:-1]:
+                source = source.get(name, {})
+                target = target.setdefault(name, {})
+            target[path[-1]] = source.get(path[-1])
+
+    def do_updateDimensionProperties(self, body):
+        self.sheet(body['range']['sheetId'])
+
+    def do_setBasicFilter(self, body):
+        self.sheet(body['filter']['range']['sheetId'])['basicFilter'] = body['filter']
+
+    def do_addChart(self, body):
+        sheet = self.sheet(body['chart']['position']['overlayPosition']['anchorCell']['sheetId'])
+        self.charts += 1
+        chart = dict(body['chart'], chartId=self.charts)
+        sheet['charts'].append(chart)
+        return {'addChart': {'chart': chart}}
+
+    def do_appendDimension(self, body):
+        grid = self.sheet(body['sheetId'])['properties']['gridProperties']
+        if body['dimension'] == 'ROWS':
+            grid['rowCount'] += body['length']
+        else:
+            grid['columnCount'] += body['length']
+
+    def do_deleteRange(self, body):
+        r = body['range']
+        sheet = self.sheet(r['sheetId'])
+        grid = sheet['properties']['gridProperties']
+        start_row = r.get('startRowIndex', 0)
+        end_row = r.get('endRowIndex', grid['rowCount'])
+        columns = range(r.get('startColumnIndex', 0), r.get('endColumnIndex', grid['columnCount']))
+        if body['shiftDimension'] != 'ROWS':
+            raise BadRequest('Only ROWS shifts are supported')
+
+        cells = sheet['cells']
+        count = end_row - start_row
+        for column in columns:
+            for row in range(start_row, grid['rowCount']):
+                moved = cells.pop((row + count, column), None)
+                if moved is None:
+                    cells.pop((row, column), None)
+                else:
+                    cells[(row, column)] = moved
+
+    def do_updateCells(self, body):
+        start = body['start']
+        sheet = self.sheet(start['sheetId'])
+        grid = sheet['properties']['gridProperties']
+        if start['rowIndex'] + len(body['rows']) > grid['rowCount']:
+            raise BadRequest('Range exceeds grid limits. Max rows: %d' % grid['rowCount'])
+
+        fields = body['fields'].split(',')
+        for i, row in enumerate(body['rows']):
+            values = row.get('values', [])
+            if start['columnIndex'] + len(values) > grid['columnCount']:
+                raise BadRequest('Range exceeds grid limits. Max columns: %d' % grid['columnCount'])
+            for j, data in enumerate(values):
+                key = (start['rowIndex'] + i, start['columnIndex'] + j)
+                current = sheet['cells'].setdefault(key, {})
+                for field in fields:
+                    source = data
+                    target = current
+                    path = field.split('.')
+                    for name in path[:-1]:
+                        source = source.get(name, {})
+                        target = target.setdefault(name, {})
+                    if path[-1] in source:
+                        target[path[-1]] = source[path[-1]]
+                    else:
+                        target.pop(path[-1], None)
+
+    def values(self, title):
+        # Entered values of a sheet as lists of rows, up to the last row
+        # and column that has something in it
+        for sheet in self.sheets:
+            if sheet['properties']['title'] == title:
+                break
+        else:
+            raise KeyError(title)
+
+        cells = {key: value['userEnteredValue'] for key, value in sheet['cells'].items()
+                 if value.get('userEnteredValue')}
+        if not cells:
+            return []
+        rows = max(r for r, c in cells) + 1
+        columns = max(c for r, c in cells) + 1
+        result = [[None] * columns for i in range(rows)]
+        for (r, c), value in cells.items():
+            (kind, v), = value.items()
+            result[r][c] = v
+        return result
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = {}
+        if length:
+            body = json.loads(self.rfile.read(length))
+
+        path = urllib.parse.urlsplit(self.path).path
+        with server.lock:
+            server.requests += 1
+            try:
+                for route_method, pattern, handler in ROUTES:
+                    match = re.match(pattern + '$', path)
+                    if route_method == method and match:
+                        status, result = handler(server, body, *match.groups())
+                        break
+                else:
+                    status, result = 404, None
+            except BadRequest as e:
+                status, result = 400, {'error': {'code': 400, 'message': str(e), 'status': 'INVALID_ARGUMENT'}}
+
+        if result is None:
+            result = {'error': {'code': status, 'message': 'Requested entity was not found.', 'status': 'NOT_FOUND'}}
+        self.respond(status, result)
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def create(server, body):
+    server.created += 1
+    spreadsheet = Spreadsheet('fake-%d' % server.created, body)
+    server.spreadsheets[spreadsheet.spreadsheet_id] = spreadsheet
+    return 200, spreadsheet.resource()
+
+
+def get(server, body, spreadsheet_id):
+    if spreadsheet_id not in server.spreadsheets:
+        return 404, None
+    return 200, server.spreadsheets[spreadsheet_id].resource()
+
+
+def batch_update(server, body, spreadsheet_id):
+    if spreadsheet_id not in server.spreadsheets:
+        return 404, None
+
+    # Like the real API, a batch applies completely or not at all
+    spreadsheet = server.spreadsheets[spreadsheet_id]
+    backup = copy.deepcopy(spreadsheet.sheets), spreadsheet.charts
+    try:
+        replies = [spreadsheet.apply(request) or {} for request in body['requests']]
+    except BadRequest:
+        spreadsheet.sheets, spreadsheet.charts = backup
+        raise
+
+    server.batches += 1
+    return 200, {'spreadsheetId': spreadsheet_id, 'replies': replies}
+
+
+ROUTES = [
+    ('POST', r'/v4/spreadsheets', create),
+    ('GET', r'/v4/spreadsheets/([^/:]+)', get),
+    ('POST', r'/v4/spreadsheets/([^/:]+):batchUpdate', batch_update),
+]
+
+
+def serve(port=0, latency=0):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.spreadsheets = {}
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.batches = 0
+    server.created = 0
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every response')
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency)
+    print("Serving Google Sheets on http://127.0.0.1:%d" % server.server_port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
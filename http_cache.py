@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+
+CACHE_FILE = 'http_cache.sqlite'
+CACHE_SIZE = 64 * 1024 * 1024
+
+# Headers describing the encoding of the original body, which no longer
+# applies to the decoded body we keep
+SKIP_HEADERS = ['content-encoding', 'content-length', 'transfer-encoding']
+
+
+class ResponseCache:
+    # Persistent store of GET responses that carry a validator (ETag or
+    # Last-Modified), evicting the least recently used ones once the total
+    # body size exceeds max_bytes.
+    def __init__(self, filename=CACHE_FILE, max_bytes=CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                headers TEXT,
+                body BLOB,
+                size INTEGER,
+                used REAL
+            )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.db.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT etag, last_modified, headers, body FROM responses WHERE url = ?',
+                (url,)).fetchone()
+            if row is None:
+                return None
+
+            self.db.execute('UPDATE responses SET used = ? WHERE url = ?', (time.time(), url))
+            self.db.commit()
+
+        return {
+            'etag': row[0],
+            'last_modified': row[1],
+            'headers': json.loads(row[2]),
+            'body': row[3]
+        }
+
+    def put(self, url, etag, last_modified, headers, body):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, json.dumps(headers), body, len(body), time.time()))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        stale = []
+        for url, size in self.db.execute('SELECT url, size FROM responses ORDER BY used'):
+            if total <= self.max_bytes:
+                break
+            stale.append((url,))
+            total -= size
+
+        self.db.executemany('DELETE FROM responses WHERE url = ?', stale)
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': entries,
+            'bytes': size
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class CachingSession(requests.Session):
+    # requests session that turns every GET into a conditional request and
+    # serves 304 Not Modified answers from the cache
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+
+        entry = self.cache.get(request.url)
+        if entry is not None:
+            if entry['etag'] is not None:
+                request.headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                request.headers['If-Modified-Since'] = entry['last_modified']
+
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.count(True)
+            headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+            # Keep fresh rate limit and validator headers from the 304
+            headers.update({k: v for k, v in response.headers.items()
+                            if k.lower() not in SKIP_HEADERS})
+            response.headers = headers
+            response.status_code = 200
+            response._content = entry['body']
+            return response
+
+        self.cache.count(False)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status_code == 200 and (etag is not None or last_modified is not None):
+            headers = {k: v for k, v in response.headers.items()
+                       if k.lower() not in SKIP_HEADERS}
+            self.cache.put(request.url, etag, last_modified, headers, response.content)
+
+        return response
@@ -8,6 +8,17 @@ import datetime
 import re
 import requests
 import time
+import functools
+
+import http_cache
+import issue_store
+import metrics
+import profiler
+import ratelimit
+import sync_pool
+
+PER_PAGE = 100
+
 
 def get_weight(title, labels):
     for abbrev in ['sp', 'pt']:
@@ -24,11 +35,15 @@ def get_weight(title, labels):
     return 1
 
 
-def get_last_updated(issues):
+def get_last_updated(issues, repo_meta=None):
     last = ""
-    for num, issue in issues.items():
-        if issue['updated_at'] > last:
-            last = issue['updated_at']
+    if repo_meta is not None and 'watermark' in repo_meta:
+        last = repo_meta['watermark']
+    else:
+        # Stores written before sync_meta.json existed
+        for num, issue in issues.items():
+            if issue['updated_at'] > last:
+                last = issue['updated_at']
 
     if last == "":
         last = "1969-12-31T21:00:00Z"
@@ -36,10 +51,7 @@ def get_last_updated(issues):
 
 
 def read_issues():
-    issues = {}
-    if os.path.exists('issues.json'):
-        with open('issues.json', encoding='utf-8') as f:
-            issues = json.loads(f.read())
+    issues = issue_store.read_issues()
 
     for orgname, org_repos in issues.items():
         for reponame, repo_issues in org_repos.items():
@@ -52,15 +64,20 @@ def read_issues():
     return issues
 
 
-def write_issues(issues):
-    with open('issues.json', 'w', encoding='utf-8') as f:
-        f.write(json.dumps(issues, indent=4,ensure_ascii=False))
-
-
-def get_issue_events(issue):
+@profiler.traced('import_github.get_issue_events')
+def get_issue_events(issue, previous=None):
+    cursor = None
     result = []
+    if previous is not None and 'event_cursor' in previous:
+        cursor = previous['event_cursor']
+        result = list(previous['events'])
+
+    events = issue.get_events()
+    new_events, cursor, complete = sync_pool.fetch_after(events.get_page, cursor, PER_PAGE)
+    if complete:
+        result = []
 
-    for event in issue.get_events():
+    for event in new_events:
         if event.event not in ['milestoned', 'demilestoned', 'labeled', 'unlabeled']:
             continue
 
@@ -87,11 +104,153 @@ def get_issue_events(issue):
         #print(evt)
         result.append(evt)
 
-    return result
+    return result, cursor
+
+
+def issue_record(issue, orgname, reponame, previous=None):
+    events, event_cursor = get_issue_events(issue, previous)
+
+    milestone = None
+    milestone_number = None
+    if issue.milestone is not None:
+        milestone = issue.milestone.title
+        milestone_number = issue.milestone.number
+
+    closed_at = None
+    if issue.closed_at is not None:
+        closed_at = issue.closed_at.isoformat() + 'Z'
+
+    labels = [l.name for l in issue.labels]
+
+    return {
+        'orgname': orgname,
+        'reponame': reponame,
+        'number': issue.number,
+        'source': 'github.com',
+        'title': issue.title,
+        'updated_at': issue.updated_at.isoformat() + 'Z',
+        'created_at': issue.created_at.isoformat() + 'Z',
+        'closed_at': closed_at,
+        'state': issue.state,
+        'is_pr': issue.pull_request is not None,
+        'labels': labels,
+        'milestone': milestone,
+        'milestone_number': milestone_number,
+        'events': events,
+        'event_cursor': event_cursor,
+        'weight': get_weight(issue.title, labels)
+    }
+
+
+def observe(gh, budget):
+    remaining, limit = gh.rate_limiting
+    budget.update(remaining, gh.rate_limiting_resettime, limit)
+
+
+def rate_limited(response):
+    # GitHub refuses requests over the quota with 403, or 429 for secondary
+    # limits, saying when to retry or that nothing remains
+    return response.status_code in [403, 429] and (
+        'Retry-After' in response.headers or
+        response.headers.get('X-RateLimit-Remaining') == '0')
+
+
+def list_repos(session, token, orgname, budget):
+    # Listed through the response cache: unchanged pages come back as 304
+    # and don't count against the rate limit. The session's response hook
+    # updates the budget from every page.
+    url = 'https://api.github.com/orgs/%s/repos?type=all&per_page=100' % orgname
+    headers = {
+        'Authorization': 'token %s' % token,
+        'Accept': 'application/vnd.github.v3+json'
+    }
+
+    repos = []
+    while url is not None:
+        budget.acquire()
+        response = session.get(url, headers=headers)
+        if rate_limited(response):
+            raise RateLimitExceededException(response.status_code, response.text, dict(response.headers))
+        response.raise_for_status()
+        repos.extend(response.json())
+        url = response.links.get('next', {}).get('url')
+
+    return repos
+
+
+def repo_changed(token, full_name, last_updated, etag, budget):
+    # Conditional request for the first page of the listing done below. A
+    # 304 means nothing changed since the last sync and costs no quota. It
+    # deliberately bypasses the response cache, which may hold an ETag of a
+    # sync that didn't finish, so it is observed and counted against the
+    # budget here.
+    url = 'https://api.github.com/repos/%s/issues' % full_name
+    params = {
+        'state': 'all',
+        'since': last_updated.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'sort': 'updated',
+        'direction': 'asc',
+        'per_page': PER_PAGE
+    }
+    headers = {
+        'Authorization': 'token %s' % token,
+        'Accept': 'application/vnd.github.v3+json'
+    }
+    if etag is not None:
+        headers['If-None-Match'] = etag
+
+    budget.acquire()
+    response = requests.get(url, params=params, headers=headers, timeout=30)
+    metrics.observe_response(budget.name or 'github.com', response.status_code, response.elapsed.total_seconds())
+    budget.update_from_headers(response.headers)
+    if response.status_code == 304:
+        return False, etag
+    if rate_limited(response):
+        # do_import() waits for the reset, as for limits PyGithub runs into
+        raise RateLimitExceededException(response.status_code, response.text, dict(response.headers))
+    response.raise_for_status()
+
+    return True, response.headers.get('ETag')
+
+
+def sync_repo(gh, token, full_name, reponame, orgname, repo_issues, last_updated, etag, budget, full, emit):
+    changed, etag = repo_changed(token, full_name, last_updated, etag, budget)
+    if not changed:
+        return etag
+
+    repo = gh.get_repo(full_name, lazy=True)
+
+    budget.acquire()
+    for issue in repo.get_issues(state='all', since=last_updated, sort='updated', direction='asc'):
+        # The listing includes the issue at the watermark itself. A full
+        # sync fetches every issue again, events and all, to repair what is
+        # stored.
+        previous = None if full else repo_issues.get(str(issue.number))
+        if previous is not None and previous['updated_at'] == issue.updated_at.isoformat() + 'Z':
+            continue
+
+        budget.acquire()
+        print("github.com %s: %s/%s %d %s" % (issue.updated_at, orgname, reponame, int(issue.number), issue.title))
 
+        with metrics.timer('issue_fetch_seconds', source='github.com'):
+            record = issue_record(issue, orgname, reponame, previous)
+        emit(orgname, reponame, record)
+        observe(gh, budget)
 
-def try_sync_issues(gh, orgname, reponame=None, since=None):
-    issues = read_issues()
+    return etag
+
+
+@profiler.traced('import_github.try_sync_issues')
+def try_sync_issues(gh, session, token, orgname, reponame=None, since=None, workers=1, budget=None, progress=None):
+    if budget is None:
+        budget = ratelimit.RateBudget()
+    if progress is None:
+        progress = sync_pool.Progress()
+
+    if progress.issues is None:
+        progress.issues = read_issues()
+        progress.meta = issue_store.read_meta()
+    issues = progress.issues
 
     if orgname not in issues:
         issues[orgname] = {}
@@ -99,74 +258,68 @@ def try_sync_issues(gh, orgname, reponame=None, since=None):
 
     last_updated = None
 
-    org = gh.get_organization(orgname)
+    if progress.repos is None:
+        progress.repos = [(repo['full_name'], repo['name'])
+                          for repo in list_repos(session, token, orgname, budget)
+                          if sync_pool.selected(reponame, repo['name'])]
 
-    c = 1
-    for repo in org.get_repos(type='all'):
-        if reponame is not None and reponame != repo.name:
+    jobs = []
+    for full_name, name in progress.repos:
+        if name in progress.done:
             continue
 
-        if repo.name not in org_issues:
-            org_issues[repo.name] = {}
-        repo_issues = org_issues[repo.name]
+        if name not in org_issues:
+            org_issues[name] = {}
 
-        last_updated = get_last_updated(repo_issues)
+        repo_meta = issue_store.repo_meta(progress.meta, 'github.com', orgname, name)
+        last_updated = get_last_updated(org_issues[name], repo_meta)
+        etag = repo_meta.get('etag')
         if since is not None:
             last_updated = since
+            etag = None
+        if name in progress.cursor:
+            last_updated = datetime.datetime.strptime(progress.cursor[name], "%Y-%m-%dT%H:%M:%SZ")
+            etag = None
 
+        jobs.append((name, functools.partial(sync_repo, gh, token, full_name, name, orgname,
+                                             org_issues[name], last_updated, etag, budget,
+                                             since is not None)))
 
-        for issue in repo.get_issues(state='all', since=last_updated, sort='updated', direction='asc'):
-            print("github.com %s: %s/%s %d %s" % (issue.updated_at, orgname, repo.name, int(issue.number), issue.title))
-            events = get_issue_events(issue)
-
-            milestone = None
-            milestone_number = None
-            if issue.milestone is not None:
-                milestone = issue.milestone.title
-                milestone_number = issue.milestone.number
-
-            closed_at = None
-            if issue.closed_at is not None:
-                closed_at = issue.closed_at.isoformat() + 'Z'
-
-            labels = [l.name for l in issue.labels]
-
-            repo_issues[str(issue.number)] = {
-                'orgname': orgname,
-                'reponame': reponame,
-                'number': issue.number,
-                'source': 'github.com',
-                'title': issue.title,
-                'updated_at': issue.updated_at.isoformat() + 'Z',
-                'created_at': issue.created_at.isoformat() + 'Z',
-                'closed_at': closed_at,
-                'state': issue.state,
-                'is_pr': issue.pull_request is not None,
-                'labels': labels,
-                'milestone': milestone,
-                'milestone_number': milestone_number,
-                'events': events,
-                'weight': get_weight(issue.title, labels)
-            }
-            c = c +1
-            if c % 100 == 99:
-               write_issues(issues)
-
-    write_issues(issues)
+    sync_pool.sync_into_store(issues, progress.meta, 'github.com', orgname, jobs, workers, progress)
 
     return last_updated
 
 
-def do_import(token, orgname, reponame=None, since=None):
-    gh = Github(token)
+def do_import(token, orgname, reponame=None, since=None, workers=1, requests_per_hour=5000,
+              cache_file=http_cache.CACHE_FILE, cache_size=http_cache.CACHE_SIZE, database=None):
+    gh = Github(token, per_page=PER_PAGE)
+    budget = ratelimit.RateBudget(requests_per_hour, name='github.com')
+    progress = sync_pool.Progress(database)
+
+    cache = http_cache.ResponseCache(cache_file, cache_size)
+    session = http_cache.CachingSession(cache)
+
+    def observe_response(response, *args, **kwargs):
+        metrics.observe_response(budget.name, response.status_code, response.elapsed.total_seconds())
+        budget.update_from_headers(response.headers)
+    session.hooks['response'].append(observe_response)
 
     while True:
         try:
-            try_sync_issues(gh, orgname, reponame, since)
+            try_sync_issues(gh, session, token, orgname, reponame, since, workers, budget, progress)
             break
         except RateLimitExceededException as e:
-            print("API request limit reached. Sleeping for 10 minutes.")
-            time.sleep(3600/6)
+            if e.headers is not None:
+                budget.update_from_headers(e.headers)
+            else:
+                observe(gh, budget)
+            print("API request limit reached. Sleeping until the limit is reset.")
+            budget.wait_for_reset()
         except requests.exceptions.ReadTimeout as e:
-            print("Request timed out. Sleeping for 10 minutes.")
-            time.sleep(3600/6)
+            print("Request timed out. Retrying in 60 seconds.")
+            time.sleep(60)
+
+    print("github.com HTTP cache: %(hits)d hits, %(misses)d misses, %(entries)d entries" % cache.stats())
+    cache.close()
+
+    return progress.changes()
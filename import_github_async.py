@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+
+import async_http
+import import_github
+import issue_store
+import profiler
+import ratelimit
+import sync_pool
+
+API_URL = 'https://api.github.com'
+PER_PAGE = 100
+
+
+def convert_events(events):
+    result = []
+
+    for event in events:
+        if event['event'] not in ['milestoned', 'demilestoned', 'labeled', 'unlabeled']:
+            continue
+
+        milestone_title = None
+        if event.get('milestone') is not None:
+            milestone_title = event['milestone']['title']
+
+        label_name = None
+        if event.get('label') is not None:
+            label_name = event['label']['name']
+
+        evt = {
+            'created_at': event['created_at'],
+            'event': event['event'],
+            'milestone': milestone_title,
+            'label': label_name
+        }
+
+        result.append(evt)
+
+    return result
+
+
+@profiler.traced('import_github_async.get_issue_events')
+async def get_issue_events(client, full_name, issue, previous=None):
+    cursor = None
+    result = []
+    if previous is not None and 'event_cursor' in previous:
+        cursor = previous['event_cursor']
+        result = list(previous['events'])
+
+    path = '/repos/%s/issues/%d/events' % (full_name, issue['number'])
+    events, cursor, complete = await client.fetch_after(path, cursor, PER_PAGE)
+    if complete:
+        result = []
+
+    result.extend(convert_events(events))
+
+    return result, cursor
+
+
+def issue_record(issue, orgname, reponame, events, event_cursor):
+    milestone = None
+    milestone_number = None
+    if issue['milestone'] is not None:
+        milestone = issue['milestone']['title']
+        milestone_number = issue['milestone']['number']
+
+    labels = [l['name'] for l in issue['labels']]
+
+    return {
+        'orgname': orgname,
+        'reponame': reponame,
+        'number': issue['number'],
+        'source': 'github.com',
+        'title': issue['title'],
+        'updated_at': issue['updated_at'],
+        'created_at': issue['created_at'],
+        'closed_at': issue['closed_at'],
+        'state': issue['state'],
+        'is_pr': 'pull_request' in issue,
+        'labels': labels,
+        'milestone': milestone,
+        'milestone_number': milestone_number,
+        'events': events,
+        'event_cursor': event_cursor,
+        'weight': import_github.get_weight(issue['title'], labels)
+    }
+
+
+async def sync_repo(client, writer, orgname, full_name, reponame, repo_issues, last_updated, etag, full):
+    start = time.monotonic()
+
+    params = {
+        'state': 'all',
+        'since': last_updated.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'sort': 'updated',
+        'direction': 'asc',
+        'per_page': PER_PAGE
+    }
+    headers = None
+    if etag is not None:
+        headers = {'If-None-Match': etag}
+
+    status, page, links, response_headers = await client.get(
+        '/repos/%s/issues' % full_name, params, headers)
+    if status != 304:
+        etag = response_headers.get('ETag')
+
+    while page is not None:
+        changed = []
+        for issue in page:
+            # The listing includes the issue at the watermark itself. A full
+            # sync fetches every issue again, events and all, to repair what
+            # is stored.
+            previous = None if full else repo_issues.get(str(issue['number']))
+            if previous is not None and previous['updated_at'] == issue['updated_at']:
+                continue
+            changed.append((issue, previous))
+
+        # Event histories of a whole page are fetched concurrently, then
+        # written in listing order so the watermark stays monotonic
+        events = await asyncio.gather(*[
+            get_issue_events(client, full_name, issue, previous)
+            for issue, previous in changed])
+
+        for (issue, previous), (issue_events, event_cursor) in zip(changed, events):
+            print("github.com %s: %s/%s %d %s" % (issue['updated_at'], orgname, reponame, issue['number'], issue['title']))
+            writer.write(orgname, reponame,
+                         issue_record(issue, orgname, reponame, issue_events, event_cursor))
+
+        if 'next' not in links:
+            break
+        status, page, links, response_headers = await client.get(links['next'])
+
+    writer.write(orgname, reponame, None, etag, time.monotonic() - start)
+
+
+@profiler.traced('import_github_async.try_sync_issues')
+async def try_sync_issues(client, orgname, reponame=None, since=None, workers=1, database=None):
+    issues = import_github.read_issues()
+    meta = issue_store.read_meta()
+    progress = sync_pool.Progress(database)
+
+    if orgname not in issues:
+        issues[orgname] = {}
+    org_issues = issues[orgname]
+
+    repos = await client.get_all('/orgs/%s/repos' % orgname, {'type': 'all', 'per_page': PER_PAGE})
+
+    writer = sync_pool.StoreWriter(issues, meta, 'github.com', progress)
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def run(full_name, name, last_updated, etag):
+        async with semaphore:
+            await sync_repo(client, writer, orgname, full_name, name,
+                            org_issues[name], last_updated, etag, since is not None)
+
+    tasks = []
+    for repo in repos:
+        name = repo['name']
+        if not sync_pool.selected(reponame, name):
+            continue
+
+        if name not in org_issues:
+            org_issues[name] = {}
+
+        repo_meta = issue_store.repo_meta(meta, 'github.com', orgname, name)
+        last_updated = import_github.get_last_updated(org_issues[name], repo_meta)
+        etag = repo_meta.get('etag')
+        if since is not None:
+            last_updated = since
+            etag = None
+
+        tasks.append(asyncio.ensure_future(run(repo['full_name'], name, last_updated, etag)))
+
+    try:
+        await asyncio.gather(*tasks)
+        writer.finish()
+    finally:
+        # When one repository fails the others are still running; they
+        # must stop writing before the journal is closed
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+    return progress.changes()
+
+
+def connect(token, requests_per_hour=5000, connections=20, base_url=API_URL):
+    headers = {
+        'Authorization': 'token %s' % token,
+        'Accept': 'application/vnd.github.v3+json'
+    }
+    budget = ratelimit.RateBudget(requests_per_hour, name='github.com')
+    return async_http.Client(base_url, headers, budget, connections)
+
+
+async def import_async(token, orgname, reponame, since, workers, requests_per_hour, connections, base_url,
+                       database):
+    client = connect(token, requests_per_hour, connections, base_url)
+    try:
+        return await try_sync_issues(client, orgname, reponame, since, workers, database)
+    finally:
+        await client.close()
+
+
+def do_import(token, orgname, reponame=None, since=None, workers=1, requests_per_hour=5000,
+              connections=20, base_url=API_URL, database=None):
+    return asyncio.run(import_async(token, orgname, reponame, since, workers,
+                             requests_per_hour, connections, base_url, database))
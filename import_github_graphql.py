@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+import datetime
+import functools
+import heapq
+import requests
+import time
+
+import http_cache
+import import_github
+import issue_store
+import metrics
+import profiler
+import ratelimit
+import sync_pool
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+EVENT_TYPES = {
+    'MilestonedEvent': 'milestoned',
+    'DemilestonedEvent': 'demilestoned',
+    'LabeledEvent': 'labeled',
+    'UnlabeledEvent': 'unlabeled'
+}
+
+TIMELINE = '''
+timelineItems(first: 100%s,
+              itemTypes: [MILESTONED_EVENT, DEMILESTONED_EVENT, LABELED_EVENT, UNLABELED_EVENT]) {
+    pageInfo { hasNextPage endCursor }
+    nodes {
+        __typename
+        ... on MilestonedEvent { createdAt milestoneTitle }
+        ... on DemilestonedEvent { createdAt milestoneTitle }
+        ... on LabeledEvent { createdAt label { name } }
+        ... on UnlabeledEvent { createdAt label { name } }
+    }
+}
+'''
+
+FIELDS = '''
+id
+number
+title
+state
+createdAt
+updatedAt
+closedAt
+labels(first: 100) { nodes { name } }
+milestone { title number }
+''' + TIMELINE % ''
+
+ISSUES_QUERY = '''
+query($owner: String!, $name: String!, $since: DateTime, $cursor: String) {
+    repository(owner: $owner, name: $name) {
+        issues(first: 100, after: $cursor, filterBy: {since: $since},
+               orderBy: {field: UPDATED_AT, direction: ASC}) {
+            pageInfo { hasNextPage endCursor }
+            nodes { %s }
+        }
+    }
+}
+''' % FIELDS
+
+PULL_REQUESTS_QUERY = '''
+query($owner: String!, $name: String!, $cursor: String) {
+    repository(owner: $owner, name: $name) {
+        pullRequests(first: 100, after: $cursor,
+                     orderBy: {field: UPDATED_AT, direction: DESC}) {
+            pageInfo { hasNextPage endCursor }
+            nodes { %s }
+        }
+    }
+}
+''' % FIELDS
+
+TIMELINE_QUERY = '''
+query($id: ID!, $timelineCursor: String) {
+    node(id: $id) {
+        ... on Issue { %s }
+        ... on PullRequest { %s }
+    }
+}
+''' % (TIMELINE % ', after: $timelineCursor', TIMELINE % ', after: $timelineCursor')
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def query(session, budget, text, **variables):
+    budget.acquire()
+    response = session.post(GRAPHQL_URL, json={'query': text, 'variables': variables})
+
+    if import_github.rate_limited(response):
+        raise RateLimitExceeded()
+    response.raise_for_status()
+
+    result = response.json()
+    if 'errors' in result:
+        for error in result['errors']:
+            if error.get('type') == 'RATE_LIMITED':
+                raise RateLimitExceeded()
+        raise RuntimeError('GraphQL query failed: %s' % result['errors'])
+
+    return result['data']
+
+
+def get_timeline(session, budget, node):
+    timeline = node['timelineItems']
+    items = list(timeline['nodes'])
+
+    while timeline['pageInfo']['hasNextPage']:
+        data = query(session, budget, TIMELINE_QUERY,
+                     id=node['id'], timelineCursor=timeline['pageInfo']['endCursor'])
+        timeline = data['node']['timelineItems']
+        items.extend(timeline['nodes'])
+
+    return items
+
+
+@profiler.traced('import_github_graphql.get_issue_events')
+def get_issue_events(session, budget, node):
+    result = []
+
+    for item in get_timeline(session, budget, node):
+        milestone_title = item.get('milestoneTitle')
+
+        label_name = None
+        if item.get('label') is not None:
+            label_name = item['label']['name']
+
+        evt = {
+            'created_at': item['createdAt'],
+            'event': EVENT_TYPES[item['__typename']],
+            'milestone': milestone_title,
+            'label': label_name
+        }
+
+        result.append(evt)
+
+    return result
+
+
+def issue_record(session, budget, node, orgname, reponame):
+    events = get_issue_events(session, budget, node)
+
+    milestone = None
+    milestone_number = None
+    if node['milestone'] is not None:
+        milestone = node['milestone']['title']
+        milestone_number = node['milestone']['number']
+
+    labels = [l['name'] for l in node['labels']['nodes']]
+
+    # REST reports merged pull requests as closed
+    state = 'open'
+    if node['state'] != 'OPEN':
+        state = 'closed'
+
+    return {
+        'orgname': orgname,
+        'reponame': reponame,
+        'number': node['number'],
+        'source': 'github.com',
+        'title': node['title'],
+        'updated_at': node['updatedAt'],
+        'created_at': node['createdAt'],
+        'closed_at': node['closedAt'],
+        'state': state,
+        'is_pr': node['is_pr'],
+        'labels': labels,
+        'milestone': milestone,
+        'milestone_number': milestone_number,
+        'events': events,
+        'weight': import_github.get_weight(node['title'], labels)
+    }
+
+
+def iter_issues(session, budget, owner, name, since):
+    cursor = None
+    while True:
+        data = query(session, budget, ISSUES_QUERY,
+                     owner=owner, name=name, since=since, cursor=cursor)
+        issues = data['repository']['issues']
+
+        for node in issues['nodes']:
+            node['is_pr'] = False
+            yield node
+
+        if not issues['pageInfo']['hasNextPage']:
+            break
+        cursor = issues['pageInfo']['endCursor']
+
+
+def get_pull_requests(session, budget, owner, name, since):
+    # Pull requests can't be filtered by update time, so walk them from the
+    # most recently updated one until the first one older than since
+    result = []
+    cursor = None
+    while True:
+        data = query(session, budget, PULL_REQUESTS_QUERY,
+                     owner=owner, name=name, cursor=cursor)
+        pull_requests = data['repository']['pullRequests']
+
+        for node in pull_requests['nodes']:
+            if node['updatedAt'] < since:
+                result.reverse()
+                return result
+            node['is_pr'] = True
+            result.append(node)
+
+        if not pull_requests['pageInfo']['hasNextPage']:
+            break
+        cursor = pull_requests['pageInfo']['endCursor']
+
+    result.reverse()
+    return result
+
+
+def sync_repo(session, token, full_name, reponame, orgname, repo_issues, last_updated, etag, budget, full, emit):
+    try:
+        changed, etag = import_github.repo_changed(token, full_name, last_updated, etag, budget)
+    except import_github.RateLimitExceededException:
+        raise RateLimitExceeded()
+    if not changed:
+        return etag
+
+    owner, name = full_name.split('/', 1)
+    since = last_updated.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    # Emit issues and pull requests in one stream ordered by updated_at, as
+    # the REST importer does, so the resume cursor stays valid
+    pull_requests = get_pull_requests(session, budget, owner, name, since)
+    nodes = heapq.merge(iter_issues(session, budget, owner, name, since), pull_requests,
+                        key=lambda node: node['updatedAt'])
+
+    for node in nodes:
+        # Both listings include the issue at the watermark itself. A full
+        # sync fetches every issue again, to repair what is stored.
+        previous = None if full else repo_issues.get(str(node['number']))
+        if previous is not None and previous['updated_at'] == node['updatedAt']:
+            continue
+
+        print("github.com %s: %s/%s %d %s" % (node['updatedAt'], orgname, reponame, node['number'], node['title']))
+
+        emit(orgname, reponame, issue_record(session, budget, node, orgname, reponame))
+
+    return etag
+
+
+@profiler.traced('import_github_graphql.try_sync_issues')
+def try_sync_issues(session, token, orgname, reponame=None, since=None, workers=1, budget=None, progress=None):
+    if budget is None:
+        budget = ratelimit.RateBudget()
+    if progress is None:
+        progress = sync_pool.Progress()
+
+    if progress.issues is None:
+        progress.issues = import_github.read_issues()
+        progress.meta = issue_store.read_meta()
+    issues = progress.issues
+
+    if orgname not in issues:
+        issues[orgname] = {}
+    org_issues = issues[orgname]
+
+    if progress.repos is None:
+        try:
+            repos = import_github.list_repos(session, token, orgname, budget)
+        except import_github.RateLimitExceededException:
+            raise RateLimitExceeded()
+        progress.repos = [(repo['full_name'], repo['name']) for repo in repos
+                          if sync_pool.selected(reponame, repo['name'])]
+
+    jobs = []
+    for full_name, name in progress.repos:
+        if name in progress.done:
+            continue
+
+        if name not in org_issues:
+            org_issues[name] = {}
+
+        repo_meta = issue_store.repo_meta(progress.meta, 'github.com', orgname, name)
+        last_updated = import_github.get_last_updated(org_issues[name], repo_meta)
+        etag = repo_meta.get('etag')
+        if since is not None:
+            last_updated = since
+            etag = None
+        if name in progress.cursor:
+            last_updated = datetime.datetime.strptime(progress.cursor[name], "%Y-%m-%dT%H:%M:%SZ")
+            etag = None
+
+        jobs.append((name, functools.partial(sync_repo, session, token, full_name, name, orgname,
+                                             org_issues[name], last_updated, etag, budget,
+                                             since is not None)))
+
+    sync_pool.sync_into_store(issues, progress.meta, 'github.com', orgname, jobs, workers, progress)
+
+
+def do_import(token, orgname, reponame=None, since=None, workers=1, requests_per_hour=5000,
+              cache_file=http_cache.CACHE_FILE, cache_size=http_cache.CACHE_SIZE, database=None):
+    budget = ratelimit.RateBudget(requests_per_hour, name='github.com')
+    progress = sync_pool.Progress(database)
+
+    cache = http_cache.ResponseCache(cache_file, cache_size)
+    session = http_cache.CachingSession(cache)
+    session.headers['Authorization'] = 'bearer %s' % token
+
+    def observe_response(response, *args, **kwargs):
+        metrics.observe_response(budget.name, response.status_code, response.elapsed.total_seconds())
+        budget.update_from_headers(response.headers)
+    session.hooks['response'].append(observe_response)
+
+    while True:
+        try:
+            try_sync_issues(session, token, orgname, reponame, since, workers, budget, progress)
+            break
+        except RateLimitExceeded as e:
+            print("API request limit reached. Sleeping until the limit is reset.")
+            budget.wait_for_reset()
+        except requests.exceptions.ReadTimeout as e:
+            print("Request timed out. Retrying in 60 seconds.")
+            time.sleep(60)
+
+    print("github.com HTTP cache: %(hits)d hits, %(misses)d misses, %(entries)d entries" % cache.stats())
+    cache.close()
+
+    return progress.changes()
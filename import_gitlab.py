@@ -8,6 +8,19 @@ import fnmatch
 import pprint
 import json
 import datetime
+import functools
+import requests
+import time
+
+import http_cache
+import issue_store
+import metrics
+import profiler
+import ratelimit
+import sync_pool
+
+
+PER_PAGE = 100
 
 
 def get_weight(title, labels):
@@ -27,10 +40,7 @@ def get_weight(title, labels):
 
 
 def read_issues():
-    issues = {}
-    if os.path.exists('issues.json'):
-        with open('issues.json', encoding='utf-8') as f:
-            issues = json.loads(f.read())
+    issues = issue_store.read_issues()
 
     for orgname, org_repos in issues.items():
         for reponame, repo_issues in org_repos.items():
@@ -43,10 +53,6 @@ def read_issues():
     return issues
 
 
-def write_issues(issues):
-    with open('issues.json', 'w', encoding='utf-8') as f:
-        f.write(json.dumps(issues, indent=4,ensure_ascii=False))
-
 def convert_time(time):
     if time is None:
         return None
@@ -57,10 +63,28 @@ def convert_time(time):
     return tm.isoformat() + 'Z'
 
 
-def get_issue_events(issue):
+@profiler.traced('import_gitlab.get_issue_events')
+def get_issue_events(issue, previous=None):
+    cursor = None
     result = []
+    if previous is not None and 'event_cursor' in previous:
+        cursor = previous['event_cursor']
+        result = list(previous['events'])
+
+    def fetch_page(page):
+        return issue.resourcemilestoneevents.list(page=page + 1, per_page=PER_PAGE)
+
+    events, cursor, complete = sync_pool.fetch_after(fetch_page, cursor, PER_PAGE)
+    if complete:
+        result = []
 
-    events = issue.resourcemilestoneevents.list()
+    result.extend(convert_events(events))
+
+    return result, cursor
+
+
+def convert_events(events):
+    result = []
 
     for event in events:
         if event.action not in ['add', 'remove']:
@@ -84,11 +108,15 @@ def get_issue_events(issue):
     return result
 
 
-def get_last_updated(issues):
+def get_last_updated(issues, repo_meta=None):
     last = ""
-    for num, issue in issues.items():
-        if issue['updated_at'] > last:
-            last = issue['updated_at']
+    if repo_meta is not None and 'watermark' in repo_meta:
+        last = repo_meta['watermark']
+    else:
+        # Stores written before sync_meta.json existed
+        for num, issue in issues.items():
+            if issue['updated_at'] > last:
+                last = issue['updated_at']
 
     if last == "":
         last = "1969-12-31T21:00:00Z"
@@ -96,19 +124,124 @@ def get_last_updated(issues):
 
 
 
-def try_sync_issues(gl, orgname, reponame, since, whitelist):
-    root = gl.groups.get(orgname)
+def issue_record(issue, orgname, repo_name, previous=None):
+    events, event_cursor = get_issue_events(issue, previous)
+
+    return make_record(issue, orgname, repo_name, events, event_cursor)
+
+
+def make_record(issue, orgname, repo_name, events, event_cursor):
+    milestone = None
+    milestone_number = None
+    if issue.milestone is not None:
+        milestone = issue.milestone['title']
+        milestone_number = issue.milestone['iid']
+
+    closed_at = None
+    if issue.closed_at is not None:
+        closed_at = issue.closed_at
+
+    weight = None
+    try:
+        weight = get_weight(issue.title, issue.labels)
+
+        if weight is None:
+            weight = issue.weight
+    except:
+        weight = 1
+
+    state = 'open'
+
+    if issue.state == 'closed':
+        state = 'closed'
+
+    return {
+        'orgname': orgname,
+        'reponame': repo_name,
+        'number': issue.iid,
+        'source': 'https://gitlab.com',
+        'title': issue.title,
+        'updated_at': convert_time(issue.updated_at),
+        'created_at': convert_time(issue.created_at),
+        'closed_at': convert_time(closed_at),
+        'state': state,
+        'is_pr': False,
+        'labels': issue.labels,
+        'milestone': milestone,
+        'milestone_number': milestone_number,
+        'events': events,
+        'event_cursor': event_cursor,
+        'weight': weight
+    }
+
+
+def project_changed(gl, project_id, last_updated, etag, budget):
+    # Conditional request for the issue listing done below, bypassing the
+    # response cache, which may hold an ETag of a sync that didn't finish.
+    # It is observed and counted against the budget like the requests of
+    # the session.
+    if isinstance(last_updated, datetime.datetime):
+        last_updated = last_updated.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    url = '%s/projects/%d/issues' % (gl.api_url, project_id)
+    params = {
+        'order_by': 'updated_at',
+        'sort': 'asc',
+        'updated_after': last_updated,
+        'per_page': PER_PAGE
+    }
+    headers = {'PRIVATE-TOKEN': gl.private_token}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+
+    response = requests.get(url, params=params, headers=headers, timeout=30)
+    metrics.observe_response(budget.name or 'gitlab.com', response.status_code, response.elapsed.total_seconds())
+    budget.update_from_headers(response.headers)
+    if response.status_code == 304:
+        return False, etag
+    if response.status_code == 429:
+        # Handled by do_import() like the limits python-gitlab runs into
+        raise gitlab.exceptions.GitlabHttpError(response.reason, response.status_code, response.content)
+    response.raise_for_status()
+
+    return True, response.headers.get('ETag')
+
+
+def sync_repo(gl, project_id, orgname, repo_name, repo_issues, last_updated, etag, budget, full, emit):
+    budget.acquire()
+    changed, etag = project_changed(gl, project_id, last_updated, etag, budget)
+    if not changed:
+        return etag
+
+    project = gl.projects.get(project_id, lazy=True)
+
+    budget.acquire()
+    # Listed issues carry every field we store, no need to get them again
+    for issue in project.issues.list(all=True, order_by='updated_at', sort='asc', updated_after=last_updated):
+        # The listing includes the issue at the watermark itself. A full
+        # sync fetches every issue again, events and all, to repair what is
+        # stored.
+        previous = None if full else repo_issues.get(str(issue.iid))
+        if previous is not None and previous['updated_at'] == convert_time(issue.updated_at):
+            continue
 
-    if reponame is not None:
-        reponame = orgname + '/' + reponame
+        budget.acquire()
+        print("gitlab.com %s: %s/%s %d %s" % (
+            convert_time(issue.updated_at), orgname, repo_name, int(issue.iid), issue.title))
 
-    issues = read_issues()
+        #print('- ', issue.title)
 
-    if orgname not in issues:
-        issues[orgname] = {}
-    org_issues = issues[orgname]
+        with metrics.timer('issue_fetch_seconds', source='gitlab.com'):
+            record = issue_record(issue, orgname, repo_name, previous)
+        emit(orgname, repo_name, record)
 
-    c = 1
+    return etag
+
+
+def list_projects(gl, orgname, reponame, whitelist):
+    root = gl.groups.get(orgname)
+
+    projects = []
     for project in root.projects.list(include_subgroups=True, all=True, lazy=True):
         if whitelist is not None:
             found = False
@@ -118,92 +251,95 @@ def try_sync_issues(gl, orgname, reponame, since, whitelist):
             if not found:
                 continue
 
-        if reponame is not None and reponame != project.path_with_namespace:
-            continue
-
         repo_name = re.search(r"^%s/(.*)$" % orgname, project.path_with_namespace).group(1)
+        if not sync_pool.selected(reponame, repo_name):
+            continue
 
         #print('scanning project: ', project.path_with_namespace)
 
-        if repo_name not in org_issues:
-            org_issues[repo_name] = {}
-
-        repo_issues = org_issues[repo_name]
-
-        project = gl.projects.get(project.id)
-
-        last_updated = get_last_updated(repo_issues)
-        if since is not None:
-            last_updated = since
-
+        projects.append((project.id, repo_name))
 
-        for found_issue in project.issues.list(all=True, order_by='created_at', sort='asc', updated_after=last_updated):
-            issue = project.issues.get(found_issue.iid)
-            print("gitlab.com %s: %s/%s %d %s" % (
-                convert_time(issue.updated_at), orgname, repo_name, int(issue.iid), issue.title))
+    return projects
 
-            #print('- ', issue.title)
 
-            milestone = None
-            milestone_number = None
-            if issue.milestone is not None:
-                milestone = issue.milestone['title']
-                milestone_number = issue.milestone['iid']
+@profiler.traced('import_gitlab.try_sync_issues')
+def try_sync_issues(gl, orgname, reponame, since, whitelist, workers=1, budget=None, progress=None):
+    if budget is None:
+        budget = ratelimit.RateBudget()
+    if progress is None:
+        progress = sync_pool.Progress()
 
-            events = get_issue_events(issue)
+    if progress.issues is None:
+        progress.issues = read_issues()
+        progress.meta = issue_store.read_meta()
+    issues = progress.issues
 
-            closed_at = None
-            if issue.closed_at is not None:
-                closed_at = issue.closed_at
+    if orgname not in issues:
+        issues[orgname] = {}
+    org_issues = issues[orgname]
 
-            weight = None
-            try:
-                weight = get_weight(issue.title, issue.labels)
+    if progress.repos is None:
+        progress.repos = list_projects(gl, orgname, reponame, whitelist)
 
-                if weight is None:
-                    weight = issue.weight
-            except:
-                weight = 1
+    jobs = []
+    for project_id, repo_name in progress.repos:
+        if repo_name in progress.done:
+            continue
 
-            state = 'open'
+        if repo_name not in org_issues:
+            org_issues[repo_name] = {}
 
-            if issue.state == 'closed':
-                state = 'closed'
+        repo_meta = issue_store.repo_meta(progress.meta, 'gitlab.com', orgname, repo_name)
+        last_updated = get_last_updated(org_issues[repo_name], repo_meta)
+        etag = repo_meta.get('etag')
+        if since is not None:
+            last_updated = since
+            etag = None
+        if repo_name in progress.cursor:
+            last_updated = progress.cursor[repo_name]
+            etag = None
 
-            repo_issues[str(issue.iid)] = {
-                'orgname': orgname,
-                'reponame': repo_name,
-                'number': issue.iid,
-                'source': 'https://gitlab.com',
-                'title': issue.title,
-                'updated_at': convert_time(issue.updated_at),
-                'created_at': convert_time(issue.created_at),
-                'closed_at': convert_time(closed_at),
-                'state': state,
-                'is_pr': False,
-                'labels': issue.labels,
-                'milestone': milestone,
-                'milestone_number': milestone_number,
-                'events': events,
-                'weight': weight
-            }
-            c = c +1
-            if c % 100 == 99:
-               write_issues(issues)
+        jobs.append((repo_name, functools.partial(
+            sync_repo, gl, project_id, orgname, repo_name, org_issues[repo_name], last_updated, etag, budget,
+            since is not None)))
 
-    write_issues(issues)
+    sync_pool.sync_into_store(issues, progress.meta, 'gitlab.com', orgname, jobs, workers, progress)
 
 
     #pp = pprint.PrettyPrinter(indent=4)
     #pp.pprint(org_issues)
 
 
-def do_import(token, orgname, reponame=None, since=None, whitelist=None):
-    gl = gitlab.Gitlab('https://gitlab.com', private_token=token)
-
-    try_sync_issues(gl, orgname, reponame, since, whitelist)
-
-    pass
+def do_import(token, orgname, reponame=None, since=None, whitelist=None, workers=1, requests_per_hour=None,
+              cache_file=http_cache.CACHE_FILE, cache_size=http_cache.CACHE_SIZE, database=None):
+    cache = http_cache.ResponseCache(cache_file, cache_size)
+    gl = gitlab.Gitlab('https://gitlab.com', private_token=token,
+                       session=http_cache.CachingSession(cache))
+    budget = ratelimit.RateBudget(requests_per_hour, name='gitlab.com')
+    progress = sync_pool.Progress(database)
+
+    def observe(response, *args, **kwargs):
+        metrics.observe_response(budget.name, response.status_code, response.elapsed.total_seconds())
+        budget.update_from_headers(response.headers)
+    gl.session.hooks['response'].append(observe)
+
+    while True:
+        try:
+            try_sync_issues(gl, orgname, reponame, since, whitelist, workers, budget, progress)
+            break
+        except gitlab.exceptions.GitlabHttpError as e:
+            if e.response_code != 429:
+                raise
+            print("API request limit reached. Sleeping until the limit is reset.")
+            budget.wait_for_reset()
+        except requests.exceptions.ReadTimeout as e:
+            print("Request timed out. Retrying in 60 seconds.")
+            time.sleep(60)
+
+    print("gitlab.com HTTP cache: %(hits)d hits, %(misses)d misses, %(entries)d entries" % cache.stats())
+    cache.close()
+
+    return progress.changes()
 
 
 if __name__ == '__main__':
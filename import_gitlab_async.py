@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import asyncio
+import datetime
+import fnmatch
+import re
+import time
+import types
+import urllib.parse
+
+import async_http
+import import_gitlab
+import issue_store
+import profiler
+import ratelimit
+import sync_pool
+
+GITLAB_URL = 'https://gitlab.com'
+PER_PAGE = 100
+
+
+@profiler.traced('import_gitlab_async.get_issue_events')
+async def get_issue_events(client, project_id, issue, previous=None):
+    cursor = None
+    result = []
+    if previous is not None and 'event_cursor' in previous:
+        cursor = previous['event_cursor']
+        result = list(previous['events'])
+
+    path = '/projects/%d/issues/%d/resource_milestone_events' % (project_id, issue['iid'])
+    events, cursor, complete = await client.fetch_after(path, cursor, PER_PAGE)
+    if complete:
+        result = []
+
+    # The GitLab importer reads the same fields as attributes
+    result.extend(import_gitlab.convert_events(
+        [types.SimpleNamespace(**event) for event in events]))
+
+    return result, cursor
+
+
+async def sync_project(client, writer, orgname, project_id, repo_name, repo_issues, last_updated, etag, full):
+    start = time.monotonic()
+
+    if isinstance(last_updated, datetime.datetime):
+        last_updated = last_updated.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    params = {
+        'order_by': 'updated_at',
+        'sort': 'asc',
+        'updated_after': last_updated,
+        'per_page': PER_PAGE
+    }
+    headers = None
+    if etag is not None:
+        headers = {'If-None-Match': etag}
+
+    status, page, links, response_headers = await client.get(
+        '/projects/%d/issues' % project_id, params, headers)
+    if status != 304:
+        etag = response_headers.get('ETag')
+
+    while page is not None:
+        changed = []
+        for issue in page:
+            # The listing includes the issue at the watermark itself. A full
+            # sync fetches every issue again, events and all, to repair what
+            # is stored.
+            previous = None if full else repo_issues.get(str(issue['iid']))
+            if previous is not None and previous['updated_at'] == import_gitlab.convert_time(issue['updated_at']):
+                continue
+            changed.append((issue, previous))
+
+        events = await asyncio.gather(*[
+            get_issue_events(client, project_id, issue, previous)
+            for issue, previous in changed])
+
+        for (issue, previous), (issue_events, event_cursor) in zip(changed, events):
+            print("gitlab.com %s: %s/%s %d %s" % (
+                import_gitlab.convert_time(issue['updated_at']), orgname, repo_name, issue['iid'], issue['title']))
+            writer.write(orgname, repo_name, import_gitlab.make_record(
+                types.SimpleNamespace(**issue), orgname, repo_name, issue_events, event_cursor))
+
+        if 'next' not in links:
+            break
+        status, page, links, response_headers = await client.get(links['next'])
+
+    writer.write(orgname, repo_name, None, etag, time.monotonic() - start)
+
+
+async def list_projects(client, orgname, reponame, whitelist):
+    projects = await client.get_all(
+        '/groups/%s/projects' % urllib.parse.quote(orgname, safe=''),
+        {'include_subgroups': 'true', 'per_page': PER_PAGE})
+
+    result = []
+    for project in projects:
+        path = project['path_with_namespace']
+        if whitelist is not None:
+            if not any(fnmatch.fnmatch(path, entry) for entry in whitelist):
+                continue
+
+        repo_name = re.search(r"^%s/(.*)$" % orgname, path).group(1)
+        if not sync_pool.selected(reponame, repo_name):
+            continue
+
+        result.append((project['id'], repo_name))
+
+    return result
+
+
+@profiler.traced('import_gitlab_async.try_sync_issues')
+async def try_sync_issues(client, orgname, reponame, since, whitelist, workers=1, database=None):
+    issues = import_gitlab.read_issues()
+    meta = issue_store.read_meta()
+    progress = sync_pool.Progress(database)
+
+    if orgname not in issues:
+        issues[orgname] = {}
+    org_issues = issues[orgname]
+
+    projects = await list_projects(client, orgname, reponame, whitelist)
+
+    writer = sync_pool.StoreWriter(issues, meta, 'gitlab.com', progress)
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def run(project_id, repo_name, last_updated, etag):
+        async with semaphore:
+            await sync_project(client, writer, orgname, project_id, repo_name,
+                               org_issues[repo_name], last_updated, etag, since is not None)
+
+    tasks = []
+    for project_id, repo_name in projects:
+        if repo_name not in org_issues:
+            org_issues[repo_name] = {}
+
+        repo_meta = issue_store.repo_meta(meta, 'gitlab.com', orgname, repo_name)
+        last_updated = import_gitlab.get_last_updated(org_issues[repo_name], repo_meta)
+        etag = repo_meta.get('etag')
+        if since is not None:
+            last_updated = since
+            etag = None
+
+        tasks.append(asyncio.ensure_future(run(project_id, repo_name, last_updated, etag)))
+
+    try:
+        await asyncio.gather(*tasks)
+        writer.finish()
+    finally:
+        # When one repository fails the others are still running; they
+        # must stop writing before the journal is closed
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+    return progress.changes()
+
+
+def connect(token, requests_per_hour=None, connections=20, base_url=GITLAB_URL):
+    budget = ratelimit.RateBudget(requests_per_hour, name='gitlab.com')
+    return async_http.Client(base_url + '/api/v4', {'PRIVATE-TOKEN': token}, budget, connections)
+
+
+async def import_async(token, orgname, reponame, since, whitelist, workers, requests_per_hour, connections, base_url,
+                       database):
+    client = connect(token, requests_per_hour, connections, base_url)
+    try:
+        return await try_sync_issues(client, orgname, reponame, since, whitelist, workers, database)
+    finally:
+        await client.close()
+
+
+def do_import(token, orgname, reponame=None, since=None, whitelist=None, workers=1, requests_per_hour=None,
+              connections=20, base_url=GITLAB_URL, database=None):
+    return asyncio.run(import_async(token, orgname, reponame, since, whitelist, workers,
+                             requests_per_hour, connections, base_url, database))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sqlite3
+
+import issue_store
+
+DB_FILE = 'issues.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS repos (
+    org TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    PRIMARY KEY (org, repo)
+);
+CREATE TABLE IF NOT EXISTS issues (
+    org TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    source TEXT,
+    title TEXT,
+    state TEXT,
+    is_pr INTEGER NOT NULL,
+    milestone TEXT,
+    milestone_number INTEGER,
+    weight INTEGER,
+    created_at TEXT,
+    updated_at TEXT,
+    closed_at TEXT,
+    event_cursor TEXT,
+    PRIMARY KEY (org, repo, number)
+);
+CREATE TABLE IF NOT EXISTS events (
+    org TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    event TEXT,
+    created_at TEXT,
+    milestone TEXT,
+    label TEXT,
+    PRIMARY KEY (org, repo, number, seq)
+);
+CREATE TABLE IF NOT EXISTS labels (
+    org TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    name TEXT,
+    PRIMARY KEY (org, repo, number, seq)
+);
+CREATE INDEX IF NOT EXISTS issues_repo ON issues (org, repo);
+CREATE INDEX IF NOT EXISTS issues_milestone ON issues (milestone);
+CREATE INDEX IF NOT EXISTS issues_updated_at ON issues (updated_at);
+CREATE INDEX IF NOT EXISTS events_milestone ON events (milestone, event);
+CREATE INDEX IF NOT EXISTS labels_name ON labels (name);
+'''
+
+ISSUE_COLUMNS = ['org', 'repo', 'number', 'source', 'title', 'state', 'is_pr', 'milestone',
+                 'milestone_number', 'weight', 'created_at', 'updated_at', 'closed_at', 'event_cursor']
+
+
+class IssueDB:
+    # SQLite copy of the issue store with issues, their events and labels in
+    # separate tables. The keys start with (org, repo), so reading one
+    # repository is an index range scan. Repositories and issues come back
+    # in the order they were first stored, as they do from the JSON store,
+    # since burndown results depend on it.
+    #
+    # Iterating it yields (orgname, reponame, repo_issues) like
+    # issue_store.IssueStream, and select() does the same for only the rows
+    # matching a filter, which is what issue_store.iter_repos() calls.
+    def __init__(self, filename=DB_FILE):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def is_empty(self):
+        return self.db.execute('SELECT 1 FROM issues LIMIT 1').fetchone() is None
+
+    def upsert(self, records):
+        # records is a list of (orgname, reponame, record), written in a
+        # single transaction
+        with self.db:
+            for orgname, reponame, record in records:
+                key = (orgname, reponame, int(record['number']))
+
+                event_cursor = None
+                if record.get('event_cursor') is not None:
+                    event_cursor = json.dumps(record['event_cursor'])
+
+                self.db.execute('INSERT OR IGNORE INTO repos VALUES (?, ?)', key[:2])
+                # An upsert rather than a replace keeps the rowid, and with
+                # it the position of the issue
+                self.db.execute(
+                    'INSERT INTO issues VALUES (%s) ON CONFLICT (org, repo, number) DO UPDATE SET %s' % (
+                        ', '.join('?' * len(ISSUE_COLUMNS)),
+                        ', '.join('%s = excluded.%s' % (c, c) for c in ISSUE_COLUMNS[3:])),
+                    key + (record.get('source'), record['title'], record['state'], int(record['is_pr']),
+                           record['milestone'], record.get('milestone_number'), record.get('weight'),
+                           record['created_at'], record['updated_at'], record['closed_at'], event_cursor))
+
+                self.db.execute('DELETE FROM events WHERE org = ? AND repo = ? AND number = ?', key)
+                self.db.executemany(
+                    'INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [key + (seq, e['event'], e['created_at'], e['milestone'], e['label'])
+                     for seq, e in enumerate(record['events'])])
+
+                self.db.execute('DELETE FROM labels WHERE org = ? AND repo = ? AND number = ?', key)
+                self.db.executemany(
+                    'INSERT INTO labels VALUES (?, ?, ?, ?, ?)',
+                    [key + (seq, name) for seq, name in enumerate(record['labels'])])
+
+    def load(self, issues, batch=1000):
+        records = []
+        for orgname, reponame, repo_issues in issue_store.iter_repos(issues):
+            for number, issue in repo_issues.items():
+                records.append((orgname, reponame, issue))
+                if len(records) >= batch:
+                    self.upsert(records)
+                    records = []
+        self.upsert(records)
+
+    def select(self, orgname=None, reponames=None, is_pr=None, milestoned_only=False):
+        repo_query = 'SELECT org, repo FROM repos'
+        repo_params = []
+        if orgname is not None:
+            repo_query += ' WHERE org = ?'
+            repo_params.append(orgname)
+        repo_query += ' ORDER BY rowid'
+
+        where = ['org = ?', 'repo = ?']
+        params = []
+        if is_pr is not None:
+            where.append('is_pr = ?')
+            params.append(int(is_pr))
+        if milestoned_only:
+            where.append('''(milestone IS NOT NULL OR EXISTS (
+                SELECT 1 FROM events e WHERE e.org = issues.org AND e.repo = issues.repo
+                AND e.number = issues.number AND e.event IN ('milestoned', 'demilestoned')))''')
+
+        query = 'SELECT %s FROM issues INDEXED BY issues_repo WHERE %s ORDER BY rowid' % (
+            ', '.join(ISSUE_COLUMNS), ' AND '.join(where))
+
+        # A second connection, so the caller may upsert while iterating
+        db = sqlite3.connect(self.filename)
+        try:
+            for repo in db.execute(repo_query, repo_params).fetchall():
+                if reponames is not None and repo[1] not in reponames:
+                    continue
+
+                rows = [dict(zip(ISSUE_COLUMNS, row)) for row in db.execute(query, repo + tuple(params))]
+                if rows:
+                    yield repo + (self.repo_issues(db, repo, rows),)
+        finally:
+            db.close()
+
+    def repo_issues(self, db, repo, rows):
+        # Events and labels of a repository are read with one range scan
+        # each instead of a lookup per issue
+        events = {}
+        for number, event, created_at, milestone, label in db.execute(
+                'SELECT number, event, created_at, milestone, label FROM events '
+                'WHERE org = ? AND repo = ? ORDER BY number, seq', repo):
+            events.setdefault(number, []).append(
+                {'created_at': created_at, 'event': event, 'milestone': milestone, 'label': label})
+
+        labels = {}
+        for number, name in db.execute(
+                'SELECT number, name FROM labels WHERE org = ? AND repo = ? ORDER BY number, seq', repo):
+            labels.setdefault(number, []).append(name)
+
+        result = {}
+        for issue in rows:
+            number = issue['number']
+            record = {
+                'orgname': issue['org'],
+                'reponame': issue['repo'],
+                'number': number,
+                'source': issue['source'],
+                'title': issue['title'],
+                'updated_at': issue['updated_at'],
+                'created_at': issue['created_at'],
+                'closed_at': issue['closed_at'],
+                'state': issue['state'],
+                'is_pr': bool(issue['is_pr']),
+                'labels': labels.get(number, []),
+                'milestone': issue['milestone'],
+                'milestone_number': issue['milestone_number'],
+                'events': events.get(number, []),
+                'weight': issue['weight']
+            }
+            if issue['event_cursor'] is not None:
+                record['event_cursor'] = json.loads(issue['event_cursor'])
+            result[str(number)] = record
+
+        return result
+
+    def __iter__(self):
+        return self.select()
+
+    def close(self):
+        self.db.close()
+
+
+def open_db(filename=DB_FILE):
+    # A new database starts out as a copy of the JSON store, after that the
+    # importers keep it up to date
+    db = IssueDB(filename)
+    if db.is_empty() and (os.path.exists(issue_store.SNAPSHOT) or os.path.exists(issue_store.JOURNAL)):
+        print("Loading %s into %s" % (issue_store.SNAPSHOT, filename))
+        db.load(issue_store.IssueStream())
+    return db
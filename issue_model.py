@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import datetime
+import time
+
+import issue_store
+
+EPOCH = datetime.datetime(1970, 1, 1)
+SECOND = datetime.timedelta(seconds=1)
+
+
+def parse_time(text):
+    # "%Y-%m-%dT%H:%M:%SZ" to seconds since the epoch. fromisoformat() is
+    # C code, several times faster than strptime or timegm.
+    if text is None:
+        return None
+    return (datetime.datetime.fromisoformat(text[:19]) - EPOCH) // SECOND
+
+
+def format_time(seconds):
+    if seconds is None:
+        return None
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+def to_datetime(seconds):
+    if seconds is None:
+        return None
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+class Event:
+    __slots__ = ['event', 'created_at', 'milestone', 'label']
+
+    def __init__(self, event, created_at, milestone, label):
+        self.event = event
+        self.created_at = created_at
+        self.milestone = milestone
+        self.label = label
+
+
+class Issue:
+    # Read-only view of a stored issue for burndown and the exporters, with
+    # every timestamp parsed once into seconds since the epoch
+    __slots__ = ['orgname', 'reponame', 'number', 'source', 'title', 'state', 'is_pr', 'labels',
+                 'milestone', 'milestone_number', 'weight', 'created_at', 'updated_at', 'closed_at',
+                 'events']
+
+    def __init__(self, orgname, reponame, number, record):
+        self.orgname = orgname
+        self.reponame = reponame
+        self.number = int(number)
+        self.source = record.get('source')
+        self.title = record['title']
+        self.state = record['state']
+        self.is_pr = record['is_pr']
+        self.labels = record['labels']
+        self.milestone = record['milestone']
+        self.milestone_number = record.get('milestone_number')
+        self.weight = record['weight']
+        self.created_at = parse_time(record['created_at'])
+        self.updated_at = parse_time(record['updated_at'])
+        self.closed_at = parse_time(record['closed_at'])
+        self.events = [Event(e['event'], parse_time(e['created_at']), e['milestone'], e['label'])
+                       for e in record['events']]
+
+
+def iter_issues(issues, orgname=None, reponames=None, is_pr=None, milestoned_only=False):
+    # issue_store.iter_repos() with the issues of each repository as Issue
+    # objects, keyed by number as in the store
+    for org, reponame, repo_issues in issue_store.iter_repos(
+            issues, orgname, reponames, is_pr, milestoned_only):
+        yield org, reponame, {number: Issue(org, reponame, number, record)
+                              for number, record in repo_issues.items()}
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import re
+
+import profiler
+
+SNAPSHOT = 'issues.json'
+JOURNAL = 'issues.journal'
+META = 'sync_meta.json'
+
+READ_CHUNK = 1024 * 1024
+
+
+def fsync_dir(filename):
+    dirname = os.path.dirname(os.path.abspath(filename))
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(filename, data):
+    # Write to a temporary file and rename it over the target, so a crash
+    # leaves either the old or the new contents, never a truncated file.
+    tmp = filename + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+    fsync_dir(filename)
+
+
+def apply_entry(issues, entry):
+    org_issues = issues.setdefault(entry['org'], {})
+    repo_issues = org_issues.setdefault(entry['repo'], {})
+    repo_issues[str(entry['number'])] = entry['issue']
+
+
+def read_journal(filename=JOURNAL):
+    if not os.path.exists(filename):
+        return
+
+    with open(filename, 'rb') as f:
+        for line in f:
+            # A torn write from a crash can only affect the last line
+            if not line.endswith(b'\n'):
+                break
+            yield json.loads(line.decode('utf-8'))
+
+
+def read_snapshot(filename=SNAPSHOT):
+    issues = {}
+    if os.path.exists(filename):
+        with open(filename, encoding='utf-8') as f:
+            issues = json.loads(f.read())
+    return issues
+
+
+def read_issues():
+    issues = read_snapshot()
+
+    for entry in read_journal():
+        apply_entry(issues, entry)
+
+    return issues
+
+
+class SnapshotReader:
+    # Incremental parser for the org -> repo -> number -> issue layout of
+    # the snapshot. Only one issue is decoded at a time and the buffer is
+    # cut down to the unparsed tail on every refill, so memory is bounded by
+    # the largest repository rather than by the whole file.
+    WHITESPACE = re.compile(r'\s*')
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        chunk = self.f.read(READ_CHUNK)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('%s: expected %r at offset %d' % (self.f.name, char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+                return value
+            except json.JSONDecodeError:
+                # The value runs past the end of the buffer
+                if not self.fill():
+                    raise
+
+    def members(self):
+        # Yields the keys of an object, the caller consumes each value
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() != ',':
+                break
+            self.pos += 1
+        self.expect('}')
+
+    def repos(self):
+        for orgname in self.members():
+            for reponame in self.members():
+                repo_issues = {}
+                for number in self.members():
+                    repo_issues[number] = self.value()
+                yield orgname, reponame, repo_issues
+
+
+def iter_snapshot(filename=SNAPSHOT):
+    if not os.path.exists(filename):
+        return
+
+    with open(filename, encoding='utf-8') as f:
+        yield from SnapshotReader(f).repos()
+
+
+# The org and repo Journal.append() writes at the start of every entry
+JOURNAL_KEY = re.compile(rb'\{"org":("(?:[^"\\]|\\.)*"),"repo":("(?:[^"\\]|\\.)*"),')
+
+
+def index_journal(filename=JOURNAL):
+    # org -> repo -> offsets of its entries in the journal, in order. Only
+    # the org and repo of each entry are decoded, so the index stays small
+    # however large the entries are.
+    index = {}
+    if not os.path.exists(filename):
+        return index
+
+    with open(filename, 'rb') as f:
+        offset = 0
+        for line in f:
+            # A torn write from a crash can only affect the last line
+            if not line.endswith(b'\n'):
+                break
+            match = JOURNAL_KEY.match(line)
+            if match is not None:
+                orgname, reponame = json.loads(match.group(1)), json.loads(match.group(2))
+            else:
+                entry = json.loads(line.decode('utf-8'))
+                orgname, reponame = entry['org'], entry['repo']
+            index.setdefault(orgname, {}).setdefault(reponame, []).append(offset)
+            offset += len(line)
+
+    return index
+
+
+def read_entries(f, offsets):
+    for offset in offsets:
+        f.seek(offset)
+        yield json.loads(f.readline().decode('utf-8'))
+
+
+class IssueStream:
+    # Read-only view of the store that yields (orgname, reponame,
+    # repo_issues) one repository at a time, with the journal applied.
+    # Every iteration reads the files again, so it can be walked more than
+    # once, e.g. for the issue list and then for the burndown.
+    def __init__(self, snapshot=SNAPSHOT, journal=JOURNAL):
+        self.snapshot = snapshot
+        self.journal = journal
+
+    def __iter__(self):
+        # Only the offsets of the journal entries are held, and those of a
+        # repository are read as it comes up, so memory is bounded by the
+        # largest repository however far the journal is from compaction
+        index = index_journal(self.journal)
+        if not index:
+            yield from iter_snapshot(self.snapshot)
+            return
+
+        with open(self.journal, 'rb') as journal:
+            for orgname, reponame, repo_issues in iter_snapshot(self.snapshot):
+                for entry in read_entries(journal, index.get(orgname, {}).pop(reponame, [])):
+                    repo_issues[str(entry['number'])] = entry['issue']
+                yield orgname, reponame, repo_issues
+
+            for orgname, org_repos in index.items():
+                for reponame, offsets in org_repos.items():
+                    repo_issues = {}
+                    for entry in read_entries(journal, offsets):
+                        repo_issues[str(entry['number'])] = entry['issue']
+                    yield orgname, reponame, repo_issues
+
+
+def milestoned(issue):
+    if issue['milestone'] is not None:
+        return True
+    return any(e['event'] in ['milestoned', 'demilestoned'] for e in issue['events'])
+
+
+def iter_repos(issues, orgname=None, reponames=None, is_pr=None, milestoned_only=False):
+    # Yields (orgname, reponame, repo_issues) for the issues matching the
+    # filters. Accepts the nested dict from read_issues(), an IssueStream or
+    # anything with a select() taking the same filters, like issue_db.IssueDB,
+    # which then does the filtering itself.
+    if hasattr(issues, 'select'):
+        yield from issues.select(orgname, reponames, is_pr, milestoned_only)
+        return
+
+    if isinstance(issues, dict):
+        repos = ((org, reponame, repo_issues)
+                 for org, org_repos in issues.items()
+                 for reponame, repo_issues in org_repos.items())
+    else:
+        repos = iter(issues)
+
+    for org, reponame, repo_issues in repos:
+        if orgname is not None and org != orgname:
+            continue
+        if reponames is not None and reponame not in reponames:
+            continue
+
+        if is_pr is not None or milestoned_only:
+            repo_issues = {number: issue for number, issue in repo_issues.items()
+                           if (is_pr is None or issue['is_pr'] == is_pr) and
+                           (not milestoned_only or milestoned(issue))}
+        yield org, reponame, repo_issues
+
+
+def read_meta():
+    # source -> org -> repo -> {'watermark', 'etag', 'duration'}
+    meta = {}
+    if os.path.exists(META):
+        with open(META, encoding='utf-8') as f:
+            meta = json.loads(f.read())
+    return meta
+
+
+def write_meta(meta):
+    atomic_write(META, json.dumps(meta, indent=4, ensure_ascii=False))
+
+
+def repo_meta(meta, source, orgname, reponame):
+    return meta.get(source, {}).get(orgname, {}).get(reponame, {})
+
+
+class Journal:
+    def __init__(self, filename=JOURNAL):
+        self.filename = filename
+
+        if os.path.exists(filename):
+            self.truncate_torn_tail()
+
+        self.fd = open(filename, 'ab')
+
+    def truncate_torn_tail(self):
+        with open(self.filename, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                f.truncate(end)
+
+    def size(self):
+        return self.fd.tell()
+
+    def append(self, orgname, reponame, issue):
+        entry = {
+            'org': orgname,
+            'repo': reponame,
+            'number': issue['number'],
+            'issue': issue
+        }
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+        self.fd.write(line.encode('utf-8') + b'\n')
+
+    def sync(self):
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+    def reset(self):
+        self.fd.seek(0)
+        self.fd.truncate(0)
+        self.sync()
+
+    def close(self):
+        self.sync()
+        self.fd.close()
+
+
+@profiler.traced('issue_store.checkpoint')
+def checkpoint(issues, journal=None):
+    atomic_write(SNAPSHOT, json.dumps(issues, indent=4, ensure_ascii=False))
+
+    # The snapshot now contains everything from the journal. Replaying the
+    # journal on top of it is idempotent, so a crash before this point is
+    # harmless.
+    if journal is not None:
+        journal.reset()
+    elif os.path.exists(JOURNAL):
+        with open(JOURNAL, 'wb') as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def maybe_compact(issues, journal):
+    # Rewrite the snapshot once the journal is as large as half of it, which
+    # keeps the total amount of bytes written linear in the number of updates.
+    snapshot_size = 0
+    if os.path.exists(SNAPSHOT):
+        snapshot_size = os.path.getsize(SNAPSHOT)
+
+    if journal.size() > snapshot_size // 2:
+        checkpoint(issues, journal)
+        return True
+    return False
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Counters, gauges and latency histograms of syncs and exports, kept in
+# memory for the life of the process. They are served in the Prometheus
+# text format while the daemon runs, and written as JSON after a one-shot
+# sync. Every metric can carry labels, given as keyword arguments:
+#
+#   metrics.inc('sync_issues_total', source='github.com', repo='docs')
+#   with metrics.timer('store_sync_seconds'):
+#       ...
+#
+# Updates are thread-safe. Metrics recorded in export worker processes
+# stay in those processes.
+
+import contextlib
+import http.server
+import json
+import threading
+import time
+
+METRICS_FILE = 'sync_metrics.json'
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+
+
+def key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    k = key(name, labels)
+    with lock:
+        counters[k] = counters.get(k, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with lock:
+        gauges[key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    k = key(name, labels)
+    with lock:
+        histogram = histograms.get(k)
+        if histogram is None:
+            histogram = histograms[k] = {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def observe_response(api, status, seconds):
+    # One request to a forge API
+    inc('api_requests_total', api=api, status=str(status))
+    observe('api_request_seconds', seconds, api=api)
+
+
+def reset():
+    with lock:
+        counters.clear()
+        gauges.clear()
+        histograms.clear()
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+def render():
+    # The Prometheus text exposition format
+    lines = []
+    with lock:
+        for kind, values in [('counter', counters), ('gauge', gauges)]:
+            declared = set()
+            for (name, labels), value in sorted(values.items()):
+                if name not in declared:
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    declared.add(name)
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+        declared = set()
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in declared:
+                lines.append('# TYPE %s histogram' % name)
+                declared.add(name)
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', bound)]), count))
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), histogram['sum']))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    with lock:
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(counters.items())],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(gauges.items())],
+            'histograms': [{'name': name, 'labels': dict(labels),
+                            'count': histogram['count'], 'sum': histogram['sum'],
+                            'buckets': dict(zip([str(bound) for bound in BUCKETS], histogram['buckets']))}
+                           for (name, labels), histogram in sorted(histograms.items())]
+        }
+
+
+def dump(filename=METRICS_FILE):
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(snapshot(), indent=2))
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        data = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(host='127.0.0.1', port=8071):
+    # Serves /metrics from a background thread
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
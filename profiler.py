@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# Profiling of a whole sync.py command, for `sync.py --profile`. Two modes:
+#
+#   sample   a background thread records the stacks of all threads every
+#            SAMPLE_INTERVAL seconds. Cheap enough for a full sync.
+#   cprofile cProfile on the main thread, exact call counts and times,
+#            but it slows everything down. Also saves the raw stats.
+#
+# Both write PREFIX.collapsed, one "frame;frame;frame count" line per
+# stack as flamegraph.pl and speedscope read it, and PREFIX.txt, a summary
+# per function and per span. Spans are named regions marked with span()
+# or the @traced decorator; they show up as [name] frames in the stacks
+# and their wall time is summed by name. cProfile stacks are rebuilt from
+# its caller graph, so they are an estimate, in microseconds.
+
+import asyncio
+import atexit
+import collections
+import contextlib
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.005
+# cProfile time spread over fewer microseconds than this along a path is
+# dropped when rebuilding stacks
+MIN_WEIGHT = 1
+
+profiler = None
+
+
+class SpanStats:
+    # Wall time per span name, and the open spans of every thread with
+    # the frame each was opened in
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = collections.defaultdict(lambda: [0, 0.0])
+        self.open = collections.defaultdict(list)
+
+    def enter(self, name, frame):
+        entry = (name, frame, time.perf_counter())
+        with self.lock:
+            self.open[threading.get_ident()].append(entry)
+        return entry
+
+    def exit(self, entry):
+        elapsed = time.perf_counter() - entry[2]
+        with self.lock:
+            # Coroutines of one thread can close spans out of order
+            self.open[threading.get_ident()].remove(entry)
+            total = self.totals[entry[0]]
+            total[0] += 1
+            total[1] += elapsed
+
+    def labels(self, thread_id):
+        # {id(frame): [span names]} of the spans open in a thread
+        result = collections.defaultdict(list)
+        with self.lock:
+            for name, frame, start in self.open.get(thread_id, []):
+                result[id(frame)].append('[%s]' % name)
+        return result
+
+
+def frame_label(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Sampler:
+    def __init__(self, spans):
+        self.spans = spans
+        self.stacks = collections.Counter()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(SAMPLE_INTERVAL):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                labels = self.spans.labels(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.extend(reversed(labels.get(id(frame), [])))
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, 'thread-%d' % thread_id))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return self.stacks
+
+    def summary(self):
+        # Samples per function, on top of the stack (self) and anywhere in
+        # it (total)
+        own = collections.Counter()
+        total = collections.Counter()
+        samples = sum(self.stacks.values())
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            frames = [f for f in frames if not f.startswith('[')]
+            if frames:
+                own[frames[-1]] += count
+            for f in set(frames):
+                total[f] += count
+
+        lines = ['%d samples every %g ms' % (samples, SAMPLE_INTERVAL * 1000), '',
+                 '%8s %7s %8s %7s  %s' % ('self', '%', 'total', '%', 'function')]
+        for f, count in total.most_common():
+            lines.append('%8d %6.1f%% %8d %6.1f%%  %s' % (
+                own[f], 100.0 * own[f] / max(samples, 1), count, 100.0 * count / max(samples, 1), f))
+        return '\n'.join(lines)
+
+
+class Deterministic:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def stats(self):
+        return pstats.Stats(self.profile)
+
+    def collapsed(self):
+        # Every function's own time is split between its callers in
+        # proportion to the time spent in it from each of them
+        stats = self.stats().stats
+        stacks = collections.Counter()
+
+        def label(func):
+            filename, line, name = func
+            return '%s (%s:%d)' % (name, os.path.basename(filename), line)
+
+        def walk(func, weight, path, seen):
+            callers = stats[func][4] if func in stats else {}
+            callers = {caller: c for caller, c in callers.items() if caller not in seen}
+            total = sum(c[3] for c in callers.values())
+            if total <= 0:
+                stacks[';'.join(reversed(path))] += weight
+                return
+            for caller, c in callers.items():
+                share = weight * c[3] / total
+                if share >= MIN_WEIGHT:
+                    walk(caller, share, path + [label(caller)], seen | {caller})
+
+        for func, (cc, nc, tt, ct, callers) in stats.items():
+            if tt * 1e6 >= MIN_WEIGHT:
+                walk(func, tt * 1e6, [label(func)], {func})
+
+        return collections.Counter({stack: int(round(count)) for stack, count in stacks.items() if count >= 1})
+
+    def summary(self):
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(60)
+        stats.sort_stats('tottime').print_stats(60)
+        return out.getvalue()
+
+
+class Profiler:
+    def __init__(self, mode, prefix):
+        self.mode = mode
+        self.prefix = prefix
+        self.spans = SpanStats()
+        if mode == 'cprofile':
+            self.backend = Deterministic()
+        else:
+            self.backend = Sampler(self.spans)
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.backend.start()
+
+    def finish(self):
+        self.backend.stop()
+        elapsed = time.perf_counter() - self.start_time
+
+        with open(self.prefix + '.collapsed', 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.backend.collapsed().items()):
+                f.write('%s %d\n' % (stack, count))
+
+        with open(self.prefix + '.txt', 'w', encoding='utf-8') as f:
+            f.write('%s profile of %.3f seconds\n\n' % (self.mode, elapsed))
+            f.write('%8s %10s %10s  %s\n' % ('calls', 'seconds', 'per call', 'span'))
+            for name, (count, total) in sorted(self.spans.totals.items(), key=lambda item: -item[1][1]):
+                f.write('%8d %10.3f %10.6f  %s\n' % (count, total, total / count, name))
+            f.write('\n')
+            f.write(self.backend.summary())
+            f.write('\n')
+
+        if self.mode == 'cprofile':
+            self.backend.stats().dump_stats(self.prefix + '.pstats')
+
+        print("Profile written to %s.collapsed and %s.txt" % (self.prefix, self.prefix))
+
+
+def start(mode='sample', prefix='profile'):
+    # Profiles until the process exits
+    global profiler
+    profiler = Profiler(mode, prefix)
+    profiler.start()
+    atexit.register(profiler.finish)
+
+
+@contextlib.contextmanager
+def span(name):
+    if profiler is None:
+        yield
+        return
+
+    # The frame of the code using the span, outside contextlib
+    entry = profiler.spans.enter(name, sys._getframe(2))
+    try:
+        yield
+    finally:
+        profiler.spans.exit(entry)
+
+
+def traced(name):
+    # Decorator marking every call of a function, or coroutine function,
+    # as a span
+    def decorate(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if profiler is None:
+                    return await function(*args, **kwargs)
+                entry = profiler.spans.enter(name, sys._getframe(0))
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    profiler.spans.exit(entry)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if profiler is None:
+                return function(*args, **kwargs)
+            entry = profiler.spans.enter(name, sys._getframe(0))
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.spans.exit(entry)
+        return wrapper
+
+    return decorate
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+import time
+
+import metrics
+
+
+class RateBudget:
+    # Request budget shared by all sync workers talking to the same API.
+    #
+    # It combines a token bucket for the configured requests_per_hour with
+    # the quota the server reports in its rate limit headers: once the
+    # remaining quota drops to the reserve, requests wait until the reset
+    # time, and the last part of the quota is spread evenly over the time
+    # left in the window. name labels the metrics of the API.
+    def __init__(self, requests_per_hour=None, reserve=10, name=None):
+        self.name = name
+        self.lock = threading.Lock()
+        self.rate = None
+        if requests_per_hour is not None:
+            self.rate = requests_per_hour / 3600.0
+        self.capacity = 100
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+        self.reserve = reserve
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.next_slot = 0
+
+    def update(self, remaining, reset, limit=None):
+        with self.lock:
+            if limit is not None:
+                self.limit = limit
+            # Responses of concurrent workers can arrive out of order, keep
+            # the lowest quota seen within the same window.
+            if self.reset == reset and self.remaining is not None:
+                remaining = min(remaining, self.remaining)
+            self.remaining = remaining
+            self.reset = reset
+
+        if self.name is not None:
+            metrics.set_gauge('api_rate_limit_remaining', remaining, api=self.name)
+
+    def update_from_headers(self, headers):
+        headers = {k.lower(): v for k, v in headers.items()}
+
+        retry_after = headers.get('retry-after')
+        if retry_after is not None:
+            self.update(0, time.time() + int(retry_after))
+            return
+
+        for prefix in ['x-ratelimit-', 'ratelimit-']:
+            remaining = headers.get(prefix + 'remaining')
+            reset = headers.get(prefix + 'reset')
+            limit = headers.get(prefix + 'limit')
+            if remaining is None or reset is None:
+                continue
+            if limit is not None:
+                limit = int(limit)
+            self.update(int(remaining), int(reset), limit)
+            return
+
+    def wait_for_reset(self):
+        with self.lock:
+            reset = self.reset
+            self.remaining = None
+            self.next_slot = 0
+
+        if reset is None:
+            return 0
+
+        wait = max(0, reset - time.time()) + 1
+        time.sleep(wait)
+        return wait
+
+    def take_token(self, count):
+        if self.rate is None:
+            return 0
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+        if self.tokens >= count:
+            self.tokens -= count
+            return 0
+
+        return (count - self.tokens) / self.rate
+
+    def quota_wait(self, count):
+        if self.remaining is None:
+            return 0
+
+        now = time.time()
+        if self.reset <= now:
+            # A new window has started, wait for fresh headers
+            self.remaining = None
+            return 0
+
+        if self.remaining - count < self.reserve:
+            return self.reset - now + 1
+
+        return 0
+
+    def take_quota(self, count):
+        # Returns how long to wait for the paced slot of this request
+        if self.remaining is None:
+            return 0
+
+        low_water = self.reserve
+        if self.limit is not None:
+            low_water = max(self.reserve, self.limit // 10)
+
+        wait = 0
+        if self.remaining < low_water:
+            now = time.monotonic()
+            interval = (self.reset - time.time()) / (self.remaining - self.reserve)
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + interval * count
+            wait = slot - now
+
+        self.remaining -= count
+        return wait
+
+    def try_acquire(self, count=1):
+        # Returns (wait, granted): when granted, the request may be sent
+        # after waiting; otherwise wait and try again
+        with self.lock:
+            wait = self.quota_wait(count)
+            if wait == 0:
+                wait = self.take_token(count)
+            if wait == 0:
+                return self.take_quota(count), True
+            return wait, False
+
+    def acquire(self, count=1):
+        while True:
+            wait, granted = self.try_acquire(count)
+            if wait > 0:
+                metrics.inc('api_wait_seconds_total', wait, api=self.name)
+                time.sleep(wait)
+            if granted:
+                return
+
+    async def acquire_async(self, count=1):
+        while True:
+            wait, granted = self.try_acquire(count)
+            if wait > 0:
+                metrics.inc('api_wait_seconds_total', wait, api=self.name)
+                await asyncio.sleep(wait)
+            if granted:
+                return
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Polling schedule of the daemon. Every repository is polled at its own
+# interval, from a smoothed rate of changed issues per hour: about one
+# changed issue is expected per poll, within min_interval and
+# max_interval. When polling every repository that often would take more
+# requests per hour than the budget, all intervals are stretched by the
+# same factor. A full sync every max_interval picks up new repositories.
+
+import json
+import os
+
+import issue_store
+
+SCHEDULE_FILE = 'schedule.json'
+
+MIN_INTERVAL = 300
+MAX_INTERVAL = 86400
+# Interval of a repository until its rate is known
+FIRST_INTERVAL = 3600
+# Weight of the latest poll in the rate
+SMOOTHING = 0.3
+# Requests per changed issue, the issue and its events, on top of the
+# request of the poll itself
+CHANGE_COST = 2
+
+
+class Schedule:
+    # Per source, organization and repository: the rate of changes per
+    # hour, and the time of the last and the next poll, in epoch seconds.
+    VERSION = 1
+
+    def __init__(self, filename=SCHEDULE_FILE, requests_per_hour=None,
+                 min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self.filename = filename
+        self.requests_per_hour = requests_per_hour
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.repos = {}
+        self.full_sync = 0
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                data = json.loads(f.read())
+            if data.get('version') == self.VERSION:
+                self.repos = data['repos']
+                self.full_sync = data['full_sync']
+
+    def entries(self):
+        for source, orgs in self.repos.items():
+            for orgname, repos in orgs.items():
+                for reponame, entry in repos.items():
+                    yield source, orgname, reponame, entry
+
+    def record(self, source, orgname, changes, now, polled=None):
+        # changes is {reponame: changed issues} of a sync, as returned by
+        # the importers. polled are the repositories that were asked for,
+        # None for all of them; those the sync didn't find are gone.
+        repos = self.repos.setdefault(source, {}).setdefault(orgname, {})
+        for reponame in list(repos if polled is None else polled):
+            if reponame not in changes:
+                repos.pop(reponame, None)
+
+        for reponame, count in changes.items():
+            entry = repos.get(reponame)
+            if entry is None:
+                repos[reponame] = {'rate': 3600.0 / FIRST_INTERVAL, 'last_poll': now, 'next_poll': now}
+                continue
+
+            observed = count * 3600.0 / max(now - entry['last_poll'], 1)
+            entry['rate'] = SMOOTHING * observed + (1 - SMOOTHING) * entry['rate']
+            entry['last_poll'] = now
+
+        self.plan()
+
+    def record_full_sync(self, now):
+        self.full_sync = now
+
+    def interval(self, rate):
+        if rate <= 0:
+            return self.max_interval
+        return min(max(3600.0 / rate, self.min_interval), self.max_interval)
+
+    def plan(self):
+        entries = list(self.entries())
+        intervals = [self.interval(entry['rate']) for source, orgname, reponame, entry in entries]
+
+        if self.requests_per_hour is not None:
+            # Changed issues cost the same however often they are polled,
+            # only the polls themselves can be saved
+            polls = sum(3600.0 / interval for interval in intervals)
+            available = self.requests_per_hour - sum(
+                CHANGE_COST * entry['rate'] for source, orgname, reponame, entry in entries)
+            if available <= 0:
+                intervals = [self.max_interval] * len(intervals)
+            elif polls > available:
+                factor = polls / available
+                intervals = [min(interval * factor, self.max_interval) for interval in intervals]
+
+        for (source, orgname, reponame, entry), interval in zip(entries, intervals):
+            entry['next_poll'] = entry['last_poll'] + interval
+
+    def full_sync_due(self, now):
+        return now >= self.full_sync + self.max_interval
+
+    def due(self, now):
+        # {source: {orgname: [reponame]}} of the repositories to poll now
+        result = {}
+        for source, orgname, reponame, entry in self.entries():
+            if entry['next_poll'] <= now:
+                result.setdefault(source, {}).setdefault(orgname, []).append(reponame)
+        return result
+
+    def next_poll(self):
+        return min([self.full_sync + self.max_interval] +
+                   [entry['next_poll'] for source, orgname, reponame, entry in self.entries()])
+
+    def save(self):
+        issue_store.atomic_write(self.filename, json.dumps(
+            {'version': self.VERSION, 'full_sync': self.full_sync, 'repos': self.repos}, ensure_ascii=False))
+
+
+class Debounce:
+    # Runs an action once changes have settled: delay seconds after the
+    # last change, but no later than max_delay after the first one it
+    # hasn't run for
+    def __init__(self, delay, max_delay):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.first = None
+        self.last = None
+
+    def changed(self, now):
+        if self.first is None:
+            self.first = now
+        self.last = now
+
+    def deadline(self):
+        if self.first is None:
+            return None
+        return min(self.last + self.delay, self.first + self.max_delay)
+
+    def due(self, now):
+        return self.first is not None and now >= self.deadline()
+
+    def done(self):
+        self.first = None
+        self.last = None
@@ -2,6 +2,7 @@
 
 
 import argparse
+import asyncio
 import pickle
 import os.path
 import datetime
@@ -12,21 +13,38 @@ import csv
 import collections
 import burndown
 
-import export_xlsx
-import export_tsv
-import export_google_sheets
+import export_pipeline
 import import_github
+import import_github_graphql
+import import_github_async
 import import_gitlab
+import import_gitlab_async
+import issue_db
+import issue_store
+import http_cache
+import metrics
+import profiler
+import scheduler
+import webhook
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='store_true', default=False)
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the command and write a collapsed stack file and a summary')
+    parser.add_argument('--profile-mode', choices=['sample', 'cprofile'], default='sample',
+                        help='sample stacks of all threads (default) or trace the main thread with cProfile')
+    parser.add_argument('--profile-output', metavar='PREFIX', default='profile',
+                        help='write PREFIX.collapsed and PREFIX.txt (default: profile)')
     subparsers = parser.add_subparsers(title="commands", dest="command")
     subparsers.required = True
 
     sync = subparsers.add_parser("sync")
     sync.add_argument('reponame', default=None, nargs='?')
     sync.add_argument('--full', action='store_true')
+    sync.add_argument('--workers', type=int, default=None)
+    sync.add_argument('--github-backend', choices=['rest', 'graphql'], default=None)
+    sync.add_argument('--engine', choices=['threads', 'async'], default=None)
 
     export = subparsers.add_parser("export")
 
@@ -37,15 +55,38 @@ if __name__ == '__main__':
 
     xlsx = export_subparsers.add_parser("xlsx")
     xlsx.add_argument('filename')
+    xlsx.add_argument('--constant-memory', action='store_true',
+                      help='stream rows to disk, with autofilters instead of tables')
+
+    parquet = export_subparsers.add_parser("parquet")
+    parquet.add_argument('directory')
 
     google_sheets = export_subparsers.add_parser("google_sheets")
     google_sheets.add_argument('filename')
+    google_sheets.add_argument('--mode', choices=['drive', 'api'], default=None)
+
+    pipeline = export_subparsers.add_parser("pipeline")
+    pipeline.add_argument('--tsv', metavar='FILENAME')
+    pipeline.add_argument('--xlsx', metavar='FILENAME')
+    pipeline.add_argument('--google-sheets', metavar='NAME')
+    pipeline.add_argument('--parquet', metavar='DIRECTORY')
+    pipeline.add_argument('--constant-memory', action='store_true')
+    pipeline.add_argument('--mode', choices=['drive', 'api'], default=None)
+    pipeline.add_argument('--processes', action='store_true',
+                          help='run every export in its own process instead of a thread')
 
     xlsx = subparsers.add_parser("daemon")
 
+    serve = subparsers.add_parser("serve")
+    serve.add_argument('--port', type=int, default=None)
+    serve.add_argument('--record', metavar='FILENAME',
+                       help='append every verified delivery to FILENAME, for webhook_replay.py')
 
     args = parser.parse_args()
 
+    if args.profile:
+        profiler.start(args.profile_mode, args.profile_output)
+
     config = configparser.ConfigParser()
 
     filename = 'github-google-sheets.ini'
@@ -64,6 +105,60 @@ if __name__ == '__main__':
     if gitlab_whitelist is not None:
         gitlab_whitelist = gitlab_whitelist.split(',')
 
+    sync_workers = config['default'].getint('sync_workers', 1)
+    github_requests_per_hour = config['default'].getint('github_requests_per_hour', 5000)
+    gitlab_requests_per_hour = config['default'].getint('gitlab_requests_per_hour', None)
+
+    cache_file = config['default'].get('http_cache', http_cache.CACHE_FILE)
+    cache_size = config['default'].getint('http_cache_size_mb', http_cache.CACHE_SIZE // (1024 * 1024)) * 1024 * 1024
+
+    github_backend = config['default'].get('github_backend', 'rest')
+    if getattr(args, 'github_backend', None) is not None:
+        github_backend = args.github_backend
+
+    sync_engine = config['default'].get('sync_engine', 'threads')
+    if getattr(args, 'engine', None) is not None:
+        sync_engine = args.engine
+    async_connections = config['default'].getint('async_connections', 20)
+    github_api_url = config['default'].get('github_api_url', import_github_async.API_URL)
+    gitlab_url = config['default'].get('gitlab_url', import_gitlab_async.GITLAB_URL)
+
+    constant_memory = config['default'].getboolean('xlsx_constant_memory', False)
+    if getattr(args, 'constant_memory', False):
+        constant_memory = True
+
+    google_sheets_export = config['default'].get('google_sheets_export', 'drive')
+    if getattr(args, 'mode', None) is not None:
+        google_sheets_export = args.mode
+    google_sheets_api_url = config['default'].get('google_sheets_api_url', None)
+
+    export_processes = config['default'].getboolean('export_processes', False)
+    if getattr(args, 'processes', False):
+        export_processes = True
+
+    webhook_host = config['default'].get('webhook_host', '127.0.0.1')
+    webhook_port = config['default'].getint('webhook_port', 8070)
+    if getattr(args, 'port', None) is not None:
+        webhook_port = args.port
+    github_webhook_secret = config['default'].get('github_webhook_secret', None)
+    gitlab_webhook_token = config['default'].get('gitlab_webhook_token', None)
+    webhook_reconcile_hours = config['default'].getfloat('webhook_reconcile_hours', 24)
+    webhook_export_minutes = config['default'].getfloat('webhook_export_minutes', 15)
+
+    daemon_requests_per_hour = config['default'].getint('daemon_requests_per_hour', 1000)
+    daemon_min_interval_minutes = config['default'].getfloat('daemon_min_interval_minutes', 5)
+    daemon_max_interval_hours = config['default'].getfloat('daemon_max_interval_hours', 24)
+    export_debounce_minutes = config['default'].getfloat('export_debounce_minutes', 5)
+    export_max_delay_minutes = config['default'].getfloat('export_max_delay_minutes', 30)
+
+    metrics_host = config['default'].get('metrics_host', '127.0.0.1')
+    metrics_port = config['default'].getint('metrics_port', 8071)
+    metrics_file = config['default'].get('metrics_file', metrics.METRICS_FILE)
+
+    database = None
+    if config['default'].get('storage', 'json') == 'sqlite':
+        database = config['default'].get('sqlite_file', issue_db.DB_FILE)
+
     github_org = config['default']['github_org']
     gitlab_org = config['default']['gitlab_org']
 
@@ -83,44 +178,197 @@ if __name__ == '__main__':
                 [m.strip() for m in config[section][key].split(',')]
             )
     #print(milestones)
+    github_importer = import_github
+    if github_backend == 'graphql':
+        github_importer = import_github_graphql
+
+    # The importers return the number of changed issues of every
+    # repository they synced. reponame can also be a list of names.
+    def sync_github(reponame=None, since=None):
+        if github_token is None:
+            return {}
+        if sync_engine == 'async':
+            return import_github_async.do_import(github_token, github_org, reponame, since,
+                                                 workers=sync_workers,
+                                                 requests_per_hour=github_requests_per_hour,
+                                                 connections=async_connections,
+                                                 base_url=github_api_url,
+                                                 database=database)
+        return github_importer.do_import(github_token, github_org, reponame, since,
+                                         workers=sync_workers,
+                                         requests_per_hour=github_requests_per_hour,
+                                         cache_file=cache_file, cache_size=cache_size,
+                                         database=database)
+
+    def sync_gitlab(reponame=None, since=None):
+        if gitlab_token is None:
+            return {}
+        if sync_engine == 'async':
+            return import_gitlab_async.do_import(gitlab_token, gitlab_org, reponame, since, whitelist=gitlab_whitelist,
+                                                 workers=sync_workers,
+                                                 requests_per_hour=gitlab_requests_per_hour,
+                                                 connections=async_connections,
+                                                 base_url=gitlab_url,
+                                                 database=database)
+        return import_gitlab.do_import(gitlab_token, gitlab_org, reponame, since, whitelist=gitlab_whitelist,
+                                       workers=sync_workers,
+                                       requests_per_hour=gitlab_requests_per_hour,
+                                       cache_file=cache_file, cache_size=cache_size,
+                                       database=database)
+
+    def synchronize(reponame=None, since=None):
+        sync_github(reponame, since)
+        sync_gitlab(reponame, since)
+
+    def sheet_sink(name):
+        if google_sheets_export == 'api':
+            return export_pipeline.SheetsApiSink(name, google_sheets_api_url)
+        return export_pipeline.GoogleSheetsSink(name, constant_memory)
+
+    def export(sinks, burndown_cache, index):
+        # One read of the store feeds all sinks
+        with metrics.timer('export_pipeline_seconds'):
+            bd = export_pipeline.run(open_store(), sinks, milestones, burndown_cache, index, export_processes)
+        if bd is not None:
+            print("Burndown: %(reused)d series reused, %(recomputed)d recomputed" % burndown_cache.stats())
+
+    def open_store():
+        # Exports read the store one repository at a time, from the SQLite
+        # mirror when there is one
+        if database is not None:
+            return issue_db.open_db(database)
+        return issue_store.IssueStream()
+
     if args.command == 'sync':
         since = None
         if args.full:
             since = datetime.datetime.strptime("1969-12-31T21:00:00Z", "%Y-%m-%dT%H:%M:%SZ")
 
-        if github_token is not None:
-            import_github.do_import(github_token, github_org, args.reponame, since)
-        if gitlab_token is not None:
-            import_gitlab.do_import(gitlab_token, gitlab_org, args.reponame, since, whitelist=gitlab_whitelist)
+        if args.workers is not None:
+            sync_workers = args.workers
+
+        with metrics.timer('sync_seconds'):
+            synchronize(args.reponame, since)
         print("Synchronization finished successfully")
+        metrics.dump(metrics_file)
+        print("Metrics written to %s" % metrics_file)
 
     elif args.command == 'export':
-        issues = {}
-        if os.path.exists('issues.json'):
-            with open('issues.json', encoding='utf-8') as f:
-                issues = json.loads(f.read())
+        burndown_cache = burndown.BurndownCache()
+        index = burndown.MilestoneIndex(milestones)
 
+        sinks = []
         if args.export_command == 'tsv':
-            export_tsv.do_export(issues, args.filename, github_org)
+            sinks.append(export_pipeline.TsvSink(args.filename, github_org))
         elif args.export_command == 'xlsx':
-            export_xlsx.do_export(issues, args.filename, milestones)
+            sinks.append(export_pipeline.XlsxSink(args.filename, constant_memory))
+        elif args.export_command == 'parquet':
+            sinks.append(export_pipeline.ParquetSink(args.directory))
         elif args.export_command == 'google_sheets':
-            export_google_sheets.do_export(issues, args.filename, milestones)
+            sinks.append(sheet_sink(args.filename))
+        elif args.export_command == 'pipeline':
+            if args.tsv is not None:
+                sinks.append(export_pipeline.TsvSink(args.tsv, github_org))
+            if args.xlsx is not None:
+                sinks.append(export_pipeline.XlsxSink(args.xlsx, constant_memory))
+            if args.google_sheets is not None:
+                sinks.append(sheet_sink(args.google_sheets))
+            if args.parquet is not None:
+                sinks.append(export_pipeline.ParquetSink(args.parquet))
+
+        export(sinks, burndown_cache, index)
     elif args.command == 'daemon':
+        burndown_cache = burndown.BurndownCache()
+        schedule = scheduler.Schedule(requests_per_hour=daemon_requests_per_hour,
+                                      min_interval=daemon_min_interval_minutes * 60,
+                                      max_interval=daemon_max_interval_hours * 3600)
+        debounce = scheduler.Debounce(export_debounce_minutes * 60, export_max_delay_minutes * 60)
+        metrics.serve(metrics_host, metrics_port)
+        print("Serving metrics on http://%s:%d/metrics" % (metrics_host, metrics_port))
+        forges = [('github.com', github_org, sync_github), ('gitlab.com', gitlab_org, sync_gitlab)]
+
         while True:
-            if github_token is not None:
-                import_github.do_import(github_token, github_org)
-            if gitlab_token is not None:
-                import_gitlab.do_import(gitlab_token, gitlab_org, whitelist=gitlab_whitelist)
-            print("Synchronization finished successfully")
-
-            issues = {}
-            if os.path.exists('issues.json'):
-                with open('issues.json', encoding='utf-8') as f:
-                    issues = json.loads(f.read())
-
-            if sheet_name is not None:
-                export_google_sheets.do_export(issues, sheet_name, milestones)
-
-            print("Sleeping for 60 minutes")
-            time.sleep(3600)
+            now = time.time()
+            changed = 0
+            if schedule.full_sync_due(now):
+                # Also finds repositories that are new or gone
+                for source, orgname, sync_forge in forges:
+                    with metrics.timer('sync_seconds'):
+                        changes = sync_forge()
+                    schedule.record(source, orgname, changes, time.time())
+                    changed += sum(changes.values())
+                schedule.record_full_sync(now)
+                print("Synchronization finished successfully")
+            else:
+                due = schedule.due(now)
+                for source, orgname, sync_forge in forges:
+                    reponames = due.get(source, {}).get(orgname)
+                    if reponames:
+                        with metrics.timer('sync_seconds'):
+                            changes = sync_forge(reponames)
+                        metrics.inc('daemon_repos_polled_total', len(reponames), source=source)
+                        schedule.record(source, orgname, changes, time.time(), reponames)
+                        changed += sum(changes.values())
+                        print("Polled %d %s repositories, %d changed issues" % (
+                            len(reponames), source, sum(changes.values())))
+            schedule.save()
+
+            if changed and sheet_name is not None:
+                debounce.changed(time.time())
+
+            if debounce.due(time.time()):
+                # Aliases depend on the store, so the index is rebuilt
+                # before every export
+                index = burndown.MilestoneIndex(milestones)
+                export([sheet_sink(sheet_name)], burndown_cache, index)
+                debounce.done()
+
+            wake = schedule.next_poll()
+            if debounce.deadline() is not None:
+                wake = min(wake, debounce.deadline())
+            delay = max(wake - time.time(), 10)
+            print("Sleeping for %d minutes" % round(delay / 60))
+            time.sleep(delay)
+    elif args.command == 'serve':
+        if github_webhook_secret is None and gitlab_webhook_token is None:
+            raise RuntimeError('github_webhook_secret or gitlab_webhook_token must be configured.')
+
+        burndown_cache = burndown.BurndownCache()
+
+        def export_sheet():
+            export([sheet_sink(sheet_name)], burndown_cache, burndown.MilestoneIndex(milestones))
+
+        async def serve_webhooks():
+            github_client = None
+            if github_token is not None and github_webhook_secret is not None:
+                github_client = import_github_async.connect(github_token, github_requests_per_hour,
+                                                            async_connections, github_api_url)
+            gitlab_client = None
+            if gitlab_token is not None and gitlab_webhook_token is not None:
+                gitlab_client = import_gitlab_async.connect(gitlab_token, gitlab_requests_per_hour,
+                                                            async_connections, gitlab_url)
+
+            async def reconcile():
+                # Polling is only a safety net for missed deliveries here
+                if github_client is not None:
+                    await import_github_async.try_sync_issues(github_client, github_org, None, None,
+                                                              sync_workers, database)
+                if gitlab_client is not None:
+                    await import_gitlab_async.try_sync_issues(gitlab_client, gitlab_org, None, None,
+                                                              gitlab_whitelist, sync_workers, database)
+
+            receiver = webhook.Receiver(github_webhook_secret, gitlab_webhook_token,
+                                        github_client, github_org,
+                                        gitlab_client, gitlab_org, gitlab_whitelist,
+                                        database, args.record)
+            try:
+                await webhook.serve(receiver, webhook_host, webhook_port, reconcile,
+                                    webhook_reconcile_hours * 3600,
+                                    export_sheet if sheet_name is not None else None,
+                                    webhook_export_minutes * 60)
+            finally:
+                for client in [github_client, gitlab_client]:
+                    if client is not None:
+                        await client.close()
+
+        asyncio.run(serve_webhooks())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import queue
+import threading
+import time
+
+import issue_db
+import issue_store
+import metrics
+import profiler
+
+
+class Cancelled(Exception):
+    pass
+
+
+def selected(reponame, name):
+    # reponame selects the repositories to sync: None for all of them, a
+    # name, or a list of names
+    if reponame is None:
+        return True
+    if isinstance(reponame, str):
+        return name == reponame
+    return name in reponame
+
+
+def run(jobs, workers, write):
+    # Run each job in a pool of worker threads. Jobs hand their results to
+    # emit(), and all of them are written from the calling thread, so the
+    # issue store only ever has a single writer.
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def emit(*item):
+        if stop.is_set():
+            raise Cancelled()
+        results.put(item)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        pending = set()
+        for job in jobs:
+            pending.add(pool.submit(job, emit))
+
+        while pending or not results.empty():
+            try:
+                item = results.get(timeout=0.1)
+            except queue.Empty:
+                done = {f for f in pending if f.done()}
+                for f in done:
+                    # Re-raise the first failure from a worker
+                    f.result()
+                pending -= done
+                continue
+
+            write(*item)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class Progress:
+    # Survives retries of a sync so it can resume where it stopped: the
+    # loaded store, the repository list, the repositories that are
+    # finished and the updated_at of the last issue written for the others.
+    # database is the file of an issue_db mirror to keep up to date, if any.
+    # changed counts the issues written per repository.
+    def __init__(self, database=None):
+        self.database = database
+        self.issues = None
+        self.meta = None
+        self.repos = None
+        self.done = set()
+        self.cursor = {}
+        self.changed = {}
+
+    def changes(self):
+        # Number of changed issues of every repository that was synced
+        return {reponame: self.changed.get(reponame, 0) for reponame in self.done}
+
+
+class StoreWriter:
+    # The single writer of a sync: applies fetched records to the in-memory
+    # store and the journal and moves repository watermarks once they are
+    # durable. Not thread-safe, it must only be called from one thread.
+    def __init__(self, issues, meta, source, progress):
+        self.issues = issues
+        self.meta = meta
+        self.source = source
+        self.progress = progress
+        self.journal = issue_store.Journal()
+        self.c = 1
+
+        self.db = None
+        self.pending = []
+        if progress.database is not None:
+            self.db = issue_db.open_db(progress.database)
+
+    @profiler.traced('sync_pool.StoreWriter.write')
+    def write(self, orgname, reponame, record, etag=None, duration=None):
+        if record is None:
+            self.finish_repo(orgname, reponame, etag, duration)
+            return
+
+        self.issues[orgname][reponame][str(record['number'])] = record
+        self.progress.cursor[reponame] = record['updated_at']
+        self.progress.changed[reponame] = self.progress.changed.get(reponame, 0) + 1
+        metrics.inc('sync_issues_total', source=self.source, repo=reponame)
+        self.journal.append(orgname, reponame, record)
+        if self.db is not None:
+            self.pending.append((orgname, reponame, record))
+        self.c = self.c +1
+        if self.c % 100 == 99:
+           self.sync()
+
+    @profiler.traced('sync_pool.StoreWriter.sync')
+    def sync(self):
+        # Everything written so far is on disk after this
+        with metrics.timer('store_sync_seconds'):
+            self.journal.sync()
+            self.flush_db()
+
+    def flush_db(self):
+        if self.pending:
+            self.db.upsert(self.pending)
+            self.pending = []
+
+    def finish_repo(self, orgname, reponame, etag, duration):
+        # The repository's issues must be on disk before the watermark moves
+        # past them
+        self.sync()
+
+        entry = self.meta.setdefault(self.source, {}).setdefault(orgname, {}).setdefault(reponame, {})
+        watermark = self.progress.cursor.get(reponame)
+        if watermark is not None and watermark > entry.get('watermark', ''):
+            entry['watermark'] = watermark
+        if etag is not None:
+            entry['etag'] = etag
+        entry['duration'] = round(duration, 3)
+        issue_store.write_meta(self.meta)
+        metrics.observe('sync_repo_seconds', duration, source=self.source)
+        metrics.set_gauge('sync_repo_last_duration_seconds', round(duration, 3), source=self.source, repo=reponame)
+
+        self.progress.done.add(reponame)
+
+    def finish(self):
+        self.sync()
+        with metrics.timer('store_compact_seconds'):
+            issue_store.maybe_compact(self.issues, self.journal)
+
+    def close(self):
+        self.journal.close()
+        if self.db is not None:
+            self.db.close()
+
+
+def sync_into_store(issues, meta, source, orgname, jobs, workers, progress):
+    # jobs is a list of (reponame, job). A job emits (orgname, reponame,
+    # record) for every fetched issue and returns the ETag of the issue
+    # listing, if it knows one.
+    writer = StoreWriter(issues, meta, source, progress)
+
+    def timed(reponame, job):
+        def run_job(emit):
+            start = time.monotonic()
+            etag = job(emit)
+            emit(orgname, reponame, None, etag, time.monotonic() - start)
+        return run_job
+
+    try:
+        run([timed(reponame, job) for reponame, job in jobs], workers, writer.write)
+        writer.finish()
+    finally:
+        writer.close()
+
+
+def fetch_after(fetch_page, cursor, per_page):
+    # Fetch the items of an oldest-first paginated list that come after the
+    # cursor {'count': items seen, 'id': id of the last one}. Returns the new
+    # items, the new cursor and whether the items are the whole list, which
+    # happens when there is no cursor or it no longer matches the list.
+    start = 0
+    if cursor is not None:
+        start = cursor['count']
+
+    page = 0
+    if start > 0:
+        page = (start - 1) // per_page
+
+    items = []
+    index = page * per_page
+    verified = start == 0
+    while True:
+        batch = fetch_page(page)
+        for item in batch:
+            if index == start - 1:
+                if item.id != cursor['id']:
+                    return fetch_after(fetch_page, None, per_page)
+                verified = True
+            elif index >= start:
+                items.append(item)
+            index += 1
+
+        if len(batch) < per_page:
+            break
+        page += 1
+
+    if not verified:
+        return fetch_after(fetch_page, None, per_page)
+
+    new_cursor = cursor
+    if items:
+        new_cursor = {'count': start + len(items), 'id': items[-1].id}
+
+    return items, new_cursor, start == 0
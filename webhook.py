@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# Webhook receiver for `sync.py serve`. GitHub `issues` and `milestone`
+# events and GitLab issue hooks are checked against the shared secret,
+# acknowledged at once and queued. Each one is then applied to the store
+# as an upsert of the issue it is about, fetching only what the payload
+# doesn't carry: new events of the issue, and for GitLab the issue itself.
+# Store writes, the periodic reconciliation sync and exports all take the
+# same lock, so the store keeps a single writer.
+
+import asyncio
+import fnmatch
+import hashlib
+import hmac
+import json
+import time
+import traceback
+import types
+
+from aiohttp import web
+
+import import_github_async
+import import_gitlab
+import import_gitlab_async
+import issue_store
+import metrics
+import sync_pool
+
+GITHUB_EVENTS = ['issues', 'milestone']
+GITLAB_EVENTS = ['Issue Hook', 'Confidential Issue Hook']
+
+
+def github_signature(secret, body):
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+
+class Receiver:
+    # github_client and gitlab_client are async_http clients of the
+    # importers, None for a forge that isn't synchronized. record is a
+    # file every verified delivery is appended to, for webhook_replay.py.
+    def __init__(self, github_secret=None, gitlab_token=None,
+                 github_client=None, github_org=None,
+                 gitlab_client=None, gitlab_org=None, gitlab_whitelist=None,
+                 database=None, record=None):
+        self.github_secret = github_secret
+        self.gitlab_token = gitlab_token
+        self.github_client = github_client
+        self.github_org = github_org
+        self.gitlab_client = gitlab_client
+        self.gitlab_org = gitlab_org
+        self.gitlab_whitelist = gitlab_whitelist
+        self.database = database
+        self.record = record
+
+        self.queue = asyncio.Queue()
+        self.lock = asyncio.Lock()
+        # Number of upserts so far, for deciding whether to export
+        self.changes = 0
+
+        self.open_store()
+
+    def open_store(self):
+        self.issues = issue_store.read_issues()
+        self.writer = sync_pool.StoreWriter(self.issues, issue_store.read_meta(), 'webhook',
+                                            sync_pool.Progress(self.database))
+
+    def close_store(self):
+        try:
+            self.writer.finish()
+        finally:
+            self.writer.close()
+
+    def upsert(self, orgname, reponame, record, milestone_change=False):
+        # A delivery no newer than what is stored, e.g. one that was retried
+        # or already seen by a sync, is dropped. Milestone renames and
+        # deletions change issues without touching their updated_at, so
+        # those are only dropped when they leave the record as it was.
+        repo_issues = self.issues.setdefault(orgname, {}).setdefault(reponame, {})
+        previous = repo_issues.get(str(record['number']))
+        if previous is not None:
+            if previous['updated_at'] > record['updated_at']:
+                return
+            if previous['updated_at'] == record['updated_at'] and (not milestone_change or previous == record):
+                return
+
+        self.writer.write(orgname, reponame, record)
+        self.writer.sync()
+        self.changes += 1
+
+    def deliver(self, forge, event, payload):
+        metrics.inc('webhook_deliveries_total', forge=forge, event=event)
+        if self.record is not None:
+            with open(self.record, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'forge': forge, 'event': event, 'payload': payload}, ensure_ascii=False) + '\n')
+        self.queue.put_nowait((forge, event, payload))
+
+    async def github_hook(self, request):
+        body = await request.read()
+        if self.github_secret is None or not hmac.compare_digest(
+                request.headers.get('X-Hub-Signature-256', ''), github_signature(self.github_secret, body)):
+            metrics.inc('webhook_rejected_total', forge='github')
+            return web.Response(status=401, text='Bad signature')
+
+        event = request.headers.get('X-GitHub-Event')
+        if event == 'ping':
+            return web.Response(text='pong')
+        if event not in GITHUB_EVENTS:
+            return web.Response(status=202, text='Ignored')
+
+        self.deliver('github', event, json.loads(body))
+        return web.Response(status=202, text='Queued')
+
+    async def gitlab_hook(self, request):
+        body = await request.read()
+        if self.gitlab_token is None or not hmac.compare_digest(
+                request.headers.get('X-Gitlab-Token', ''), self.gitlab_token):
+            metrics.inc('webhook_rejected_total', forge='gitlab')
+            return web.Response(status=401, text='Bad token')
+
+        event = request.headers.get('X-Gitlab-Event')
+        if event not in GITLAB_EVENTS:
+            return web.Response(status=202, text='Ignored')
+
+        self.deliver('gitlab', event, json.loads(body))
+        return web.Response(status=202, text='Queued')
+
+    async def work(self):
+        while True:
+            forge, event, payload = await self.queue.get()
+            try:
+                async with self.lock:
+                    with metrics.timer('webhook_apply_seconds', forge=forge):
+                        if forge == 'github':
+                            await self.apply_github(event, payload)
+                        else:
+                            await self.apply_gitlab(event, payload)
+            except Exception:
+                metrics.inc('webhook_failures_total', forge=forge)
+                print("Failed to apply %s %s event" % (forge, event))
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    async def apply_github(self, event, payload):
+        repository = payload['repository']
+        orgname = repository['owner']['login']
+        reponame = repository['name']
+        if self.github_client is None or orgname != self.github_org:
+            return
+
+        repo_issues = self.issues.get(orgname, {}).get(reponame, {})
+
+        if event == 'milestone':
+            # Renaming or deleting a milestone changes the milestone of its
+            # issues without touching the issues themselves
+            milestone = payload['milestone']
+            if payload['action'] == 'edited' and 'title' in payload.get('changes', {}):
+                title = milestone['title']
+            elif payload['action'] == 'deleted':
+                title = None
+            else:
+                return
+
+            for number, record in list(repo_issues.items()):
+                if record['source'] == 'github.com' and record.get('milestone_number') == milestone['number']:
+                    self.upsert(orgname, reponame, dict(
+                        record, milestone=title, milestone_number=milestone['number'] if title is not None else None),
+                        milestone_change=True)
+            print("github.com webhook: %s/%s milestone %s %s" % (orgname, reponame, milestone['title'], payload['action']))
+            return
+
+        issue = payload['issue']
+        if payload['action'] in ['deleted', 'transferred']:
+            # The store never drops issues, the reconciliation sync will
+            # leave it as it was last seen
+            return
+
+        previous = repo_issues.get(str(issue['number']))
+        if previous is not None and previous['updated_at'] >= issue['updated_at']:
+            # Nothing new, don't spend requests on its events
+            return
+        events, event_cursor = await import_github_async.get_issue_events(
+            self.github_client, repository['full_name'], issue, previous)
+        print("github.com webhook %s: %s/%s %d %s" % (issue['updated_at'], orgname, reponame, issue['number'], issue['title']))
+        self.upsert(orgname, reponame, import_github_async.issue_record(issue, orgname, reponame, events, event_cursor))
+
+    async def apply_gitlab(self, event, payload):
+        # The hook names the milestone by id only and labels differently
+        # from the API, so the issue is read from the API like a sync does
+        path = payload['project']['path_with_namespace']
+        if self.gitlab_client is None or not path.startswith(self.gitlab_org + '/'):
+            return
+        if self.gitlab_whitelist is not None and not any(fnmatch.fnmatch(path, entry) for entry in self.gitlab_whitelist):
+            return
+
+        orgname = self.gitlab_org
+        reponame = path[len(orgname) + 1:]
+        project_id = payload['project']['id']
+
+        status, issue, links, headers = await self.gitlab_client.get(
+            '/projects/%d/issues/%d' % (project_id, payload['object_attributes']['iid']))
+
+        previous = self.issues.get(orgname, {}).get(reponame, {}).get(str(issue['iid']))
+        if previous is not None and previous['updated_at'] >= import_gitlab.convert_time(issue['updated_at']):
+            return
+        events, event_cursor = await import_gitlab_async.get_issue_events(
+            self.gitlab_client, project_id, issue, previous)
+        print("gitlab.com webhook %s: %s/%s %d %s" % (
+            import_gitlab.convert_time(issue['updated_at']), orgname, reponame, issue['iid'], issue['title']))
+        self.upsert(orgname, reponame, import_gitlab.make_record(
+            types.SimpleNamespace(**issue), orgname, reponame, events, event_cursor))
+
+    async def reconcile(self, synchronize):
+        # A full incremental sync, with the store closed so the importers
+        # are its only writer, catching whatever webhooks missed
+        async with self.lock:
+            self.close_store()
+            try:
+                await synchronize()
+            finally:
+                self.open_store()
+
+    async def export(self, export):
+        # export is a blocking function reading the store, run in a thread
+        # while no webhook writes
+        async with self.lock:
+            await asyncio.get_running_loop().run_in_executor(None, export)
+
+    async def metrics_page(self, request):
+        return web.Response(text=metrics.render(), content_type='text/plain')
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/github', self.github_hook)
+        app.router.add_post('/gitlab', self.gitlab_hook)
+        app.router.add_get('/metrics', self.metrics_page)
+        return app
+
+
+async def serve(receiver, host, port, synchronize, reconcile_interval, export=None, export_interval=900):
+    # Reconciles at start and then every reconcile_interval seconds, and
+    # exports after each reconciliation and every export_interval seconds
+    # if webhooks changed anything since the last export
+    runner = web.AppRunner(receiver.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print("Listening for webhooks on http://%s:%d/github and /gitlab" % (host, port))
+
+    worker = asyncio.ensure_future(receiver.work())
+    try:
+        next_reconcile = time.monotonic()
+        exported = None
+        while True:
+            if time.monotonic() >= next_reconcile:
+                await receiver.reconcile(synchronize)
+                print("Reconciliation finished")
+                next_reconcile = time.monotonic() + reconcile_interval
+                exported = None
+
+            if export is not None and exported != receiver.changes:
+                exported = receiver.changes
+                await receiver.export(export)
+
+            await asyncio.sleep(min(export_interval, max(0, next_reconcile - time.monotonic())))
+    finally:
+        worker.cancel()
+        await runner.cleanup()
+        receiver.close_store()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Replays webhook deliveries against a `sync.py serve` receiver, signed the
+# way GitHub and GitLab sign them. Deliveries are read from a file recorded
+# with `sync.py serve --record`, one {"forge", "event", "payload"} object
+# per line:
+#
+#   ./webhook_replay.py --secret s --token t deliveries.jsonl
+#
+# or generated for the organization fake_api.py serves with the same
+# --org, --repos and --issues:
+#
+#   ./webhook_replay.py --secret s --token t --generate 100
+
+import argparse
+import json
+import random
+import time
+import urllib.error
+import urllib.request
+
+import fake_api
+import webhook
+
+
+def read_deliveries(filename):
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def generate(count, orgname='org', repos=10, issues=100, seed=1):
+    data = fake_api.generate(orgname, repos, issues)
+    rnd = random.Random(seed)
+
+    for i in range(count):
+        repo = rnd.choice(data['repos'])
+        issue = rnd.choice(repo['issues'])
+        if issue['is_pr'] or rnd.random() < 0.5:
+            yield {
+                'forge': 'github',
+                'event': 'issues',
+                'payload': {
+                    'action': 'edited',
+                    'issue': fake_api.github_issue(issue),
+                    'repository': {
+                        'name': repo['name'],
+                        'full_name': '%s/%s' % (orgname, repo['name']),
+                        'owner': {'login': orgname}
+                    }
+                }
+            }
+        else:
+            yield {
+                'forge': 'gitlab',
+                'event': 'Issue Hook',
+                'payload': {
+                    'object_kind': 'issue',
+                    'project': {
+                        'id': repo['id'],
+                        'path_with_namespace': '%s/%s' % (orgname, repo['name'])
+                    },
+                    'object_attributes': {'iid': issue['number'], 'action': 'update'}
+                }
+            }
+
+
+def deliver(url, delivery, secret=None, token=None):
+    # Returns the HTTP status of the delivery
+    body = json.dumps(delivery['payload']).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if delivery['forge'] == 'github':
+        url = url + '/github'
+        headers['X-GitHub-Event'] = delivery['event']
+        if secret is not None:
+            headers['X-Hub-Signature-256'] = webhook.github_signature(secret, body)
+    else:
+        url = url + '/gitlab'
+        headers['X-Gitlab-Event'] = delivery['event']
+        if token is not None:
+            headers['X-Gitlab-Token'] = token
+
+    request = urllib.request.Request(url, body, headers, method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='?', help='recorded deliveries')
+    parser.add_argument('--url', default='http://127.0.0.1:8070')
+    parser.add_argument('--secret', help='github_webhook_secret of the receiver')
+    parser.add_argument('--token', help='gitlab_webhook_token of the receiver')
+    parser.add_argument('--generate', type=int, metavar='N', help='send N generated deliveries instead')
+    parser.add_argument('--org', default='org')
+    parser.add_argument('--repos', type=int, default=10)
+    parser.add_argument('--issues', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.generate is not None:
+        deliveries = generate(args.generate, args.org, args.repos, args.issues)
+    elif args.file is not None:
+        deliveries = read_deliveries(args.file)
+    else:
+        parser.error('a file or --generate is required')
+
+    start = time.monotonic()
+    statuses = {}
+    for delivery in deliveries:
+        status = deliver(args.url.rstrip('/'), delivery, args.secret, args.token)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    print("Sent %d deliveries in %.2f seconds: %s" % (
+        sum(statuses.values()), time.monotonic() - start,
+        ', '.join('%d x %d' % (count, status) for status, count in sorted(statuses.items()))))